@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Cliente HFTP asincrónico, sobre asyncio, para herramientas que hacen
+miles de pedidos a la vez a uno o más servers.
+
+AsyncConnection es una conexión que atiende un pedido por vez.
+ConnectionPool mantiene conexiones persistentes a cada server y reparte
+los pedidos entre ellas, con un límite de pedidos en curso, un plazo por
+pedido medido en tiempo de reloj y reconexión automática: si una conexión
+se corta (p.ej. el server la cerró por inactividad) el pedido se
+reintenta con otra. Los pedidos de HFTP solo leen, así que reintentarlos
+es seguro.
+
+Ejemplo:
+
+    async with ConnectionPool([("127.0.0.1", DEFAULT_PORT)]) as pool:
+        sizes = await asyncio.gather(*(pool.get_metadata(f) for f in names))
+"""
+
+import asyncio
+import itertools
+import logging
+import optparse
+import sys
+from base64 import b64decode
+from constants import *
+
+
+class ResponseError(Exception):
+    """
+    El server contestó el pedido con un código de error.
+    """
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.message = message
+
+
+class AsyncConnection(object):
+    """
+    Conexión con un server HFTP, para usar desde asyncio. Atiende un
+    pedido por vez; para hacer varios a la vez se usan varias conexiones,
+    como en ConnectionPool.
+
+    Los métodos lanzan ResponseError si el server contesta con un código de
+    error, y OSError o asyncio.IncompleteReadError si se corta la conexión.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.connected = True
+
+    @classmethod
+    async def open(cls, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+        """
+        Abre una conexión nueva con el `server` en el `port` TCP indicado.
+        """
+        reader, writer = await asyncio.open_connection(server, port)
+        return cls(reader, writer)
+
+    async def close(self):
+        """
+        Cierra la conexión, avisándole antes al server con quit.
+        """
+        if self.connected:
+            try:
+                await self.request("quit")
+            except (OSError, asyncio.IncompleteReadError, ResponseError):
+                pass  # Se cierra igual
+        self.abort()
+
+    def abort(self):
+        """
+        Cierra la conexión sin avisarle al server.
+        """
+        self.connected = False
+        self.writer.close()
+
+    async def read_line(self):
+        """
+        Espera una línea completa y la devuelve sin el fin de línea ni los
+        espacios al principio y al final.
+        """
+        line = await self.reader.readuntil(EOL_BYTES)
+        return line[: -len(EOL_BYTES)].decode("ascii").strip()
+
+    async def request(self, line: str):
+        """
+        Envía el pedido y lee la línea de respuesta. Si el código no es
+        CODE_OK lanza ResponseError; si además es fatal, el server cierra
+        la conexión.
+        """
+        self.writer.write((line + EOL).encode("ascii"))
+        await self.writer.drain()
+        response = await self.read_line()
+        code, _, message = response.partition(" ")
+        try:
+            code = int(code)
+        except ValueError:
+            # Ya no se sabe dónde empieza la próxima respuesta
+            self.abort()
+            raise ConnectionError(f"Respuesta inválida: {response!r}")
+        if code != CODE_OK:
+            if not valid_status(code) or fatal_status(code):
+                self.abort()
+            raise ResponseError(code, message)
+
+    async def read_lines(self):
+        """
+        Lee líneas hasta la línea vacía que termina la respuesta.
+        """
+        lines = []
+        line = await self.read_line()
+        while line:
+            lines.append(line)
+            line = await self.read_line()
+        return lines
+
+    async def read_fragment(self):
+        """
+        Lee un fragmento codificado en base64 y lo devuelve decodificado.
+        La línea se lee de a partes, así no importa cuánto mida.
+        """
+        parts = []
+        pending = b""  # Caracteres base64 que todavía no se decodificaron
+        while True:
+            try:
+                data = (await self.reader.readuntil(EOL_BYTES))[: -len(EOL_BYTES)]
+                last = True
+            except asyncio.LimitOverrunError as e:
+                data = await self.reader.readexactly(e.consumed)
+                last = False
+            data = pending + data
+            # Se decodifica de a grupos de 4 caracteres base64 (3 bytes)
+            cut = len(data) if last else len(data) - len(data) % 4
+            parts.append(b64decode(data[:cut]))
+            pending = data[cut:]
+            if last:
+                return b"".join(parts)
+
+    async def get_file_listing(self, offset=None, count=None):
+        """
+        Devuelve la lista de archivos del server, o solo una página de
+        `count` nombres desde `offset` si se da alguno de los dos (como en
+        Client.file_lookup).
+        """
+        if offset is None and count is None:
+            await self.request("get_file_listing")
+        else:
+            if offset is None:
+                offset = 0
+            if count is None:
+                count = LISTING_PAGE_SIZE
+            await self.request("get_file_listing %d %d" % (offset, count))
+        return await self.read_lines()
+
+    async def get_metadata(self, filename):
+        """
+        Devuelve el tamaño del archivo.
+        """
+        await self.request("get_metadata %s" % filename)
+        return int(await self.read_line())
+
+    async def get_metadata_multi(self, filenames):
+        """
+        Devuelve una lista de pares (código, tamaño) con el tamaño de cada
+        archivo, en el mismo orden, con tamaño None si falló ese archivo.
+        """
+        await self.request("get_metadata_multi %s" % " ".join(filenames))
+        entries = []
+        for line in await self.read_lines():
+            code, value = line.split(None, 1)
+            code = int(code)
+            entries.append((code, int(value) if code == CODE_OK else None))
+        return entries
+
+    async def get_checksum(self, filename, start=None, length=None):
+        """
+        Devuelve el checksum (BLAKE2b, en hexadecimal) del archivo, o del
+        rango de `length` bytes desde `start` si se dan.
+        """
+        if start is None:
+            await self.request("get_checksum %s" % filename)
+        else:
+            await self.request("get_checksum %s %d %d" % (filename, start, length))
+        return await self.read_line()
+
+    async def get_slice(self, filename, start, length):
+        """
+        Devuelve `length` bytes del archivo a partir de `start`.
+        """
+        await self.request("get_slice %s %d %d" % (filename, start, length))
+        return await self.read_fragment()
+
+    async def get_slice_raw(self, filename, start, length):
+        """
+        Como get_slice, pero el server envía los bytes sin codificar.
+        """
+        await self.request("get_slice_raw %s %d %d" % (filename, start, length))
+        data = await self.reader.readexactly(length)
+        if await self.reader.readuntil(EOL_BYTES) != EOL_BYTES:
+            self.abort()
+            raise ConnectionError("Se esperaba el fin de línea luego del fragmento")
+        return data
+
+
+class ServerPool(object):
+    """
+    Conexiones persistentes a un server, como mucho `connections` a la
+    vez. Las que quedan libres se guardan para los próximos pedidos.
+    """
+
+    def __init__(self, server: str, port: int, connections: int):
+        self.server = server
+        self.port = port
+        self.slots = asyncio.Semaphore(connections)
+        self.idle = []  # Conexiones libres; se usa primero la última
+
+    async def run(self, operation):
+        """
+        Ejecuta `operation` con una conexión libre, o una nueva si no hay.
+        La conexión vuelve al pool salvo que se haya cortado o el pedido
+        se haya interrumpido (p.ej. por el plazo), porque entonces su
+        respuesta puede haber quedado a medio leer.
+        """
+        async with self.slots:
+            conn = None
+            while self.idle and conn is None:
+                conn = self.idle.pop()
+                if not conn.connected or conn.reader.at_eof():
+                    conn.abort()
+                    conn = None
+            if conn is None:
+                conn = await AsyncConnection.open(self.server, self.port)
+            try:
+                result = await operation(conn)
+            except ResponseError:
+                if conn.connected:
+                    self.idle.append(conn)
+                raise
+            except BaseException:
+                conn.abort()
+                raise
+            self.idle.append(conn)
+            return result
+
+    async def close(self):
+        """
+        Cierra las conexiones libres.
+        """
+        idle, self.idle = self.idle, []
+        await asyncio.gather(*(conn.close() for conn in idle))
+
+
+class ConnectionPool(object):
+    """
+    Pool de conexiones persistentes a uno o más servers HFTP con los
+    mismos archivos. Los pedidos se reparten entre los servers por turnos,
+    con hasta `connections` conexiones por server y hasta `concurrency`
+    pedidos en curso en total; los demás esperan su turno.
+
+    Cada pedido tiene un plazo de `timeout` segundos de reloj, que incluye
+    la espera de su turno y los reintentos: si se cumple, lanza
+    asyncio.TimeoutError. Si se corta la conexión, el pedido se reintenta
+    con una conexión nueva del server siguiente, hasta `attempts` veces.
+    """
+
+    def __init__(
+        self,
+        servers,
+        connections=POOL_CONNECTIONS,
+        concurrency=POOL_CONCURRENCY,
+        timeout=REQUEST_TIMEOUT,
+        attempts=REQUEST_ATTEMPTS,
+    ):
+        """
+        Args:
+            servers: Lista de pares (dirección, puerto).
+            connections (int): Conexiones abiertas como máximo por server.
+            concurrency (int): Pedidos en curso como máximo.
+            timeout (float): Plazo por defecto de cada pedido, en segundos.
+            attempts (int): Intentos por pedido si falla la conexión.
+        """
+        assert servers
+        self.servers = [
+            ServerPool(server, port, connections) for server, port in servers
+        ]
+        self.turn = itertools.count()
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.attempts = attempts
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def run(self, operation, timeout=None):
+        """
+        Ejecuta `operation`, una función async que recibe una
+        AsyncConnection, con una conexión del pool.
+
+        Args:
+            timeout (float): Plazo del pedido, en segundos. Por defecto,
+                el del pool.
+
+        Devuelve el resultado de `operation`.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return await asyncio.wait_for(self._run(operation), timeout)
+
+    async def _run(self, operation):
+        """
+        Cuerpo de run(), sin el plazo.
+
+        Para uso privado del pool.
+        """
+        async with self.concurrency:
+            for attempt in range(1, self.attempts + 1):
+                server = self.servers[next(self.turn) % len(self.servers)]
+                try:
+                    return await server.run(operation)
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    if attempt == self.attempts:
+                        raise
+                    logging.info(
+                        "Falló la conexión con %s:%d (%s), reintentando."
+                        % (server.server, server.port, e)
+                    )
+
+    async def get_file_listing(self, offset=None, count=None, timeout=None):
+        return await self.run(lambda c: c.get_file_listing(offset, count), timeout)
+
+    async def get_metadata(self, filename, timeout=None):
+        return await self.run(lambda c: c.get_metadata(filename), timeout)
+
+    async def get_metadata_multi(self, filenames, timeout=None):
+        return await self.run(lambda c: c.get_metadata_multi(filenames), timeout)
+
+    async def get_checksum(self, filename, start=None, length=None, timeout=None):
+        return await self.run(
+            lambda c: c.get_checksum(filename, start, length), timeout
+        )
+
+    async def get_slice(self, filename, start, length, timeout=None):
+        return await self.run(lambda c: c.get_slice(filename, start, length), timeout)
+
+    async def get_slice_raw(self, filename, start, length, timeout=None):
+        return await self.run(
+            lambda c: c.get_slice_raw(filename, start, length), timeout
+        )
+
+    async def close(self):
+        """
+        Cierra las conexiones libres de todos los servers.
+        """
+        await asyncio.gather(*(server.close() for server in self.servers))
+
+
+async def list_sizes(servers, options):
+    """
+    Pide el listado de archivos y el tamaño de cada uno, todos a la vez.
+    """
+    async with ConnectionPool(
+        servers, options.connections, options.concurrency, options.timeout
+    ) as pool:
+        names = await pool.get_file_listing()
+        results = await asyncio.gather(
+            *(pool.get_metadata(name) for name in names), return_exceptions=True
+        )
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            print("%s\terror: %s" % (name, result))
+        else:
+            print("%s\t%d" % (name, result))
+
+
+def main():
+    """
+    Muestra el tamaño de cada archivo de los servers, pidiéndolos todos a
+    la vez.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] server[:port]...")
+    parser.add_option(
+        "-p",
+        "--port",
+        type="int",
+        help="Puerto de los servers que no lo indican",
+        default=DEFAULT_PORT,
+    )
+    parser.add_option(
+        "-c",
+        "--connections",
+        type="int",
+        help="Conexiones por server",
+        default=POOL_CONNECTIONS,
+    )
+    parser.add_option(
+        "-n",
+        "--concurrency",
+        type="int",
+        help="Pedidos en curso a la vez",
+        default=POOL_CONCURRENCY,
+    )
+    parser.add_option(
+        "-t",
+        "--timeout",
+        type="float",
+        help="Plazo de cada pedido, en segundos",
+        default=REQUEST_TIMEOUT,
+    )
+    options, args = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+    servers = []
+    for arg in args:
+        server, _, port = arg.partition(":")
+        try:
+            servers.append((server, int(port) if port else options.port))
+        except ValueError:
+            sys.stderr.write("Numero de puerto invalido: %s\n" % repr(port))
+            sys.exit(1)
+    asyncio.run(list_sizes(servers, options))
+
+
+if __name__ == "__main__":
+    main()
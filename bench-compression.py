@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Compara get_slice sin compresión y con las compresiones que se negocian
+con set_compression, sobre archivos de distinto tipo: texto, bytes al
+azar, una mezcla de ambos y un archivo ya comprimido. Para cada caso
+muestra el tiempo de la descarga y los bytes que pasaron por la red.
+
+Necesita un servidor corriendo que sirva el directorio indicado con -d,
+donde se crean (y luego se borran) los archivos de prueba.
+"""
+
+import client
+import constants
+import gzip
+import optparse
+import os
+import time
+
+
+class CountingSocket(object):
+    """
+    Envuelve el socket del cliente y cuenta los bytes recibidos.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+
+    def recv_into(self, buffer, size=0):
+        received = self.sock.recv_into(buffer, size)
+        self.received += received
+        return received
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Sink(object):
+    """
+    Descarta lo que se escribe, como un archivo de salida que no cuesta.
+    """
+
+    def write(self, data):
+        return len(data)
+
+
+def corpora(size: int):
+    """
+    Devuelve los pares (nombre del archivo, contenido) de los casos.
+    """
+    text = b"".join(
+        b"2023-05-%02d 12:%02d:%02d INFO pedido %d atendido en %d ms\n"
+        % (i % 28 + 1, i % 60, i * 7 % 60, i, i * 13 % 1000)
+        for i in range(size // 40)
+    )[:size]
+    noise = os.urandom(size)
+    piece = 2**16
+    mixed = b"".join(
+        (text if i % 2 == 0 else noise)[i * piece : (i + 1) * piece]
+        for i in range(size // piece + 1)
+    )
+    return [
+        ("bench_texto.log", text),
+        ("bench_aleatorio.bin", noise),
+        ("bench_mixto.bin", mixed),
+        ("bench_comprimido.gz", gzip.compress(text)),
+    ]
+
+
+def measure(c, counter, name: str, size: int):
+    """
+    Baja el archivo entero y devuelve los segundos que tardó y los bytes
+    que se recibieron por la red.
+    """
+    before = counter.received
+    start = time.perf_counter()
+    assert c.fetch_range(name, 0, size, Sink())
+    return time.perf_counter() - start, counter.received - before
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "-a", "--address", help="Dirección del servidor", default="127.0.0.1"
+    )
+    parser.add_option(
+        "-p",
+        "--port",
+        type="int",
+        help="Puerto del servidor",
+        default=constants.DEFAULT_PORT,
+    )
+    parser.add_option(
+        "-d",
+        "--datadir",
+        help="Directorio que sirve el servidor",
+        default=constants.DEFAULT_DIR,
+    )
+    parser.add_option(
+        "-s",
+        "--size",
+        type="int",
+        help="Tamaño de cada archivo, en bytes",
+        default=2**23,
+    )
+    parser.add_option(
+        "-m",
+        "--methods",
+        help="Compresiones a medir, separadas por comas",
+        default="none,zlib,lzma",
+    )
+    options, args = parser.parse_args()
+
+    cases = corpora(options.size)
+    for name, data in cases:
+        with open(os.path.join(options.datadir, name), "wb") as f:
+            f.write(data)
+
+    try:
+        c = client.Client(options.address, options.port)
+        counter = CountingSocket(c.s)
+        c.s = counter
+        print("archivo               método  tiempo (s)  en la red (MiB)  relación")
+        for name, data in cases:
+            for method in options.methods.split(","):
+                assert c.set_compression(method)
+                elapsed, wire = measure(c, counter, name, len(data))
+                print(
+                    "%-21s %6s  %10.3f  %15.2f  %8.2f"
+                    % (name, method, elapsed, wire / 2**20, wire / len(data))
+                )
+        c.close()
+    finally:
+        for name, data in cases:
+            os.remove(os.path.join(options.datadir, name))
+
+
+if __name__ == "__main__":
+    main()
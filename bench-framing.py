@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Compara el buffer de recepción anterior (un str al que se le concatena
+cada recv y se le busca el terminador desde el principio) con LineBuffer,
+que recibe con recv_into y solo busca en los bytes nuevos.
+
+No necesita un servidor: los datos salen de un socket falso en memoria,
+de a RECV_SIZE bytes por llamada, como llegarían por la red.
+"""
+
+import constants
+import optparse
+import time
+from framing import LineBuffer
+
+
+class FakeSocket(object):
+    """
+    Entrega `payload` de a `chunk` bytes por llamada.
+    """
+
+    def __init__(self, payload: bytes, chunk: int):
+        self.payload = memoryview(payload)
+        self.chunk = chunk
+        self.position = 0
+
+    def recv(self, size):
+        size = min(size, self.chunk)
+        data = bytes(self.payload[self.position : self.position + size])
+        self.position += len(data)
+        return data
+
+    def recv_into(self, buffer, size=0):
+        size = min(size or len(buffer), self.chunk, len(self.payload) - self.position)
+        buffer[:size] = self.payload[self.position : self.position + size]
+        self.position += size
+        return size
+
+
+def str_lines(sock):
+    """
+    Separa las líneas como lo hacía Connection antes de LineBuffer.
+    """
+    buffer = ""
+    lines = 0
+    while True:
+        while not constants.EOL in buffer:
+            data = sock.recv(constants.RECV_SIZE).decode("ascii")
+            if not data:
+                return lines
+            buffer += data
+        line, buffer = buffer.split(constants.EOL, 1)
+        lines += 1
+
+
+def linebuffer_lines(sock):
+    """
+    Separa las líneas con LineBuffer.
+    """
+    buffer = LineBuffer()
+    lines = 0
+    while buffer.recv_into(sock) > 0:
+        for line in buffer.read_lines():
+            line = line.decode("ascii")
+            lines += 1
+    return lines
+
+
+def measure(function, payload, chunk):
+    """
+    Devuelve las líneas encontradas y los segundos que tardó `function`.
+    """
+    start = time.perf_counter()
+    lines = function(FakeSocket(payload, chunk))
+    return lines, time.perf_counter() - start
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "-n",
+        "--commands",
+        type="int",
+        help="Cantidad de comandos cortos en pipeline",
+        default=200000,
+    )
+    parser.add_option(
+        "-l",
+        "--line-size",
+        type="int",
+        help="Tamaño de la línea larga, en bytes",
+        default=2**22,
+    )
+    parser.add_option(
+        "-c",
+        "--chunk",
+        type="int",
+        help="Bytes que entrega cada recv",
+        default=constants.RECV_SIZE,
+    )
+    options, args = parser.parse_args()
+
+    cases = [
+        (
+            "comandos en pipeline",
+            b"".join(
+                b"get_metadata archivo%06d\r\n" % i for i in range(options.commands)
+            ),
+        ),
+        ("una línea larga", b"x" * options.line_size + constants.EOL_BYTES),
+    ]
+    print("caso                    str (s)  LineBuffer (s)  aceleración")
+    for name, payload in cases:
+        old_lines, old = measure(str_lines, payload, options.chunk)
+        new_lines, new = measure(linebuffer_lines, payload, options.chunk)
+        assert old_lines == new_lines
+        print("%-22s %8.3f  %14.3f  %10.2fx" % (name, old, new, old / new))
+
+
+if __name__ == "__main__":
+    main()
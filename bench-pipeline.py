@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Mide cuánto se amortiza el tiempo de ida y vuelta al hacer pedidos en
+pipeline (Client.pipeline) frente a hacerlos de a uno.
+
+Necesita un servidor corriendo que sirva el directorio indicado con -d,
+donde se crean (y luego se borran) los archivos de prueba.
+"""
+
+import client
+import constants
+import optparse
+import os
+import time
+
+
+def run(c, requests, window):
+    """
+    Hace los pedidos con la ventana dada y devuelve los segundos que tardó.
+    """
+    start = time.perf_counter()
+    results = c.pipeline(requests, window)
+    elapsed = time.perf_counter() - start
+    assert all(status == constants.CODE_OK for status, _ in results)
+    return elapsed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "-a", "--address", help="Dirección del servidor", default="127.0.0.1"
+    )
+    parser.add_option(
+        "-p",
+        "--port",
+        type="int",
+        help="Puerto del servidor",
+        default=constants.DEFAULT_PORT,
+    )
+    parser.add_option(
+        "-d",
+        "--datadir",
+        help="Directorio que sirve el servidor",
+        default=constants.DEFAULT_DIR,
+    )
+    parser.add_option(
+        "-n", "--files", type="int", help="Cantidad de archivos", default=500
+    )
+    parser.add_option(
+        "-s", "--size", type="int", help="Tamaño de cada archivo", default=100
+    )
+    parser.add_option(
+        "-w",
+        "--windows",
+        help="Ventanas a medir, separadas por comas",
+        default="1,4,16,64",
+    )
+    options, args = parser.parse_args()
+
+    names = ["bench_pipeline%05d" % i for i in range(options.files)]
+    for name in names:
+        with open(os.path.join(options.datadir, name), "wb") as f:
+            f.write(b"x" * options.size)
+    requests = []
+    for name in names:
+        requests.append(("get_metadata", name))
+        requests.append(("get_slice", name, 0, options.size))
+
+    try:
+        c = client.Client(options.address, options.port)
+        base = None
+        print("ventana  pedidos/s  aceleración")
+        for window in map(int, options.windows.split(",")):
+            elapsed = run(c, requests, window)
+            base = base or elapsed
+            print(
+                "%7d  %9.0f  %10.2fx"
+                % (window, len(requests) / elapsed, base / elapsed)
+            )
+        c.close()
+    finally:
+        for name in names:
+            os.remove(os.path.join(options.datadir, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Prueba de carga del servidor: lanza server.py en un proceso aparte, en
+cada modo pedido, y lo carga con clientes concurrentes que hacen una
+mezcla de get_file_listing, get_metadata y get_slice de varios tamaños.
+
+Para cada modo y cantidad de clientes muestra pedidos y MiB por segundo,
+latencias p50 y p99, CPU y memoria máxima (RSS) del servidor. Con -o se
+guarda además el resultado en JSON, para comparar corridas y modos y
+detectar regresiones.
+
+Los clientes son hilos, repartidos en los procesos que se piden con -j:
+si la CPU de un proceso generador ("CPU cli" sobre -j) se acerca al 100%,
+el cuello de botella es el generador y no el servidor.
+"""
+
+import client
+import concurrent.futures
+import constants
+import json
+import optparse
+import os
+import random
+import resource
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Operaciones de la mezcla
+OPERATIONS = ("listing", "metadata", "slice")
+
+
+class Sink(object):
+    """
+    Descarta lo que se escribe, como un archivo de salida que no cuesta.
+    """
+
+    def write(self, data):
+        return len(data)
+
+
+class Worker(object):
+    """
+    Un cliente de la carga: hace pedidos al azar según la mezcla hasta
+    `deadline` y anota la latencia de cada uno.
+    """
+
+    def __init__(self, port: int, files, weights, seed: int, deadline: float):
+        self.port = port
+        self.files = files  # Pares (nombre, tamaño)
+        self.weights = weights
+        self.random = random.Random(seed)
+        self.deadline = deadline
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.received = 0
+        self.errors = 0
+
+    def request(self, c, op: str):
+        """
+        Hace un pedido de la operación `op`. Devuelve True si salió bien.
+        """
+        name, size = self.random.choice(self.files)
+        if op == "listing":
+            c.file_lookup()
+        elif op == "metadata":
+            return c.get_metadata(name) == size
+        else:
+            if not c.fetch_range(name, 0, size, Sink()):
+                return False
+            self.received += size
+        return c.status == constants.CODE_OK
+
+    def run(self):
+        c = None
+        while time.monotonic() < self.deadline:
+            op = self.random.choices(OPERATIONS, self.weights)[0]
+            try:
+                if c is None:
+                    c = client.Client("127.0.0.1", self.port)
+                start = time.perf_counter()
+                ok = self.request(c, op)
+                elapsed = time.perf_counter() - start
+            except OSError:
+                c = None
+                self.errors += 1
+                continue
+            if ok:
+                self.latencies[op].append(elapsed)
+            else:
+                self.errors += 1
+                c.s.close()
+                c = None  # Se reconecta, por si el error fue fatal
+        if c is not None:
+            c.s.close()
+
+
+def load(port: int, files, weights, seeds, deadline: float):
+    """
+    Corre un Worker por semilla, cada uno en su hilo, hasta `deadline`.
+
+    Devuelve las latencias por operación, los bytes recibidos, los
+    errores y los segundos de CPU que usó el proceso.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    workers = [Worker(port, files, weights, seed, deadline) for seed in seeds]
+    threads = [threading.Thread(target=w.run) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    latencies = {op: [] for op in OPERATIONS}
+    for w in workers:
+        for op in OPERATIONS:
+            latencies[op] += w.latencies[op]
+    return {
+        "latencies": latencies,
+        "received": sum(w.received for w in workers),
+        "errors": sum(w.errors for w in workers),
+        "cpu": (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+    }
+
+
+def percentile(values, q: float):
+    """
+    Devuelve el percentil `q` (entre 0 y 1) de los valores ya ordenados.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(latencies):
+    """
+    Resume una lista de latencias en segundos: cantidad, media, p50 y p99
+    en milisegundos.
+    """
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"count": 0, "mean_ms": None, "p50_ms": None, "p99_ms": None}
+    return {
+        "count": len(latencies),
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * percentile(latencies, 0.50),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+    }
+
+
+def start_server(mode: str, port: int, datadir: str, extra):
+    """
+    Lanza server.py en el modo dado y espera a que acepte conexiones.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(here, "server.py")]
+        + ["-m", mode, "-p", str(port), "-d", datadir, "--log-sample", "0"]
+        + extra,
+        stdout=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError("El servidor no arrancó")
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("El servidor no acepta conexiones")
+
+
+def stop_server(proc):
+    """
+    Detiene el servidor y devuelve su uso de recursos (rusage), que
+    incluye el arranque.
+    """
+    proc.send_signal(signal.SIGTERM)
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        return None
+    proc.returncode = status
+    return usage
+
+
+def run(mode: str, nclients: int, options, files, weights, extra):
+    """
+    Hace una corrida de carga y devuelve su resumen.
+    """
+    proc = start_server(mode, options.port, options.datadir, extra)
+    seeds = [options.seed + i for i in range(nclients)]
+    processes = max(1, min(options.processes, nclients))
+    try:
+        start = time.monotonic()
+        deadline = start + options.duration
+        if processes == 1:
+            parts = [load(options.port, files, weights, seeds, deadline)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                futures = [
+                    pool.submit(
+                        load,
+                        options.port,
+                        files,
+                        weights,
+                        seeds[i::processes],
+                        deadline,
+                    )
+                    for i in range(processes)
+                ]
+                parts = [future.result() for future in futures]
+        elapsed = time.monotonic() - start
+    finally:
+        usage = stop_server(proc)
+
+    latencies = {op: [] for op in OPERATIONS}
+    for part in parts:
+        for op in OPERATIONS:
+            latencies[op] += part["latencies"][op]
+    every = [latency for op in OPERATIONS for latency in latencies[op]]
+    received = sum(part["received"] for part in parts)
+    result = {
+        "mode": mode,
+        "clients": nclients,
+        "processes": processes,
+        "seconds": elapsed,
+        "requests": len(every),
+        "errors": sum(part["errors"] for part in parts),
+        "requests_per_second": len(every) / elapsed,
+        "mib_per_second": received / elapsed / 2**20,
+        "latency": summarize(every),
+        "latency_by_operation": {op: summarize(latencies[op]) for op in OPERATIONS},
+        "client_cpu_percent": 100 * sum(part["cpu"] for part in parts) / elapsed,
+    }
+    if usage is not None:
+        cpu = usage.ru_utime + usage.ru_stime
+        result["server_cpu_seconds"] = cpu
+        result["server_cpu_percent"] = 100 * cpu / elapsed
+        # En Linux ru_maxrss está en KiB
+        result["server_max_rss_mib"] = usage.ru_maxrss / 2**10
+    return result
+
+
+def parse_mix(text: str):
+    """
+    Convierte "listing=1,metadata=4,slice=5" en los pesos de OPERATIONS.
+    """
+    weights = dict.fromkeys(OPERATIONS, 0)
+    for part in text.split(","):
+        op, weight = part.split("=")
+        if op not in weights:
+            raise ValueError(f"Operación desconocida: {op}")
+        weights[op] = float(weight)
+    return [weights[op] for op in OPERATIONS]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "-p",
+        "--port",
+        type="int",
+        help="Puerto donde lanzar el servidor",
+        default=constants.DEFAULT_PORT + 10,
+    )
+    parser.add_option(
+        "-d",
+        "--datadir",
+        help="Directorio que sirve el servidor (por defecto, uno temporal)",
+        default=None,
+    )
+    parser.add_option(
+        "-m",
+        "--modes",
+        help="Modos del servidor a medir, separados por comas",
+        default="threads,events",
+    )
+    parser.add_option(
+        "-c",
+        "--clients",
+        help="Cantidades de clientes concurrentes, separadas por comas",
+        default="1,8,32",
+    )
+    parser.add_option(
+        "-j",
+        "--processes",
+        type="int",
+        help="Procesos entre los que se reparten los clientes",
+        default=1,
+    )
+    parser.add_option(
+        "-t",
+        "--duration",
+        type="float",
+        help="Segundos de carga por corrida",
+        default=5,
+    )
+    parser.add_option(
+        "--mix",
+        help="Pesos de cada operación en la mezcla",
+        default="listing=1,metadata=4,slice=5",
+    )
+    parser.add_option(
+        "-s",
+        "--sizes",
+        help="Tamaños de los archivos que se piden con get_slice, separados "
+        "por comas",
+        default="1024,65536,1048576",
+    )
+    parser.add_option(
+        "--server-args",
+        help='Opciones extra para server.py, p.ej. "--mmap -c 0"',
+        default="",
+    )
+    parser.add_option("--seed", type="int", help="Semilla de la mezcla", default=2023)
+    parser.add_option(
+        "-o",
+        "--json",
+        help="Archivo donde guardar el resultado en JSON (- para la salida "
+        "estándar)",
+        default=None,
+    )
+    options, args = parser.parse_args()
+    try:
+        weights = parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(f"--mix inválido: {e}")
+
+    temporary = options.datadir is None
+    if temporary:
+        options.datadir = tempfile.mkdtemp(prefix="bench-server-")
+    files = []
+    for size in map(int, options.sizes.split(",")):
+        name = "bench_server%d" % size
+        with open(os.path.join(options.datadir, name), "wb") as f:
+            f.write(os.urandom(size))
+        files.append((name, size))
+
+    # Con el JSON en la salida estándar, la tabla va a la de errores
+    table = sys.stderr if options.json == "-" else sys.stdout
+    results = []
+    try:
+        print(
+            "modo     clientes  pedidos/s    MiB/s  p50 (ms)  p99 (ms)  "
+            "CPU srv  CPU cli  RSS (MiB)  errores",
+            file=table,
+        )
+        for mode in options.modes.split(","):
+            for nclients in map(int, options.clients.split(",")):
+                r = run(
+                    mode,
+                    nclients,
+                    options,
+                    files,
+                    weights,
+                    shlex.split(options.server_args),
+                )
+                results.append(r)
+                print(
+                    "%-8s %8d  %9.0f  %7.1f  %8.2f  %8.2f  %6.0f%%  %6.0f%%  "
+                    "%9.1f  %7d"
+                    % (
+                        r["mode"],
+                        r["clients"],
+                        r["requests_per_second"],
+                        r["mib_per_second"],
+                        r["latency"]["p50_ms"] or 0,
+                        r["latency"]["p99_ms"] or 0,
+                        r.get("server_cpu_percent", 0),
+                        r["client_cpu_percent"],
+                        r.get("server_max_rss_mib", 0),
+                        r["errors"],
+                    ),
+                    file=table,
+                )
+    finally:
+        if temporary:
+            shutil.rmtree(options.datadir)
+        else:
+            for name, size in files:
+                os.remove(os.path.join(options.datadir, name))
+
+    report = {
+        "config": {
+            "duration": options.duration,
+            "mix": dict(zip(OPERATIONS, weights)),
+            "sizes": [size for name, size in files],
+            "processes": options.processes,
+            "server_args": options.server_args,
+            "seed": options.seed,
+        },
+        "runs": results,
+    }
+    if options.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif options.json is not None:
+        with open(options.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# encoding: utf-8
+
+import threading
+from base64 import b64encode
+from collections import OrderedDict
+from constants import *
+
+
+class BlockCache(object):
+    """
+    Cache LRU de bloques de archivos, compartido por todas las conexiones,
+    con un límite en bytes. Las claves identifican la versión del archivo
+    (inodo, tamaño y mtime), así un archivo modificado nunca devuelve
+    bloques viejos, aunque el mtime del sistema de archivos sea grueso.
+
+    Con capacidad 0 no guarda nada.
+    """
+
+    def __init__(self, capacity=BLOCK_CACHE_SIZE):
+        """
+        Args:
+            capacity (int): Máximo de bytes guardados entre todos los bloques.
+        """
+        self.capacity = capacity
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Devuelve el bloque guardado con la clave `key`, o None.
+        """
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return data
+
+    def put(self, key, data: bytes):
+        """
+        Guarda el bloque, descartando los usados hace más tiempo hasta que
+        entre en la capacidad.
+        """
+        if self.capacity == 0 or len(data) > self.capacity:
+            return
+        with self.lock:
+            old = self.blocks.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.blocks[key] = data
+            self.size += len(data)
+            while self.size > self.capacity:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Devuelve los contadores del cache.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "blocks": len(self.blocks),
+                "bytes": self.size,
+                "capacity": self.capacity,
+            }
+
+
+class BlockReader(object):
+    """
+    Lee los bloques alineados de `block_size` bytes de una versión de un
+    archivo, pasando por el BlockCache. El archivo se abre recién cuando
+    hace falta leer un bloque que no está en el cache.
+
+    Si el archivo está mapeado en memoria, los bloques son slices del
+    mapeo, sin copias, y solo se guardan en el cache sus codificaciones.
+    """
+
+    def __init__(
+        self, filepath: str, info, block_size: int, cache: BlockCache, mapped=None
+    ):
+        """
+        Args:
+            filepath (str): Ruta del archivo.
+            info: FileInfo del archivo, identifica su versión.
+            block_size (int): Tamaño de los bloques, múltiplo de 3.
+            cache (BlockCache): Cache compartido de bloques.
+            mapped: MappedFile del archivo, o None para leerlo con read.
+        """
+        self.filepath = filepath
+        self.key = (info.inode, info.size, info.mtime, block_size)
+        self.block_size = block_size
+        self.cache = cache
+        self.mapped = mapped
+        self.f = None
+
+    def block(self, index: int):
+        """
+        Devuelve el contenido del bloque número `index`.
+        """
+        if self.mapped is not None:
+            start = index * self.block_size
+            return self.mapped.view[start : start + self.block_size]
+        key = self.key + (index,)
+        data = self.cache.get(key)
+        if data is None:
+            if self.f is None:
+                # Abrir el archivo en modo lectura binario "rb"
+                self.f = open(self.filepath, "rb")
+            self.f.seek(index * self.block_size)
+            data = self.f.read(self.block_size)
+            self.cache.put(key, data)
+        return data
+
+    def encoded(self, index: int):
+        """
+        Devuelve el bloque número `index` codificado en base64, guardando
+        también la codificación en el cache.
+        """
+        key = self.key + (index, "b64")
+        data = self.cache.get(key)
+        if data is None:
+            data = b64encode(self.block(index))
+            self.cache.put(key, data)
+        return data
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
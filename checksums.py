@@ -0,0 +1,236 @@
+# encoding: utf-8
+
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from constants import *
+
+
+def file_digest(f, offset: int, size: int):
+    """
+    Calcula el checksum de `size` bytes del archivo abierto `f` a partir
+    de `offset`, leyendo de a CHECKSUM_READ_SIZE bytes sobre un único
+    buffer. Lo usan tanto el server como el cliente.
+
+    Devuelve el digest BLAKE2b en hexadecimal.
+
+    Raises:
+        OSError: Si el archivo tiene menos bytes que los pedidos.
+    """
+    digest = hashlib.blake2b(digest_size=CHECKSUM_DIGEST_SIZE)
+    block = memoryview(bytearray(min(CHECKSUM_READ_SIZE, size) or 1))
+    f.seek(offset)
+    while size > 0:
+        read = f.readinto(block[: min(len(block), size)])
+        if read == 0:
+            raise OSError("el archivo se achicó mientras se lo leía")
+        digest.update(block[:read])
+        size -= read
+    return digest.hexdigest()
+
+
+def block_signature(data):
+    """
+    Devuelve la firma de un bloque, como par (débil, fuerte): el adler32,
+    que se puede actualizar byte a byte al correr una ventana por un
+    archivo, y un BLAKE2b corto en hexadecimal para confirmar.
+    """
+    strong = hashlib.blake2b(data, digest_size=SIGNATURE_DIGEST_SIZE)
+    return zlib.adler32(data), strong.hexdigest()
+
+
+def file_signatures(f, block_size: int):
+    """
+    Devuelve la lista de firmas de los bloques de `block_size` bytes del
+    archivo abierto `f`. El último bloque puede ser más corto.
+    """
+    signatures = []
+    f.seek(0)
+    block = f.read(block_size)
+    while block:
+        signatures.append(block_signature(block))
+        block = f.read(block_size)
+    return signatures
+
+
+def match_blocks(data, signatures, block_size: int, size: int):
+    """
+    Busca en `data` (el contenido de la copia local, p.ej. mapeado en
+    memoria) los bloques de un archivo de `size` bytes cuyas firmas son
+    `signatures`, en cualquier posición, como rsync: la suma débil se
+    actualiza byte a byte al correr la ventana y solo cuando coincide se
+    calcula la fuerte. Luego de encontrar un bloque se salta al siguiente.
+
+    Devuelve un diccionario número de bloque -> posición en `data`.
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signatures[: size // block_size]):
+        table.setdefault(weak, []).append(index)
+    found = {}
+    length = len(data)
+    position = 0
+    weak = None
+    while table and position + block_size <= length:
+        if weak is None:
+            weak = zlib.adler32(data[position : position + block_size])
+            a, b = weak & 0xFFFF, weak >> 16
+        candidates = table.get(weak)
+        if candidates:
+            strong = block_signature(data[position : position + block_size])[1]
+            matched = False
+            for index in candidates:
+                if index not in found and signatures[index][1] == strong:
+                    found[index] = position
+                    matched = True
+            if matched:
+                position += block_size
+                weak = None
+                continue
+        if position + block_size == length:
+            break
+        # Se corre la ventana un byte: sale data[position], entra el siguiente
+        out, new = data[position], data[position + block_size]
+        a = (a - out + new) % ADLER_MOD
+        b = (b + a - 1 - block_size * out) % ADLER_MOD
+        weak = (b << 16) | a
+        position += 1
+    last = len(signatures) - 1
+    tail = size - last * block_size
+    if signatures and tail < block_size:
+        # El último bloque es más corto: se lo busca en la misma posición
+        # y al final de la copia local
+        for position in {last * block_size, length - tail}:
+            if 0 <= position and position + tail <= length:
+                block = data[position : position + tail]
+                if block_signature(block) == signatures[last]:
+                    found[last] = position
+                    break
+    return found
+
+
+class ChecksumCache(object):
+    """
+    Checksums de archivos y rangos, y firmas de bloques para delta sync,
+    compartidos por todas las conexiones.
+    Se guardan los últimos `capacity` calculados, con claves que
+    identifican la versión del archivo (inodo, tamaño y mtime), así un
+    archivo modificado nunca devuelve un checksum viejo.
+
+    Los rangos de al menos `offload_size` bytes se calculan en un pool de
+    hilos, para no frenar al hilo que atiende los pedidos (en el modo
+    eventos, a todas las conexiones). Si varias conexiones piden a la vez
+    el mismo checksum, se calcula una sola vez.
+    """
+
+    def __init__(
+        self,
+        capacity=CHECKSUM_CACHE_ENTRIES,
+        workers=CHECKSUM_WORKERS,
+        offload_size=CHECKSUM_OFFLOAD_SIZE,
+    ):
+        """
+        Args:
+            capacity (int): Máximo de checksums guardados.
+            workers (int): Hilos que calculan los checksums grandes.
+            offload_size (int): Bytes a partir de los cuales el checksum
+                se calcula en otro hilo.
+        """
+        self.capacity = capacity
+        self.offload_size = offload_size
+        self.digests = OrderedDict()  # clave -> digest o lista de firmas
+        self.running = {}  # clave -> Future del cálculo en curso
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="checksum")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, filepath: str, info, offset: int, size: int):
+        """
+        Pide el checksum de `size` bytes a partir de `offset` de la versión
+        `info` del archivo.
+
+        Devuelve un Future con el digest en hexadecimal, que ya está
+        completo si estaba en el cache o si el rango es chico. Si el archivo
+        no se puede leer, el Future tiene la excepción OSError.
+        """
+        key = (info.inode, info.size, info.mtime, "digest", offset, size)
+        return self.request(filepath, key, size, file_digest, offset, size)
+
+    def signatures(self, filepath: str, info, block_size: int):
+        """
+        Pide las firmas de los bloques de `block_size` bytes de la versión
+        `info` del archivo, como digest().
+
+        Devuelve un Future con la lista de firmas (débil, fuerte).
+        """
+        key = (info.inode, info.size, info.mtime, "signatures", block_size)
+        return self.request(filepath, key, info.size, file_signatures, block_size)
+
+    def request(self, filepath: str, key, size: int, function, *args):
+        """
+        Devuelve un Future con el resultado de `function(f, *args)` sobre
+        el archivo abierto, guardado con la clave `key`. Se calcula en otro
+        hilo si lee al menos `offload_size` bytes.
+        """
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest is not None:
+                self.hits += 1
+                self.digests.move_to_end(key)
+                future = Future()
+                future.set_result(digest)
+                return future
+            future = self.running.get(key)
+            if future is not None:
+                self.hits += 1
+                return future
+            self.misses += 1
+            if size >= self.offload_size:
+                future = self.executor.submit(
+                    self.compute, filepath, key, function, *args
+                )
+                self.running[key] = future
+                return future
+        future = Future()
+        try:
+            future.set_result(self.compute(filepath, key, function, *args))
+        except OSError as e:
+            future.set_exception(e)
+        return future
+
+    def compute(self, filepath: str, key, function, *args):
+        """
+        Calcula el resultado de la clave `key` y lo guarda en el cache, si
+        el archivo no cambió mientras se lo leía.
+        """
+        try:
+            with open(filepath, "rb") as f:
+                digest = function(f, *args)
+                st = os.fstat(f.fileno())
+            with self.lock:
+                if (st.st_ino, st.st_size, st.st_mtime_ns) == key[:3]:
+                    self.digests[key] = digest
+                    while len(self.digests) > self.capacity:
+                        self.digests.popitem(last=False)
+                        self.evictions += 1
+            return digest
+        finally:
+            with self.lock:
+                self.running.pop(key, None)
+
+    def stats(self):
+        """
+        Devuelve los contadores del cache.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "digests": len(self.digests),
+                "running": len(self.running),
+            }
@@ -6,13 +6,24 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: client.py 387 2011-03-22 13:48:44Z nicolasw $
 
+import io
+import lzma
+import mmap
+import os
 import socket
 import logging
 import optparse
 import sys
+import threading
 import time
+import zlib
+from collections import deque
 from base64 import b64decode
 from constants import *
+from framing import LineBuffer
+from checksums import file_digest, match_blocks
+from compression import COMPRESSION_METHODS, decompressor
+from journal import RangeJournal
 
 
 class Client(object):
@@ -26,8 +37,14 @@ class Client(object):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.status = None
         self.s.connect((server, port))
-        self.buffer = ""
+        # Se guardan para poder abrir más conexiones al mismo server
+        self.server = server
+        self.port = port
+        # Bytes recibidos y no procesados; pueden no ser texto (get_slice_raw)
+        self.buffer = LineBuffer()
         self.connected = True
+        # Compresión de los get_slice, negociada con set_compression
+        self.compression = "none"
 
     def close(self):
         """
@@ -60,17 +77,16 @@ class Client(object):
             assert bytes_sent > 0
             message = message[bytes_sent:]
 
-    def _recv(self, timeout=None):
+    def _recv(self, timeout=None, size=RECV_SIZE):
         """
-        Recibe datos y acumula en el buffer interno.
+        Recibe hasta `size` bytes y los acumula en el buffer interno.
 
         Para uso privado del cliente.
         """
         self.s.settimeout(timeout)
-        data = self.s.recv(4096).decode("ascii")
-        self.buffer += data
+        received = self.buffer.recv_into(self.s, size)
 
-        if len(data) == 0:
+        if received == 0:
             logging.info("El server interrumpió la conexión.")
             self.connected = False
 
@@ -81,18 +97,21 @@ class Client(object):
 
         Devuelve la línea, eliminando el terminaodr y los espacios en blanco
         al principio y al final.
+
+        Con `timeout`, si la línea no se completa en ese tiempo (de reloj,
+        no de CPU) aborta con una excepción socket.timeout.
         """
-        while not EOL in self.buffer and self.connected:
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while not self.buffer.has_line() and self.connected:
             if timeout is not None:
-                t1 = time.process_time()
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise socket.timeout("timed out")
             self._recv(timeout)
-            if timeout is not None:
-                t2 = time.process_time()
-                timeout -= t2 - t1
-                t1 = t2
-        if EOL in self.buffer:
-            response, self.buffer = self.buffer.split(EOL, 1)
-            return response.strip()
+        response = self.buffer.read_line()
+        if response is not None:
+            return response.decode("ascii").strip()
         else:
             self.connected = False
             return ""
@@ -122,22 +141,94 @@ class Client(object):
 
         Devuelve el contenido del fragmento.
         """
-        # Ahora, esperamos hasta tener la cantidad de datos necesaria
-        data = self.read_line()
-        fragment = b64decode(data)
-        while len(fragment) < length:
-            data = self.read_line()
-            fragment += b64decode(data)
+        fragment = io.BytesIO()
+        self.read_fragment_into(fragment, length)
+        return fragment.getvalue()
+
+    def read_fragment_into(self, output, length, block_size=SLICE_BLOCK_SIZE):
+        """
+        Espera un fragmento de un archivo codificado en base64 y lo
+        escribe en el archivo `output` a medida que llega, decodificando
+        de a bloques. Así la memoria usada depende de `block_size` y no
+        del tamaño del fragmento.
+
+        Si la sesión tiene compresión, antes del fragmento llega una línea
+        con el método con el que se comprimió, y se descomprime también a
+        medida que llega.
+
+        Devuelve la cantidad de bytes escritos.
+        """
+        decomp = None
+        if self.compression != "none":
+            method = self.read_line()
+            if method != "none":
+                decomp = decompressor(method)
+        written = 0
+        pending = b""  # Caracteres base64 que todavía no se decodificaron
+        while True:
+            data, last = self.buffer.read_chunk()
+            data = pending + data.strip()
+            # Se decodifica de a grupos de 4 caracteres base64 (3 bytes)
+            cut = len(data) if last else len(data) - len(data) % 4
+            if cut > 0:
+                decoded = b64decode(data[:cut])
+                if decomp is not None:
+                    decoded = decomp.decompress(decoded)
+                written += output.write(decoded)
+            pending = data[cut:]
+            if last or not self.connected:
+                break
+            self._recv(size=block_size)
+
+        if written != length:
+            logging.warning(
+                "Se esperaban %d bytes del fragmento y llegaron %d." % (length, written)
+            )
+        return written
 
-        return fragment
+    def read_raw_into(self, output, length, block_size=SLICE_BLOCK_SIZE):
+        """
+        Lee exactamente `length` bytes sin codificar, seguidos del fin de
+        línea, y los escribe en el archivo `output`. Se recibe con
+        recv_into sobre un único buffer de `block_size` bytes, que se
+        reutiliza para todo el fragmento.
 
-    def file_lookup(self):
+        Devuelve la cantidad de bytes escritos.
+        """
+        # Primero lo que ya se recibió junto con el encabezado
+        written = output.write(self.buffer.take(length))
+        block = memoryview(bytearray(min(block_size, length - written) or 1))
+        self.s.settimeout(None)
+        while written < length:
+            received = self.s.recv_into(block, min(len(block), length - written))
+            if received == 0:
+                logging.info("El server interrumpió la conexión.")
+                self.connected = False
+                break
+            written += output.write(block[:received])
+        # Luego de los datos, el server envía el fin de línea
+        if self.connected and self.read_line() != "":
+            logging.warning("Se esperaba el fin de línea luego del fragmento.")
+        return written
+
+    def file_lookup(self, offset=None, count=None):
         """
         Obtener el listado de archivos en el server. Devuelve una lista
         de strings.
+
+        Si se dan `offset` o `count`, pide solo esa página del listado: sin
+        `offset` empieza desde el principio y sin `count` trae
+        LISTING_PAGE_SIZE nombres.
         """
         result = []
-        self.send("get_file_listing")
+        if offset is None and count is None:
+            self.send("get_file_listing")
+        else:
+            if offset is None:
+                offset = 0
+            if count is None:
+                count = LISTING_PAGE_SIZE
+            self.send("get_file_listing %d %d" % (offset, count))
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
             filename = self.read_line()
@@ -153,6 +244,42 @@ class Client(object):
 
         return result
 
+    def stats(self):
+        """
+        Obtiene las métricas del server, en el formato de texto de
+        Prometheus. Devuelve un diccionario serie -> valor, sin los
+        comentarios.
+        """
+        result = {}
+        self.send("stats")
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            line = self.read_line()
+            while line:
+                if not line.startswith("#"):
+                    name, value = line.rsplit(" ", 1)
+                    result[name] = float(value)
+                line = self.read_line()
+        else:
+            logging.warning("El servidor no envió las métricas.")
+        return result
+
+    def file_lookup_pages(self, page_size=LISTING_PAGE_SIZE):
+        """
+        Recorre el listado de archivos del server de a páginas de
+        `page_size` nombres, para directorios muy grandes. Genera los
+        nombres a medida que llegan las páginas.
+        """
+        offset = 0
+        while True:
+            page = self.file_lookup(offset, page_size)
+            if self.status != CODE_OK:
+                return
+            yield from page
+            if len(page) < page_size:
+                return
+            offset += len(page)
+
     def get_metadata(self, filename):
         """
         Obtiene en el server el tamaño del archivo con el nombre dado.
@@ -164,6 +291,75 @@ class Client(object):
             size = int(self.read_line())
             return size
 
+    def set_compression(self, method):
+        """
+        Pide al server que comprima los próximos get_slice de la sesión
+        con `method` ("none", "zlib" o "lzma").
+
+        Devuelve True si el server aceptó el método.
+        """
+        self.send("set_compression %s" % method)
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            self.compression = method
+            return True
+        logging.warning("El servidor no aceptó la compresión %s." % method)
+        return False
+
+    def get_metadata_many(self, filenames, batch_size=METADATA_BATCH_SIZE):
+        """
+        Obtiene en el server el tamaño de varios archivos, con pedidos
+        get_metadata_multi de hasta `batch_size` nombres, enviados en
+        pipeline. Así se paga un tiempo de ida y vuelta para todos y no
+        uno por archivo.
+
+        Devuelve una lista de pares (código, tamaño), en el orden de
+        `filenames`, con tamaño None si falló ese archivo.
+        """
+        requests = [
+            ("get_metadata_multi",) + tuple(filenames[i : i + batch_size])
+            for i in range(0, len(filenames), batch_size)
+        ]
+        result = []
+        for status, entries in self.pipeline(requests):
+            if status != CODE_OK:
+                logging.warning("Falló get_metadata_multi (code=%s)." % status)
+                return None
+            result.extend(entries)
+        return result
+
+    def get_checksum(self, filename, start=None, length=None):
+        """
+        Obtiene en el server el checksum (BLAKE2b, en hexadecimal) del
+        archivo, o del rango de `length` bytes desde `start` si se dan.
+        Devuelve None en caso de error.
+        """
+        if start is None:
+            self.send("get_checksum %s" % filename)
+        else:
+            self.send("get_checksum %s %d %d" % (filename, start, length))
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            return self.read_line()
+
+    def get_signatures(self, filename, block_size):
+        """
+        Obtiene en el server las firmas de los bloques de `block_size`
+        bytes del archivo. Devuelve una lista de pares (débil, fuerte), o
+        None en caso de error.
+        """
+        self.send("get_signatures %s %d" % (filename, block_size))
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return None
+        signatures = []
+        line = self.read_line()
+        while line:
+            weak, strong = line.split()
+            signatures.append((int(weak, 16), strong))
+            line = self.read_line()
+        return signatures
+
     def get_slice(self, filename, start, length):
         """
         Obtiene un trozo de un archivo en el server.
@@ -174,13 +370,106 @@ class Client(object):
         self.send("get_slice %s %d %d" % (filename, start, length))
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
-            output = open(filename, "wb")
-            fragment = self.read_fragment(length)
-            output.write(fragment)
-            output.close()
+            with open(filename, "wb") as output:
+                self.read_fragment_into(output, length)
+        else:
+            logging.warning("El servidor indico un error al leer de %s." % filename)
+
+    def get_slice_raw(self, filename, start, length):
+        """
+        Como get_slice, pero el server envía los bytes del archivo sin
+        codificar en base64.
+        """
+        self.send("get_slice_raw %s %d %d" % (filename, start, length))
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            with open(filename, "wb") as output:
+                self.read_raw_into(output, length)
         else:
             logging.warning("El servidor indico un error al leer de %s." % filename)
 
+    def fetch_range(self, filename, start, length, output, raw=False):
+        """
+        Obtiene un trozo de un archivo en el server y lo escribe en el
+        archivo `output` (o cualquier objeto con un método write).
+
+        Args:
+            raw: Si es True se usa get_slice_raw en vez de get_slice.
+
+        Devuelve True si se recibió el trozo completo.
+        """
+        cmd = "get_slice_raw" if raw else "get_slice"
+        self.send("%s %s %d %d" % (cmd, filename, start, length))
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return False
+        if raw:
+            return self.read_raw_into(output, length) == length
+        return self.read_fragment_into(output, length) == length
+
+    def pipeline(self, requests, window=PIPELINE_WINDOW):
+        """
+        Hace varios pedidos sin esperar la respuesta de cada uno antes de
+        enviar el siguiente: se mantienen hasta `window` pedidos en vuelo,
+        así el tiempo de ida y vuelta se paga una vez por tanda y no una
+        vez por pedido. El server responde en el mismo orden.
+
+        Args:
+            requests: Lista de tuplas (comando, argumentos...), donde el
+                comando es get_metadata, get_metadata_multi, get_checksum,
+                get_slice o get_slice_raw.
+            window: Máximo de pedidos enviados y todavía sin respuesta.
+
+        Devuelve una lista de pares (código, resultado), en el orden de
+        los pedidos. El resultado es el tamaño del archivo para
+        get_metadata, la lista de pares (código, tamaño) para
+        get_metadata_multi, el checksum para get_checksum, el contenido
+        del slice para get_slice y get_slice_raw, o None si el pedido falló.
+        """
+        results = []
+        sent = 0
+        while len(results) < len(requests):
+            # Se completa la ventana con una sola escritura en el socket
+            batch = requests[sent : len(results) + window]
+            if batch:
+                self.send(EOL.join(" ".join(map(str, r)) for r in batch))
+                sent += len(batch)
+            results.append(self._read_result(requests[len(results)]))
+            if not self.connected:
+                break
+        return results
+
+    def _read_result(self, request):
+        """
+        Lee la respuesta a un pedido hecho con pipeline.
+
+        Para uso privado del cliente.
+        """
+        cmd, *args = request
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return self.status, None
+        if cmd == "get_metadata":
+            return self.status, int(self.read_line())
+        if cmd == "get_checksum":
+            return self.status, self.read_line()
+        if cmd == "get_metadata_multi":
+            entries = []
+            for _ in args:
+                code, value = self.read_line().split(None, 1)
+                code = int(code)
+                entries.append((code, int(value) if code == CODE_OK else None))
+            self.read_line()  # La línea vacía del final
+            return self.status, entries
+        fragment = io.BytesIO()
+        if cmd == "get_slice":
+            self.read_fragment_into(fragment, int(args[2]))
+        elif cmd == "get_slice_raw":
+            self.read_raw_into(fragment, int(args[2]))
+        else:
+            raise ValueError(f"pipeline: comando no soportado '{cmd}'")
+        return self.status, fragment.getvalue()
+
     def retrieve(self, filename):
         """
         Obtiene un archivo completo desde el servidor.
@@ -196,6 +485,334 @@ class Client(object):
                 "No se pudo obtener el archivo %s (code=%s)." % (filename, self.status)
             )
 
+    def retrieve_if_changed(self, filename):
+        """
+        Como retrieve, pero si ya hay una copia local del archivo con el
+        mismo checksum que en el server, no se la vuelve a bajar.
+
+        Devuelve True si se bajó el archivo.
+        """
+        if os.path.exists(filename):
+            remote = self.get_checksum(filename)
+            if self.status == CODE_OK:
+                with open(filename, "rb") as f:
+                    local = file_digest(f, 0, os.fstat(f.fileno()).st_size)
+                if local == remote:
+                    logging.info("El archivo %s no cambió." % filename)
+                    return False
+        self.retrieve(filename)
+        return self.status == CODE_OK
+
+    def retrieve_delta(self, filename, block_size=DELTA_BLOCK_SIZE):
+        """
+        Como retrieve, pero si ya hay una copia local del archivo solo se
+        bajan los bloques que cambiaron, al estilo rsync: se piden las
+        firmas de los bloques del server, se buscan esos bloques en la copia
+        local (en cualquier posición, así también sirve si se insertaron o
+        borraron datos) y se piden con get_slice_raw solo los que faltan.
+        El archivo nuevo se arma aparte y se verifica con su checksum antes
+        de reemplazar la copia local.
+
+        Devuelve la cantidad de bytes que se bajaron del server, o None si
+        falló.
+        """
+        size = self.get_metadata(filename)
+        if self.status != CODE_OK:
+            logging.warning(
+                "No se pudo obtener el archivo %s (code=%s)." % (filename, self.status)
+            )
+            return None
+        if not os.path.exists(filename):
+            self.get_slice(filename, 0, size)
+            return size if self.status == CODE_OK else None
+        signatures = self.get_signatures(filename, block_size)
+        if signatures is None:
+            return None
+        tmp = filename + ".delta"
+        fetched = 0
+        with open(filename, "rb") as local, open(tmp, "wb") as output:
+            local_size = os.fstat(local.fileno()).st_size
+            data = b""
+            if local_size > 0:
+                data = mmap.mmap(local.fileno(), 0, access=mmap.ACCESS_READ)
+            found = match_blocks(data, signatures, block_size, size)
+            index = 0
+            while index < len(signatures):
+                start = index * block_size
+                if index in found:
+                    position = found[index]
+                    length = min(block_size, size - start)
+                    output.write(data[position : position + length])
+                    index += 1
+                    continue
+                # Se piden juntos los bloques que faltan seguidos
+                end = index
+                while end < len(signatures) and end not in found:
+                    end += 1
+                length = min(end * block_size, size) - start
+                if not self.fetch_range(filename, start, length, output, raw=True):
+                    break
+                fetched += length
+                index = end
+            if local_size > 0:
+                data.close()
+        remote = self.get_checksum(filename)
+        with open(tmp, "rb") as f:
+            local = file_digest(f, 0, os.fstat(f.fileno()).st_size)
+        if self.status != CODE_OK or local != remote:
+            # El archivo cambió en el medio o falló un pedido: se baja entero
+            logging.info("Falló la sincronización de %s, se baja entero." % filename)
+            os.remove(tmp)
+            self.get_slice(filename, 0, size)
+            return size if self.status == CODE_OK else None
+        os.replace(tmp, filename)
+        return fetched
+
+    def retrieve_parallel(
+        self,
+        filename,
+        connections=PARALLEL_CONNECTIONS,
+        range_size=PARALLEL_RANGE_SIZE,
+        raw=False,
+        resume=False,
+    ):
+        """
+        Obtiene un archivo completo desde el servidor, partido en rangos de
+        `range_size` bytes que se piden en paralelo por `connections`
+        conexiones. Cada rango se escribe en su posición del archivo local,
+        que se crea de antemano con el tamaño final. Los rangos que fallan
+        se vuelven a pedir, hasta MAX_RETRIES veces cada uno. Cada conexión
+        negocia la compresión que tenga negociada este cliente.
+
+        Si `resume` es True, los rangos completados se anotan en un
+        registro junto al archivo (ver journal.RangeJournal). Si la descarga
+        se corta, la próxima llamada solo pide los rangos que faltan,
+        siempre que el archivo en el server tenga el mismo tamaño.
+
+        Devuelve True si se obtuvo el archivo completo.
+        """
+        size = self.get_metadata(filename)
+        if self.status == FILE_NOT_FOUND:
+            logging.info("El archivo solicitado no existe.")
+            return False
+        elif self.status != CODE_OK:
+            logging.warning(
+                "No se pudo obtener el archivo %s (code=%s)." % (filename, self.status)
+            )
+            return False
+
+        journal = None
+        resuming = False
+        if resume:
+            journal = RangeJournal.load(filename)
+            if journal is None or journal.size != size or not os.path.exists(filename):
+                # No hay una descarga previa que se pueda retomar
+                journal = RangeJournal(filename, size)
+            elif journal.complete():
+                # Solo faltaba borrar el registro de la descarga anterior
+                journal.remove()
+                return True
+            else:
+                logging.info("Se retoma la descarga de %s." % filename)
+                resuming = True
+        if resuming:
+            fd = os.open(filename, os.O_WRONLY)
+            ranges = deque(journal.missing(range_size))
+        else:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            ranges = deque(
+                (start, min(range_size, size - start))
+                for start in range(0, size, range_size)
+            )
+        try:
+            os.ftruncate(fd, size)
+            on_done = None
+            if journal is not None:
+                journal.save()
+                on_done = lambda ranges: self._record(fd, journal, ranges)
+            fetcher = RangeFetcher(self, filename, fd, ranges, raw, on_done)
+            fetcher.run(connections)
+        finally:
+            os.close(fd)
+        if fetcher.failed:
+            self.status = INTERNAL_ERROR
+            logging.warning(
+                "No se pudieron obtener %d rangos de %s."
+                % (len(fetcher.failed), filename)
+            )
+        elif journal is not None:
+            journal.remove()
+        return not fetcher.failed
+
+    def _record(self, fd, journal, ranges):
+        """
+        Anota en el registro los rangos (inicio, largo) ya escritos. Primero
+        se asegura que los datos estén en disco, para no anotar rangos que
+        se perderían si se corta la luz.
+
+        Para uso privado del cliente.
+        """
+        os.fdatasync(fd)
+        for start, length in ranges:
+            journal.add(start, length)
+
+
+class PositionalWriter(object):
+    """
+    Objeto archivo que escribe con os.pwrite a partir de una posición, sin
+    mover el offset compartido del descriptor. Así varios hilos escriben
+    en distintas partes del mismo archivo a la vez.
+    """
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.fd, data[written:], self.offset + written)
+        self.offset += written
+        return written
+
+
+class RangeFetcher(object):
+    """
+    Reparte los rangos de un archivo entre varias conexiones, cada una en
+    su propio hilo, y reintenta los que fallan.
+    """
+
+    def __init__(self, client, filename, fd, ranges, raw=False, on_done=None):
+        """
+        Args:
+            client (Client): Cliente con la dirección del server.
+            filename (str): Nombre del archivo en el server.
+            fd (int): Descriptor del archivo local, ya con su tamaño final.
+            ranges: deque de pares (inicio, largo) que faltan obtener.
+            raw (bool): Si es True se usa get_slice_raw.
+            on_done: Función que se llama con una lista de pares (inicio,
+                largo) de rangos completos, de a un hilo por vez. Los
+                rangos que terminan mientras corre se le pasan juntos en
+                la llamada siguiente.
+        """
+        self.client = client
+        self.filename = filename
+        self.fd = fd
+        self.ranges = ranges
+        self.raw = raw
+        self.on_done = on_done
+        self.attempts = {}
+        self.failed = []
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.finished = []  # Rangos completos que falta pasar a on_done
+        self.record_lock = threading.Lock()  # Uno por vez en on_done
+
+    def run(self, connections):
+        """
+        Obtiene todos los rangos usando hasta `connections` conexiones.
+        """
+        threads = [
+            threading.Thread(target=self.worker)
+            for _ in range(min(connections, len(self.ranges)))
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def next_range(self):
+        """
+        Devuelve el próximo rango a pedir, o None si no quedan. Si no hay
+        rangos pero otros hilos tienen pedidos en curso, espera: pueden
+        fallar y volver a la cola.
+        """
+        with self.cond:
+            while not self.ranges and self.in_flight > 0:
+                self.cond.wait()
+            if not self.ranges:
+                return None
+            self.in_flight += 1
+            return self.ranges.popleft()
+
+    def done(self, rng, ok):
+        """
+        Registra el resultado de un rango y lo vuelve a encolar si falló.
+        """
+        with self.cond:
+            try:
+                self.in_flight -= 1
+                if ok and self.on_done is not None:
+                    self.finished.append(rng)
+                elif not ok:
+                    self.attempts[rng] = self.attempts.get(rng, 0) + 1
+                    if self.attempts[rng] < MAX_RETRIES:
+                        self.ranges.append(rng)
+                    else:
+                        self.failed.append(rng)
+            finally:
+                self.cond.notify_all()
+        if ok and self.on_done is not None:
+            self.record()
+
+    def record(self):
+        """
+        Pasa a on_done los rangos completos. Se llama sin tener self.cond:
+        on_done puede tardar (p.ej. esperar a que los datos lleguen al
+        disco) y mientras tanto los demás hilos siguen pidiendo rangos.
+
+        Si on_done falla, sus rangos cuentan como fallidos: están escritos
+        pero no anotados, y la descarga no se da por completa.
+        """
+        with self.record_lock:
+            with self.cond:
+                finished, self.finished = self.finished, []
+            if not finished:
+                return  # Ya los anotó otro hilo mientras se esperaba
+            try:
+                self.on_done(finished)
+            except OSError as e:
+                logging.warning("No se pudieron anotar los rangos: %s" % e)
+                with self.cond:
+                    self.failed.extend(finished)
+
+    def worker(self):
+        """
+        Cuerpo de cada hilo: pide rangos por su propia conexión.
+        """
+        c = None
+        rng = self.next_range()
+        while rng is not None:
+            start, length = rng
+            ok = False
+            # done() siempre se llama: si no, los demás hilos esperan este
+            # rango para siempre en next_range()
+            try:
+                try:
+                    if c is None:
+                        c = Client(self.client.server, self.client.port)
+                        if not self.raw and self.client.compression != "none":
+                            # Se negocia la misma compresión que el cliente original
+                            c.set_compression(self.client.compression)
+                    output = PositionalWriter(self.fd, start)
+                    ok = c.fetch_range(self.filename, start, length, output, self.raw)
+                except (socket.error, ValueError, zlib.error, lzma.LZMAError) as e:
+                    logging.info("Falló el rango %d+%d: %s" % (start, length, e))
+                    ok = False
+                    if c is not None:
+                        c.connected = False
+                        c.s.close()
+                if c is not None and not c.connected:
+                    c = None  # Se reconecta para el próximo rango
+            finally:
+                self.done(rng, ok)
+            rng = self.next_range()
+        if c is not None:
+            try:
+                c.close()
+            except socket.error:
+                pass
+
 
 def main():
     """
@@ -214,6 +831,40 @@ def main():
     parser.add_option(
         "-p", "--port", help="Numero de puerto TCP donde escuchar", default=DEFAULT_PORT
     )
+    parser.add_option(
+        "-c",
+        "--connections",
+        type="int",
+        help="Conexiones en paralelo para bajar el archivo",
+        default=1,
+    )
+    parser.add_option(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="Retomar la descarga si se había cortado",
+        default=False,
+    )
+    parser.add_option(
+        "-u",
+        "--update",
+        action="store_true",
+        help="No bajar el archivo si la copia local tiene el mismo checksum",
+        default=False,
+    )
+    parser.add_option(
+        "-d",
+        "--delta",
+        action="store_true",
+        help="Bajar solo los bloques que cambiaron respecto de la copia local",
+        default=False,
+    )
+    parser.add_option(
+        "-z",
+        "--compression",
+        help="Comprimir los get_slice con este método (none, zlib o lzma)",
+        default="none",
+    )
     parser.add_option(
         "-v",
         "--verbose",
@@ -235,6 +886,15 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    # -c/-r, -d y -u eligen cómo se baja el archivo: solo se puede usar uno
+    if options.connections < 1:
+        parser.error("-c debe ser al menos 1")
+    parallel = options.connections > 1 or options.resume
+    if parallel + options.delta + options.update > 1:
+        parser.error("-c/-r, -d y -u no se pueden combinar")
+    if options.compression not in COMPRESSION_METHODS:
+        parser.error("Compresión desconocida: %s" % options.compression)
+
     # Setar verbosidad
     code_level = DEBUG_LEVELS.get(options.level)  # convertir el str en codigo
     logging.getLogger().setLevel(code_level)
@@ -251,6 +911,9 @@ def main():
         "* Estan disponibles los siguientes archivos:"
     )
 
+    if options.compression != "none":
+        client.set_compression(options.compression)
+
     files = client.file_lookup()
 
     for filename in files:
@@ -258,7 +921,16 @@ def main():
 
     if client.status == CODE_OK:
         print("* Indique el nombre del archivo a descargar:")
-        client.retrieve(input().strip())
+        if parallel:
+            client.retrieve_parallel(
+                input().strip(), options.connections, resume=options.resume
+            )
+        elif options.delta:
+            client.retrieve_delta(input().strip())
+        elif options.update:
+            client.retrieve_if_changed(input().strip())
+        else:
+            client.retrieve(input().strip())
 
     client.close()
 
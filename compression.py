@@ -0,0 +1,68 @@
+# encoding: utf-8
+
+import lzma
+import os
+import zlib
+from constants import *
+
+# Métodos que se pueden negociar con set_compression
+COMPRESSION_METHODS = {"none", "zlib", "lzma"}
+
+# Extensiones de archivos que ya vienen comprimidos
+COMPRESSED_EXTENSIONS = {
+    ".gz",
+    ".tgz",
+    ".bz2",
+    ".xz",
+    ".lzma",
+    ".zst",
+    ".zip",
+    ".7z",
+    ".rar",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".webp",
+    ".mp3",
+    ".mp4",
+    ".mkv",
+    ".ogg",
+}
+
+
+def compressor(method: str):
+    """
+    Devuelve un compresor del método dado, con métodos compress y flush.
+    """
+    if method == "zlib":
+        return zlib.compressobj(ZLIB_LEVEL)
+    if method == "lzma":
+        return lzma.LZMACompressor(preset=LZMA_PRESET)
+    raise ValueError(f"método de compresión inválido '{method}'")
+
+
+def decompressor(method: str):
+    """
+    Devuelve un descompresor del método dado, con método decompress.
+    """
+    if method == "zlib":
+        return zlib.decompressobj()
+    if method == "lzma":
+        return lzma.LZMADecompressor()
+    raise ValueError(f"método de compresión inválido '{method}'")
+
+
+def worth_compressing(filename: str, size: int, sample):
+    """
+    Decide si vale la pena comprimir un slice de `size` bytes, mirando la
+    extensión del archivo y cuánto se comprime `sample`, el principio del
+    slice, con zlib en el nivel más rápido. Los slices chicos no se
+    comprimen.
+    """
+    if size < COMPRESSION_MIN_SIZE:
+        return False
+    if os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    sample = sample[:COMPRESSION_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) <= len(sample) * COMPRESSION_MAX_RATIO
@@ -4,10 +4,26 @@
 # $Id: connection.py 455 2011-05-01 00:32:09Z carlos $
 
 import socket
+from socket import IPPROTO_TCP, TCP_NODELAY
 import os
 from constants import *
 from base64 import b64encode
+from collections import deque
+from metacache import shared_cache
+from blockcache import BlockCache, BlockReader
+from checksums import ChecksumCache
+from compression import COMPRESSION_METHODS, compressor, worth_compressing
+from framing import LineBuffer
+from metrics import Metrics
+from tracing import NO_TRACE
+import itertools
 import logging
+import time
+
+logger = logging.getLogger("hftp.server")
+
+# TCP_CORK solo existe en Linux; en otros sistemas no se usa
+TCP_CORK = getattr(socket, "TCP_CORK", None)
 
 
 class Connection(object):
@@ -17,30 +33,98 @@ class Connection(object):
     que termina la conexión.
     """
 
-    def __init__(self, socket: socket.socket, directory):
+    def __init__(
+        self,
+        socket: socket.socket,
+        directory,
+        block_size=SLICE_BLOCK_SIZE,
+        cache=None,
+        blocks=None,
+        cache_b64=False,
+        mmaps=None,
+        checksums=None,
+        limiter=None,
+        metrics=None,
+        log=None,
+        tracer=None,
+        profiler=None,
+    ):
         """
         Inicializa una nueva conexión.
 
         Args:
             socket: Objeto socket que representa la conexión.
             directory: Directorio raíz de los archivos que se compartirán con el cliente.
+            block_size: Bytes del archivo que se leen y codifican por vez en
+                get_slice. Debe ser múltiplo de 3.
+            cache: MetadataCache del directorio, compartido entre conexiones.
+                Si no se da, se usa el que comparten las conexiones creadas
+                sin uno (ver metacache.shared_cache).
+            blocks: BlockCache compartido para las lecturas de get_slice.
+                Si no se da, no se guardan bloques.
+            cache_b64: Si es True, también se guarda en `blocks` la
+                codificación base64 de los bloques enteros.
+            mmaps: MmapPool compartido para leer los archivos mapeados en
+                memoria. Si no se da, se leen con read.
+            checksums: ChecksumCache compartido para get_checksum. Si no
+                se da, la conexión usa uno propio.
+            limiter: RateLimiter con el ancho de banda de la conexión. Si
+                no se da, se envía sin límite.
+            metrics: Metrics compartido donde se anotan los pedidos. Si no
+                se da, la conexión usa uno propio, con sus caches.
+            log: RequestLogger compartido donde se anotan los pedidos. Si
+                no se da, no se anotan.
+            tracer: Tracer compartido donde se anotan las fases de cada
+                pedido. Si no se da, no se anotan.
+            profiler: ThreadProfiler compartido, que la conexión consulta
+                entre pedidos. Si no se da, no se usa cProfile.
         """
+        assert block_size > 0 and block_size % 3 == 0
         self.directory = directory
+        self.cache = cache if cache is not None else shared_cache(directory)
+        self.blocks = blocks if blocks is not None else BlockCache(0)
+        self.cache_b64 = cache_b64
+        self.mmaps = mmaps
+        self.checksums = checksums if checksums is not None else ChecksumCache()
+        self.limiter = limiter
+        if metrics is None:
+            metrics = Metrics()
+            metrics.register("metadata_cache", self.cache)
+            metrics.register("block_cache", self.blocks)
+            if mmaps is not None:
+                metrics.register("mmap_pool", mmaps)
+            metrics.register("checksum_cache", self.checksums)
+        self.metrics = metrics
+        self.log = log
+        self.tracer = tracer
+        self.profiler = profiler
+        # Registro de acceso del pedido que se está atendiendo, si se anota
+        self.record = None
+        self.block_size = block_size
+        # Compresión de los slices negociada con set_compression
+        self.compression = "none"
         self.s = socket
+        # La salida ya se junta en flush, Nagle solo agregaría demoras
+        self.s.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.corked = False
         self.connected = True
-        self.buffer = ""
+        self.buffer = LineBuffer()
+        # Respuestas ya generadas que todavía no se escribieron en el socket
+        self.pending = deque()
+        self.pending_size = 0
 
     def close(self):
         """
-        Cierra la conexión.
+        Cierra la conexión, luego de enviar las respuestas pendientes.
         """
-        print("Closing connection...")
+        logger.info("Closing connection...")
+        self.flush()
         self.connected = False
         try:
             self.s.close()
         except socket.error as e:
             # Seguramente ya se desconecto del otro lado
-            print(f"Error closing socket: {e}")
+            logger.warning("Error closing socket: %s", e)
 
     def send(self, message: bytes or str, codif="ascii"):
         """
@@ -62,15 +146,214 @@ class Connection(object):
             else:
                 raise ValueError(f"send: codificación inválida '{codif}'")
             # Envía el mensaje
-            while message:
-                bytes_sent = self.s.send(message)
-                assert bytes_sent > 0
-                message = message[bytes_sent:]
-            self.s.send(EOL.encode("ascii"))  # Envía el fin de línea
-
-        except BrokenPipeError or ConnectionResetError:
-            logging.warning("No se pudo contactar al cliente")
+            self._write(message)
+            self._write(EOL.encode("ascii"))  # Envía el fin de línea
+
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("No se pudo contactar al cliente")
+            self.connected = False
+
+    def send_stream(self, chunks):
+        """
+        Envia como una sola línea los fragmentos que produce `chunks`,
+        sin tenerlos todos en memoria a la vez.
+
+        Args:
+            chunks: Iterable de bytes ya codificados.
+        """
+        try:
+            self._write_stream(chunks)
+            self._write(EOL.encode("ascii"))  # Envía el fin de línea
+
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("No se pudo contactar al cliente")
+            self.connected = False
+
+    def send_file(self, f, offset: int, size: int):
+        """
+        Envia `size` bytes del archivo abierto `f` a partir de `offset`, tal
+        cual están en el archivo, seguidos del fin de línea, y cierra el
+        archivo.
+        """
+        try:
+            self._write_file(f, offset, size)
+            self._write(EOL.encode("ascii"))  # Envía el fin de línea
+
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("No se pudo contactar al cliente")
+            self.connected = False
+        except OSError as e:
+            # Ya se envió el encabezado, no se puede avisar el error
+            logger.error("Error in connection handling: %s", e)
+            self.pending.clear()
+            self.close()
+
+    def send_deferred(self, future, render):
+        """
+        Envía una respuesta que se calcula en otro hilo. Se respeta el
+        orden: la respuesta va después de todo lo enviado antes.
+
+        Args:
+            future: Future con el resultado del cálculo.
+            render: Función que recibe el Future ya completo y devuelve el
+                código de respuesta y los bytes que van luego del
+                encabezado.
+        """
+        deferred = Deferred(future, render)
+        deferred.record = self.record
+        self._write_deferred(deferred)
+
+    def flush(self):
+        """
+        Escribe en el socket las respuestas pendientes, todas juntas y
+        normalmente con una sola llamada a sendmsg.
+        """
+        try:
+            self._send_pending()
+            self._cork(False)
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            logger.warning("No se pudo contactar al cliente")
+            self.pending.clear()
             self.connected = False
+        self.pending_size = 0
+
+    def _cork(self, corked: bool):
+        """
+        Activa o desactiva TCP_CORK. Mientras está activo, el kernel solo
+        envía segmentos llenos, así el encabezado, el contenido enviado con
+        sendfile y el fin de línea no salen en segmentos chicos separados.
+
+        Para uso privado de la conexión.
+        """
+        if TCP_CORK is not None and corked != self.corked:
+            self.s.setsockopt(IPPROTO_TCP, TCP_CORK, int(corked))
+            self.corked = corked
+
+    def _write(self, data: bytes):
+        """
+        Agrega los bytes a las respuestas pendientes. Se escriben en el
+        socket al llamar a flush(), o antes si ya se acumularon
+        OUTPUT_BUFFER_SIZE bytes.
+
+        Para uso privado de la conexión.
+        """
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.record is not None:
+                count_bytes(self.record, len(data))
+        if self.pending_size >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def _send_pending(self):
+        """
+        Escribe en el socket todas las respuestas pendientes, bloqueando
+        hasta terminar. Con límite de ancho de banda se envían de a
+        RATE_QUANTUM bytes, esperando el turno de cada parte.
+
+        Para uso privado de la conexión.
+        """
+        while self.pending:
+            if self.limiter is None:
+                with self.trace("send"):
+                    self.metrics.sent(send_vectored(self.s, self.pending))
+                continue
+            size = min(sum(map(len, self.pending)), RATE_QUANTUM)
+            self._throttle(size)
+            while size > 0:
+                with self.trace("send"):
+                    sent = send_vectored(self.s, self.pending, size)
+                self.metrics.sent(sent)
+                size -= sent
+
+    def _throttle(self, size: int):
+        """
+        Reserva `size` bytes del ancho de banda y espera hasta poder
+        enviarlos.
+
+        Para uso privado de la conexión.
+        """
+        delay = self.limiter.reserve(size)
+        if delay > 0:
+            with self.trace("throttle"):
+                time.sleep(delay)
+
+    def trace(self, phase: str):
+        """
+        Devuelve un context manager que anota en el tracer la duración de
+        `phase`, o uno que no hace nada si no hay tracing.
+        """
+        if self.tracer is None:
+            return NO_TRACE
+        return self.tracer.span(phase)
+
+    def _write_stream(self, chunks):
+        """
+        Escribe en el socket cada fragmento a medida que se produce.
+
+        Para uso privado de la conexión.
+        """
+        for chunk in chunks:
+            self._write(chunk)
+
+    def _write_deferred(self, deferred):
+        """
+        Espera a que termine el cálculo y escribe su respuesta. El cálculo
+        corre en otro hilo igual, así varias conexiones que piden lo mismo
+        lo comparten.
+
+        Para uso privado de la conexión.
+        """
+        self._write(self._render(deferred))
+
+    def _render(self, deferred):
+        """
+        Arma la respuesta de un cálculo terminado. Su código se anota como
+        en header(): en las métricas y en el registro de acceso del pedido.
+
+        Para uso privado de la conexión.
+        """
+        code, body = deferred.render(deferred.future)
+        self.metrics.response(code)
+        if deferred.record is not None:
+            deferred.record.setdefault("status", code)
+        return f"{code} {error_messages[code]}{EOL}".encode("ascii") + body
+
+    def _write_file(self, f, offset: int, size: int):
+        """
+        Escribe en el socket un rango del archivo abierto `f` con
+        sendfile, y cierra el archivo.
+
+        Para uso privado de la conexión.
+
+        Raises:
+            OSError: Si el archivo se achicó y ya no tiene los bytes del rango.
+        """
+        with f:
+            if size > 0:
+                if self.record is not None:
+                    count_bytes(self.record, size)
+                # Lo pendiente va antes que el contenido del archivo. El
+                # cork se saca en el próximo flush, luego del fin de línea.
+                self._cork(True)
+                self._send_pending()
+                if self.limiter is None:
+                    with self.trace("send"):
+                        sent = self.s.sendfile(f, offset, size)
+                    self.metrics.sent(sent)
+                    if sent < size:
+                        raise OSError("el archivo se achicó mientras se lo enviaba")
+                    return
+                while size > 0:
+                    part = min(size, RATE_QUANTUM)
+                    self._throttle(part)
+                    with self.trace("send"):
+                        sent = self.s.sendfile(f, offset, part)
+                    self.metrics.sent(sent)
+                    if sent == 0:
+                        raise OSError("el archivo se achicó mientras se lo enviaba")
+                    offset += sent
+                    size -= sent
 
     def header(self, cod: int):
         """
@@ -80,6 +363,10 @@ class Connection(object):
         Args:
             cod: Código de respuesta a enviar.
         """
+        self.metrics.response(cod)
+        if self.record is not None:
+            # Cuenta el código con que empieza la respuesta
+            self.record.setdefault("status", cod)
         if fatal_status(cod):
             self.send(f"{cod} {error_messages[cod]}")
             self.close()
@@ -98,26 +385,59 @@ class Connection(object):
             INVALID_ARGUMENTS si el nombre del archivo no es valido.
             FILE_NOT_FOUND si el archivo no existe.
         """
+        return self.file_info(filename)[0]
+
+    def file_info(self, filename: str):
+        """
+        Como valid_file, pero además devuelve los datos del archivo, que
+        se obtienen del cache de metadatos compartido.
+
+        Returns:
+            Un par (código, FileInfo), con None en lugar del FileInfo si
+            el código no es CODE_OK.
+        """
         # Obtiene los caracteres del nombre del archivo que no pertenecen a VALID_CHARS
         aux = set(filename) - VALID_CHARS
-        if os.path.isfile(os.path.join(self.directory, filename)) and len(aux) == 0:
-            return CODE_OK
-        elif len(aux) != 0:
-            return INVALID_ARGUMENTS
-        else:
-            return FILE_NOT_FOUND
+        if len(aux) != 0:
+            return INVALID_ARGUMENTS, None
+        with self.trace("validate"):
+            info = self.cache.lookup(filename)
+        if info is None:
+            return FILE_NOT_FOUND, None
+        return CODE_OK, info
 
-    def get_file_listing(self):
+    def get_file_listing(self, offset=0, count=None):
         """
-        Obtiene la lista de archivos disponibles en el directorio y la envía al cliente
+        Obtiene la lista de archivos disponibles en el directorio y la envía al cliente.
+
+        Los nombres se envían a medida que se recorre la lista, de a
+        bloques, sin armar toda la respuesta en memoria. Con `offset` y
+        `count` se envía solo esa página del listado, ordenado
+        alfabéticamente; una página con menos de `count` nombres es la última.
         """
-        rta = ""
-        # Itero sobre la lista de archivos disponibles en el directorio
-        for fil in os.listdir(self.directory):
-            # Agrego los archvios a la cadena de respuesta
-            rta += fil + EOL
+        if offset < 0 or (count is not None and count < 0):
+            self.header(INVALID_ARGUMENTS)
+            return
+        names = self.cache.listing(offset, count)
         self.header(CODE_OK)
-        self.send(rta)
+        self.send_stream(self.listing_chunks(names))
+
+    def listing_chunks(self, names):
+        """
+        Genera los nombres, cada uno seguido del fin de línea, juntados en
+        bloques de alrededor de OUTPUT_BUFFER_SIZE bytes.
+        """
+        batch = []
+        size = 0
+        for name in names:
+            batch.append(name)
+            size += len(name) + len(EOL)
+            if size >= OUTPUT_BUFFER_SIZE:
+                yield (EOL.join(batch) + EOL).encode("ascii")
+                batch = []
+                size = 0
+        if batch:
+            yield (EOL.join(batch) + EOL).encode("ascii")
 
     def get_metadata(self, filename: str):
         """
@@ -127,14 +447,39 @@ class Connection(object):
             filename (str): El nombre del archivo del que se va a obtener el tamaño.
         """
         # Se verifica si es un archivo valido
-        if self.valid_file(filename) != CODE_OK:
+        code, info = self.file_info(filename)
+        if code != CODE_OK:
             # Se envia el mensaje de error correspondiente por no ser un archivo valido
-            self.header(self.valid_file(filename))
+            self.header(code)
         else:
-            # Se obtiene el tamaño del archivo y se envia al cliente
-            file_size = os.path.getsize(os.path.join(self.directory, filename))
+            # Se envia al cliente el tamaño del archivo
             self.header(CODE_OK)
-            self.send(str(file_size))
+            self.send(str(info.size))
+
+    def get_metadata_multi(self, filenames):
+        """
+        Obtiene el tamaño de varios archivos y lo envía al cliente en una
+        sola respuesta: una línea por archivo, en el mismo orden, con
+        "0 <tamaño>" o con el código y mensaje de error de ese archivo,
+        seguidas de una línea vacía.
+
+        Args:
+            filenames (list): Los nombres de los archivos.
+        """
+        valid = [f for f in filenames if not set(f) - VALID_CHARS]
+        infos = dict(zip(valid, self.cache.lookup_many(valid)))
+        lines = []
+        for filename in filenames:
+            if filename not in infos:
+                code = INVALID_ARGUMENTS
+            elif infos[filename] is None:
+                code = FILE_NOT_FOUND
+            else:
+                lines.append(f"{CODE_OK} {infos[filename].size}")
+                continue
+            lines.append(f"{code} {error_messages[code]}")
+        self.header(CODE_OK)
+        self.send(EOL.join(lines) + EOL)
 
     def get_slice(self, filename: str, offset: int, size: int):
         """
@@ -146,24 +491,257 @@ class Connection(object):
             offset (int): El byte de inicio del slice.
             size (int): El tamaño del slice.
         """
+        target = self.slice_path(filename, offset, size)
+        if target is not None:
+            filepath, info = target
+            self.header(CODE_OK)
+            if self.compression != "none":
+                self.send_compressed_slice(filepath, info, offset, size)
+            else:
+                self.send_stream(self.slice_blocks(filepath, info, offset, size))
+
+    def set_compression(self, method: str):
+        """
+        Elige la compresión de los próximos get_slice de la sesión: "none",
+        "zlib" o "lzma". Con compresión, la respuesta de get_slice tiene
+        antes del contenido una línea con el método usado en ese slice, que
+        puede ser "none" si el contenido no se comprime bien (p.ej. porque
+        ya está comprimido). get_slice_raw nunca se comprime.
+        """
+        if method not in COMPRESSION_METHODS:
+            self.header(INVALID_ARGUMENTS)
+            return
+        self.compression = method
+        self.header(CODE_OK)
+
+    def send_compressed_slice(self, filepath: str, info, offset: int, size: int):
+        """
+        Envía la línea con el método de compresión usado para el slice y el
+        slice en base64, comprimido si vale la pena. Para decidir se prueba
+        comprimir el principio del slice.
+        """
+        parts = self.slice_parts(filepath, info, offset, size)
+        head = []
+        sampled = 0
+        for reader, index, part in parts:
+            head.append(part)
+            sampled += len(part)
+            if sampled >= COMPRESSION_SAMPLE_SIZE:
+                break
+        sample = b"".join(head)
+        if worth_compressing(filepath, size, sample):
+            method = self.compression
+        else:
+            method = "none"
+        self.send(method)
+        # Lo ya leído, seguido del resto del slice
+        rest = (part for reader, index, part in parts)
+        if method == "none":
+            self.send_stream(b64_stream(itertools.chain([sample], rest)))
+        else:
+            chunks = compress_stream(itertools.chain([sample], rest), method)
+            self.send_stream(b64_stream(chunks))
+
+    def get_slice_raw(self, filename: str, offset: int, size: int):
+        """
+        Obtiene un slice del archivo especificado y lo envía al cliente
+        sin codificar: luego del encabezado van exactamente `size` bytes
+        y el fin de línea. Los bytes se copian del archivo al socket
+        dentro del kernel (sendfile), sin pasar por el proceso.
+
+        Args:
+            filename (str): El nombre del archivo del que se va a obtener el slice.
+            offset (int): El byte de inicio del slice.
+            size (int): El tamaño del slice.
+        """
+        target = self.slice_path(filename, offset, size)
+        if target is not None:
+            filepath, info = target
+            try:
+                f = open(filepath, "rb")
+            except OSError:
+                # El archivo se borró desde que se lo buscó
+                self.header(FILE_NOT_FOUND)
+                return
+            self.header(CODE_OK)
+            self.send_file(f, offset, size)
+
+    def get_checksum(self, filename: str, offset=0, size=None):
+        """
+        Obtiene el checksum (BLAKE2b) de un archivo o de un rango de un
+        archivo y lo envía al cliente, en hexadecimal. Los checksums de
+        cada versión del archivo se guardan en un cache compartido y los
+        de rangos grandes se calculan en otro hilo.
+
+        Args:
+            filename (str): El nombre del archivo.
+            offset (int): Primer byte del rango.
+            size (int): Bytes del rango, o None para llegar hasta el final.
+        """
+        code, info = self.file_info(filename)
+        if code != CODE_OK:
+            self.header(code)
+            return
+        if size is None:
+            size = info.size - offset
+        if offset < 0 or size < 0 or offset + size > info.size:
+            self.header(BAD_OFFSET)
+            return
+        filepath = os.path.join(self.directory, filename)
+        future = self.checksums.digest(filepath, info, offset, size)
+        self.send_deferred(future, self.render_checksum)
+
+    def render_checksum(self, future):
+        """
+        Arma la respuesta de get_checksum a partir del cálculo terminado.
+
+        Devuelve el código de respuesta y lo que va luego del encabezado.
+        """
+        try:
+            digest = future.result()
+        except OSError:
+            # El archivo se borró o se achicó desde que se lo buscó
+            return FILE_NOT_FOUND, b""
+        return CODE_OK, f"{digest}{EOL}".encode("ascii")
+
+    def get_signatures(self, filename: str, block_size: int):
+        """
+        Envía al cliente las firmas de los bloques de `block_size` bytes del
+        archivo, para que pueda pedir solo los que no tiene (delta sync, al
+        estilo rsync): una línea por bloque con la suma débil (adler32) y
+        el hash fuerte en hexadecimal, seguidas de una línea vacía. Se
+        calculan y guardan como los checksums.
+
+        Args:
+            filename (str): El nombre del archivo.
+            block_size (int): Bytes por bloque; el último puede ser más corto.
+        """
+        if not MIN_SIGNATURE_BLOCK <= block_size <= MAX_SIGNATURE_BLOCK:
+            self.header(INVALID_ARGUMENTS)
+            return
+        code, info = self.file_info(filename)
+        if code != CODE_OK:
+            self.header(code)
+            return
+        filepath = os.path.join(self.directory, filename)
+        future = self.checksums.signatures(filepath, info, block_size)
+        self.send_deferred(future, self.render_signatures)
+
+    def render_signatures(self, future):
+        """
+        Arma la respuesta de get_signatures a partir del cálculo terminado.
+
+        Devuelve el código de respuesta y lo que va luego del encabezado.
+        """
+        try:
+            signatures = future.result()
+        except OSError:
+            # El archivo se borró desde que se lo buscó
+            return FILE_NOT_FOUND, b""
+        lines = "".join(f"{weak:08x} {strong}{EOL}" for weak, strong in signatures)
+        return CODE_OK, (lines + EOL).encode("ascii")
+
+    def slice_path(self, filename: str, offset: int, size: int):
+        """
+        Verifica que se pueda obtener el slice pedido. Si no se puede,
+        envía el código de error correspondiente.
+
+        Returns:
+            Un par (ruta, FileInfo) del archivo, o None si el pedido no es válido.
+        """
         # Se verifica si es un archivo valido
-        if self.valid_file(filename) != CODE_OK:
+        code, info = self.file_info(filename)
+        if code != CODE_OK:
             # Se envia el mensaje de error correspondiente por no ser un archivo valido
-            self.header(self.valid_file(filename))
-        else:
-            filepath = os.path.join(self.directory, filename)
-            file_size = os.path.getsize(filepath)
-            if offset < 0 or offset + size > file_size or size < 0:
-                self.header(BAD_OFFSET)
-            # Abrir el archivo en modo lectura binario "rb"
-            # 'r' se abrira el archivo en modo lectura y 'b' se abrira en modo binario
-            else:
-                with open(filepath, "rb") as f:
-                    # Lee el slice del archivo especificado, inicia en offset y lee size bytes
-                    f.seek(offset)
-                    slice_data = f.read(size)
-                    self.header(CODE_OK)
-                    self.send(slice_data, codif="b64encode")
+            self.header(code)
+            return None
+        if offset < 0 or offset + size > info.size or size < 0:
+            self.header(BAD_OFFSET)
+            return None
+        return os.path.join(self.directory, filename), info
+
+    def slice_parts(self, filepath: str, info, offset: int, size: int):
+        """
+        Generador que recorre el slice por los bloques alineados de
+        `block_size` bytes del archivo, que se buscan primero en el cache
+        de bloques compartido (o se toman del mapeo en memoria del archivo,
+        si hay pool de mmap).
+
+        Devuelve por cada bloque una terna (lector, número de bloque,
+        parte del slice que cae en el bloque). Termina antes si el archivo
+        se achicó mientras se lo enviaba.
+
+        Args:
+            filepath (str): Ruta del archivo.
+            info: FileInfo del archivo.
+            offset (int): El byte de inicio del slice.
+            size (int): El tamaño del slice.
+        """
+        mapped = None
+        if self.mmaps is not None and size > 0:
+            mapped = self.mmaps.acquire(filepath, info)
+        reader = BlockReader(filepath, info, self.block_size, self.blocks, mapped)
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        try:
+            for index in range(first, last + 1):
+                start = index * self.block_size
+                lo = max(offset - start, 0)
+                hi = min(offset + size - start, self.block_size)
+                with self.trace("read"):
+                    block = reader.block(index)
+                yield reader, index, memoryview(block)[lo:hi]
+                if len(block) < hi:
+                    break
+        finally:
+            reader.close()
+            if mapped is not None:
+                self.mmaps.release(mapped)
+
+    def slice_blocks(self, filepath: str, info, offset: int, size: int):
+        """
+        Generador que devuelve el slice codificado en base64, de a partes
+        que concatenadas forman la codificación del slice completo. Si
+        `cache_b64` está activo, los bloques enteros se toman ya
+        codificados del cache de bloques.
+
+        Args:
+            filepath (str): Ruta del archivo.
+            info: FileInfo del archivo.
+            offset (int): El byte de inicio del slice.
+            size (int): El tamaño del slice.
+        """
+        carry = b""  # Bytes de la parte anterior que no se codificaron aún
+        for reader, index, part in self.slice_parts(filepath, info, offset, size):
+            if self.cache_b64 and not carry and len(part) == self.block_size:
+                # Bloque entero: su codificación guardada sirve tal cual
+                yield reader.encoded(index)
+                continue
+            start = 0
+            if carry:
+                # Se completan aparte los 3 bytes que quedaron a medias, así
+                # el resto de la parte se codifica sin copiarla
+                start = min(3 - len(carry), len(part))
+                carry += bytes(part[:start])
+                if len(carry) < 3:
+                    continue
+                yield b64encode(carry)
+                carry = b""
+            # Se codifica de a múltiplos de 3 bytes, sin relleno en el medio
+            cut = len(part) - (len(part) - start) % 3
+            with self.trace("encode"):
+                encoded = b64encode(part[start:cut])
+            yield encoded
+            carry = bytes(part[cut:])
+        yield b64encode(carry)
+
+    def stats(self):
+        """
+        Envía las métricas del servidor, en el formato de texto de
+        Prometheus, una por línea, terminadas con una línea vacía.
+        """
+        self.header(CODE_OK)
+        self.send_stream(self.listing_chunks(self.metrics.render()))
 
     def quit(self):
         """
@@ -174,44 +752,36 @@ class Connection(object):
 
     def command_selector(self, line):
         """
-        Selecciona el comando a ejecutar según la línea recibida.
+        Selecciona el comando a ejecutar según la línea recibida, buscándolo
+        en COMMANDS, y lo ejecuta con los argumentos ya convertidos.
         Si la línea no es un comando válido o existe un problema con sus argumentos,
         se envía el código de error correspondiente.
 
         Args:
             line (str): La línea recibida.
+
+        Returns:
+            El nombre del comando, o "unknown" si no existe.
         """
+        cmd, *args = line.split(" ")
+        command = COMMANDS.get(cmd)
+        if self.record is not None:
+            self.record["command"] = cmd
+        if command is None:
+            self.header(INVALID_COMMAND)
+            return "unknown"
         try:
-            print("Request: " + line)
-            cmd, *args = line.split(" ")
-            if cmd == "get_file_listing":
-                if len(args) == 0:
-                    self.get_file_listing()
-                else:
-                    self.header(INVALID_ARGUMENTS)
-            elif cmd == "get_metadata":
-                if len(args) == 1:
-                    self.get_metadata(args[0])
-                else:
-                    self.header(INVALID_ARGUMENTS)
-            elif cmd == "get_slice":
-                try:
-                    if len(args) == 3:
-                        self.get_slice(args[0], int(args[1]), int(args[2]))
-                    else:
-                        self.header(INVALID_ARGUMENTS)
-                except ValueError:
-                    self.header(INVALID_ARGUMENTS)
-            elif cmd == "quit":
-                if len(args) == 0:
-                    self.quit()
-                else:
-                    self.header(INVALID_ARGUMENTS)
+            args = command.parse(args)
+            if args is None:
+                self.header(INVALID_ARGUMENTS)
             else:
-                self.header(INVALID_COMMAND)
+                if self.record is not None:
+                    command.describe(self.record, args)
+                command.handler(self, *args)
         except Exception as e:
-            print(f"Error in connection handling: {e}")
+            logger.error("Error in connection handling: %s", e)
             self.header(INTERNAL_ERROR)
+        return cmd
 
     def _recv(self):
         """
@@ -220,18 +790,28 @@ class Connection(object):
         Para uso privado del servidor.
         """
         try:
-            data = self.s.recv(4096).decode("ascii")
-            self.buffer += data
-
-            if len(data) == 0:
-                self.close()
-            if len(self.buffer) >= MAX_BUFFER_SIZE:
-                self.header(BAD_REQUEST)
-        except UnicodeError:
-            self.header(BAD_REQUEST)
-        except ConnectionResetError or BrokenPipeError:
-            logging.warning("No se pudo contactar al cliente")
+            self._feed(self.buffer.recv_into(self.s))
+        except (ConnectionResetError, BrokenPipeError):
+            logger.warning("No se pudo contactar al cliente")
             self.connected = False
+        except socket.timeout:
+            # El servidor pone un timeout de inactividad en el socket
+            logger.info("Closing idle connection...")
+            self.close()
+
+    def _feed(self, received: int):
+        """
+        Revisa los `received` bytes que se acaban de recibir del cliente.
+        Si no se recibió nada, el cliente cerró la conexión.
+        """
+        if received == 0:
+            self.close()
+        elif not self.buffer.isascii(received):
+            # Nada de lo recibido se va a atender
+            self.buffer.clear()
+            self.header(BAD_REQUEST)
+        elif len(self.buffer) >= MAX_BUFFER_SIZE:
+            self.header(BAD_REQUEST)
 
     def read_line(self):
         """
@@ -240,20 +820,521 @@ class Connection(object):
 
         Devuelve la línea sin el terminador ni espacios en blanco al inicio o final.
         """
-        while not EOL in self.buffer and self.connected:
+        while not self.buffer.has_line() and self.connected:
             self._recv()
-        if EOL in self.buffer:
-            response, self.buffer = self.buffer.split(EOL, 1)
-            return response.strip()
+        line = self.buffer.read_line()
+        if line is not None:
+            return line.decode("ascii").strip()
+
+    def handle_line(self, line: str):
+        """
+        Atiende una línea completa recibida del cliente.
+        """
+        if NEWLINE in line:
+            self.header(BAD_EOL)
+        elif len(line) > 0:
+            start = time.perf_counter()
+            if self.log is not None:
+                self.record = self.log.begin()
+            command = self.command_selector(line)
+            elapsed = time.perf_counter() - start
+            self.metrics.request(command, elapsed)
+            if self.tracer is not None:
+                self.tracer.add(command, start, elapsed)
+            if self.record is not None:
+                self._log_request(self.record, start)
+                self.record = None
+
+    def _log_request(self, record: dict, start: float):
+        """
+        Completa el registro de acceso del pedido que empezó a atenderse
+        en `start` y lo encola en el RequestLogger. Aquí la respuesta ya
+        está entera en las pendientes o enviada.
+
+        Para uso privado de la conexión.
+        """
+        record.setdefault("bytes", 0)
+        record["duration"] = round(time.perf_counter() - start, 6)
+        self.log.write(record)
 
     def handle(self):
         """
         Atiende eventos de la conexión hasta que termina.
+
+        Si el cliente envió varios pedidos juntos, se atienden todos los
+        que ya están completos en el buffer y sus respuestas se envían
+        juntas, en orden, antes de volver a esperar datos.
         """
-        line = ""
         while self.connected:
-            if NEWLINE in line:
-                self.header(BAD_EOL)
-            elif len(line) > 0:
-                self.command_selector(line)
-            line = self.read_line()
+            if self.profiler is not None:
+                self.profiler.check()
+            for line in self.buffer.read_lines():
+                if not self.connected:
+                    break
+                self.handle_line(line.decode("ascii").strip())
+            if self.connected:
+                self.flush()
+                self._recv()
+
+
+class Command(object):
+    """
+    Comando del protocolo: la función que lo atiende y las formas que
+    pueden tener sus argumentos.
+    """
+
+    def __init__(self, handler, *forms, variadic=False, fields=()):
+        """
+        Args:
+            handler: Función que atiende el comando; recibe la conexión y
+                los argumentos ya convertidos.
+            forms: Una tupla de conversores (p.ej. `(str, int, int)`) por
+                cada cantidad de argumentos que acepta el comando. Los
+                conversores lanzan ValueError si el argumento no es válido.
+            variadic (bool): Si es True, el comando acepta uno o más
+                argumentos, que el handler recibe juntos en una lista.
+            fields: Nombres con que se anotan los argumentos en el
+                registro de acceso, en orden.
+        """
+        self.handler = handler
+        self.forms = {len(form): form for form in forms}
+        self.variadic = variadic
+        self.fields = fields
+
+    def parse(self, args):
+        """
+        Convierte los argumentos recibidos según la forma que corresponde a
+        su cantidad.
+
+        Devuelve la lista de argumentos para el handler, o None si no son
+        válidos.
+        """
+        if self.variadic:
+            return [args] if args else None
+        form = self.forms.get(len(args))
+        if form is None:
+            return None
+        try:
+            return [convert(arg) for convert, arg in zip(form, args)]
+        except ValueError:
+            return None
+
+    def describe(self, record: dict, args):
+        """
+        Anota en el registro de acceso los argumentos ya convertidos. De
+        los comandos variádicos solo se anota cuántos argumentos recibió.
+        """
+        if self.variadic:
+            record[self.fields[0]] = len(args[0])
+        else:
+            record.update(zip(self.fields, args))
+
+
+# Comandos del protocolo. Para agregar uno basta con agregar el método que
+# lo atiende en Connection y registrarlo aquí.
+COMMANDS = {
+    "get_file_listing": Command(
+        Connection.get_file_listing, (), (int, int), fields=("offset", "count")
+    ),
+    "get_metadata": Command(Connection.get_metadata, (str,), fields=("file",)),
+    "get_metadata_multi": Command(
+        Connection.get_metadata_multi, variadic=True, fields=("files",)
+    ),
+    "get_slice": Command(
+        Connection.get_slice, (str, int, int), fields=("file", "offset", "size")
+    ),
+    "get_slice_raw": Command(
+        Connection.get_slice_raw, (str, int, int), fields=("file", "offset", "size")
+    ),
+    "get_checksum": Command(
+        Connection.get_checksum,
+        (str,),
+        (str, int, int),
+        fields=("file", "offset", "size"),
+    ),
+    "get_signatures": Command(
+        Connection.get_signatures, (str, int), fields=("file", "block_size")
+    ),
+    "set_compression": Command(Connection.set_compression, (str,), fields=("method",)),
+    "stats": Command(Connection.stats, ()),
+    "quit": Command(Connection.quit, ()),
+}
+
+
+class EventConnection(Connection):
+    """
+    Conexión no bloqueante, atendida por el loop de eventos del servidor.
+    Las respuestas se encolan y se envían cuando el socket está listo para
+    escribir, así un solo hilo puede atender muchas conexiones a la vez.
+    """
+
+    def __init__(self, socket: socket.socket, directory, wakeup=None, **kwargs):
+        """
+        Args:
+            wakeup: Función que se llama (desde otro hilo) con la conexión
+                cuando termina un cálculo del que espera una respuesta.
+            El resto, como en Connection.
+        """
+        super().__init__(socket, directory, **kwargs)
+        self.s.setblocking(False)
+        self.wakeup = wakeup
+        self.output = deque()
+        # Con límite de ancho de banda: bytes enviados en el turno actual,
+        # bytes ya reservados y momento en que se puede seguir enviando
+        self.turn = 0
+        self.prepaid = 0
+        self.resume_at = None
+        # Último momento en que el loop de eventos atendió la conexión
+        self.last_active = time.monotonic()
+
+    def close(self):
+        """
+        Marca la conexión como terminada. El socket se cierra recién
+        cuando el loop de eventos terminó de enviar la salida pendiente.
+        """
+        logger.info("Closing connection...")
+        self.connected = False
+
+    def _write(self, data: bytes):
+        """
+        Encola los bytes para enviarlos cuando el socket esté listo.
+        """
+        if data:
+            self.output.append(memoryview(data))
+            if self.record is not None:
+                count_bytes(self.record, len(data))
+
+    def _write_stream(self, chunks):
+        """
+        Encola el iterable, que se consume recién cuando el socket está
+        listo para escribir. Así solo hay un bloque en memoria por vez.
+        """
+        if self.record is not None:
+            chunks = counted_stream(chunks, self.record)
+        self.output.append(iter(chunks))
+
+    def _write_file(self, f, offset: int, size: int):
+        """
+        Encola el rango del archivo, que se envía con sendfile a medida
+        que el socket está listo para escribir.
+        """
+        if size > 0:
+            self.output.append(FileRange(f, offset, size))
+            if self.record is not None:
+                count_bytes(self.record, size)
+        else:
+            f.close()
+
+    def _write_deferred(self, deferred):
+        """
+        Encola la respuesta, que se envía recién cuando termine el cálculo.
+        Al terminar se avisa al loop de eventos con `wakeup`.
+        """
+        self.output.append(deferred)
+        if self.wakeup is not None:
+            deferred.future.add_done_callback(lambda future: self.wakeup(self))
+
+    @property
+    def waiting(self):
+        """
+        True si lo próximo a enviar es una respuesta que todavía se está
+        calculando.
+        """
+        return (
+            bool(self.output)
+            and isinstance(self.output[0], Deferred)
+            and not self.output[0].future.done()
+        )
+
+    @property
+    def finished(self):
+        """
+        True si la conexión terminó y no queda nada por enviar.
+        """
+        return not self.connected and not self.output
+
+    def on_readable(self):
+        """
+        Lee los datos disponibles y atiende todas las líneas completas
+        que haya en el buffer.
+        """
+        try:
+            received = self.buffer.recv_into(self.s)
+        except BlockingIOError:
+            return
+        except (ConnectionResetError, BrokenPipeError):
+            logger.warning("No se pudo contactar al cliente")
+            self.abort()
+            return
+        self._feed(received)
+        for line in self.buffer.read_lines():
+            if not self.connected:
+                break
+            self.handle_line(line.decode("ascii").strip())
+
+    def _log_request(self, record: dict, start: float):
+        """
+        Si la respuesta todavía no se envió entera, el registro de acceso
+        se encola detrás de ella, así cuenta los bytes que se producen al
+        enviarla y la duración llega hasta que termina de salir.
+
+        Para uso privado de la conexión.
+        """
+        if self.output:
+            self.output.append(AccessEntry(record, start))
+        else:
+            super()._log_request(record, start)
+
+    def _allow(self, size: int):
+        """
+        Devuelve cuántos de los próximos `size` bytes se pueden enviar ya.
+        Se reservan de a RATE_QUANTUM bytes del ancho de banda: si hay que
+        esperar para usarlos, o si la conexión ya envió RATE_QUANTUM bytes
+        en este turno, devuelve None y deja en `resume_at` cuándo seguir.
+        Como la reserva ya está hecha, la conexión queda en la cola detrás
+        de las que reservaron antes, igual que en Connection._throttle.
+
+        Para uso privado de la conexión.
+        """
+        if self.limiter is None or size == 0:
+            return size
+        if self.prepaid == 0:
+            self.prepaid = min(size, RATE_QUANTUM)
+            delay = self.limiter.reserve(self.prepaid)
+            if delay > 0 or self.turn >= RATE_QUANTUM:
+                # Le cede el turno a las demás conexiones con límite
+                self.resume_at = time.monotonic() + delay
+                return None
+        size = min(size, self.prepaid)
+        self.prepaid -= size
+        self.turn += size
+        return size
+
+    def on_writable(self):
+        """
+        Envía todo lo posible de la salida pendiente sin bloquear. Con
+        límite de ancho de banda se envía como mucho RATE_QUANTUM bytes por
+        llamada, y `resume_at` indica cuándo volver a llamarla.
+        """
+        self.turn = 0
+        self.resume_at = None
+        while self.output:
+            data = self.output[0]
+            if isinstance(data, FileRange):
+                allowed = self._allow(data.size)
+                if allowed is None:
+                    return
+                size = data.size
+                try:
+                    self._cork(True)
+                    with self.trace("send"):
+                        data.send(self.s, allowed)
+                except BlockingIOError:
+                    self.metrics.sent(size - data.size)
+                    return
+                except (ConnectionResetError, BrokenPipeError):
+                    logger.warning("No se pudo contactar al cliente")
+                    self.abort()
+                    return
+                except OSError as e:
+                    # Ya se envió el encabezado, no se puede avisar el error
+                    logger.error("Error in connection handling: %s", e)
+                    self.abort()
+                    return
+                self.metrics.sent(size - data.size)
+                if data.size == 0:
+                    self.output.popleft()
+                continue
+            if isinstance(data, Deferred):
+                if not data.future.done():
+                    return  # Se sigue cuando el loop reciba el aviso
+                try:
+                    rendered = self._render(data)
+                except Exception as e:
+                    logger.error("Error in connection handling: %s", e)
+                    self.abort()
+                    return
+                if data.record is not None:
+                    count_bytes(data.record, len(rendered))
+                self.output[0] = memoryview(rendered)
+                continue
+            if isinstance(data, AccessEntry):
+                # Ya se envió toda la respuesta del pedido
+                self.output.popleft()
+                Connection._log_request(self, data.record, data.start)
+                continue
+            if not isinstance(data, memoryview):
+                # Es un stream: se produce su siguiente fragmento
+                try:
+                    chunk = next(data)
+                except StopIteration:
+                    self.output.popleft()
+                    continue
+                except Exception as e:
+                    # Ya se envió el encabezado, no se puede avisar el error
+                    logger.error("Error in connection handling: %s", e)
+                    self.abort()
+                    return
+                self.output.appendleft(memoryview(chunk))
+                continue
+            size = 0
+            for data in self.output:
+                if not isinstance(data, memoryview) or size >= RATE_QUANTUM:
+                    break
+                size += len(data)
+            allowed = self._allow(size)
+            if allowed is None:
+                return
+            # Encabezado y respuesta salen juntos, en un mismo segmento
+            try:
+                with self.trace("send"):
+                    sent = send_vectored(self.s, self.output, allowed)
+                self.metrics.sent(sent)
+            except BlockingIOError:
+                return
+            except (ConnectionResetError, BrokenPipeError):
+                logger.warning("No se pudo contactar al cliente")
+                self.abort()
+                return
+        self._cork(False)
+
+    def abort(self):
+        """
+        Descarta la salida pendiente, el cliente ya no la va a recibir.
+        """
+        self.connected = False
+        for data in self.output:
+            if isinstance(data, FileRange):
+                data.f.close()
+        self.output.clear()
+
+
+def b64_stream(chunks):
+    """
+    Generador que codifica en base64 los bytes que produce `chunks`, de a
+    múltiplos de 3 bytes, así las partes concatenadas forman la
+    codificación de todo el contenido.
+    """
+    carry = b""
+    for chunk in chunks:
+        data = carry + chunk if carry else chunk
+        cut = len(data) - len(data) % 3
+        yield b64encode(data[:cut])
+        carry = bytes(data[cut:])
+    yield b64encode(carry)
+
+
+def count_bytes(record: dict, size: int):
+    """
+    Suma `size` bytes a la respuesta anotada en el registro de acceso.
+    """
+    record["bytes"] = record.get("bytes", 0) + size
+
+
+def counted_stream(chunks, record: dict):
+    """
+    Generador que deja pasar los fragmentos de `chunks`, sumando su tamaño
+    al registro de acceso a medida que se producen.
+    """
+    for chunk in chunks:
+        count_bytes(record, len(chunk))
+        yield chunk
+
+
+def compress_stream(chunks, method: str):
+    """
+    Generador que comprime con `method` los bytes que produce `chunks`.
+    """
+    comp = compressor(method)
+    for chunk in chunks:
+        data = comp.compress(chunk)
+        if data:
+            yield data
+    yield comp.flush()
+
+
+class Deferred(object):
+    """
+    Respuesta que se está calculando en otro hilo.
+    """
+
+    def __init__(self, future, render):
+        self.future = future
+        self.render = render
+        self.record = None  # Registro de acceso donde contar la respuesta
+
+
+class AccessEntry(object):
+    """
+    Marca en la salida de una EventConnection el fin de la respuesta de un
+    pedido que se anota en el registro de acceso.
+    """
+
+    def __init__(self, record: dict, start: float):
+        self.record = record
+        self.start = start
+
+
+def send_vectored(sock: socket.socket, buffers: deque, limit=None):
+    """
+    Envía con una sola llamada a sendmsg los fragmentos de bytes que hay al
+    principio de `buffers`, sin copiarlos a uno solo, y como mucho `limit`
+    bytes si se da. Saca de `buffers` lo que se envió completo y deja el
+    resto de lo enviado a medias.
+
+    Devuelve la cantidad de bytes enviados. Deja pasar las excepciones del
+    socket.
+    """
+    parts = []
+    total = 0
+    for data in buffers:
+        if not isinstance(data, (bytes, memoryview)) or len(parts) == IOV_MAX:
+            break
+        if limit is not None and total + len(data) > limit:
+            if limit > total:
+                parts.append(memoryview(data)[: limit - total])
+            break
+        parts.append(data)
+        total += len(data)
+    sent = sock.sendmsg(parts)
+    remaining = sent
+    for _ in parts:
+        data = buffers[0]
+        if len(data) > remaining:
+            if remaining > 0:
+                buffers[0] = memoryview(data)[remaining:]
+            break
+        remaining -= len(data)
+        buffers.popleft()
+    return sent
+
+
+class FileRange(object):
+    """
+    Rango de un archivo abierto que falta enviar por un socket no bloqueante.
+    """
+
+    def __init__(self, f, offset: int, size: int):
+        self.f = f
+        self.offset = offset
+        self.size = size
+
+    def send(self, sock: socket.socket, limit=None):
+        """
+        Envía con os.sendfile el resto del rango, o como mucho `limit`
+        bytes si se da, y cierra el archivo al terminar el rango.
+
+        Raises:
+            BlockingIOError: Si el socket no acepta más datos por ahora.
+            OSError: Si el archivo se achicó y ya no tiene los bytes del rango.
+        """
+        remaining = self.size if limit is None else min(limit, self.size)
+        while remaining > 0:
+            sent = os.sendfile(sock.fileno(), self.f.fileno(), self.offset, remaining)
+            if sent == 0:
+                raise OSError("el archivo se achicó mientras se lo enviaba")
+            self.offset += sent
+            self.size -= sent
+            remaining -= sent
+        if self.size == 0:
+            self.f.close()
@@ -9,13 +9,71 @@ DEFAULT_DIR = "testdata"
 DEFAULT_ADDR = "0.0.0.0"  # 0.0.0.0 representa todas las IPv4 del server
 DEFAULT_PORT = 19500
 MAX_BUFFER_SIZE = 2**32
+RECV_SIZE = 4096  # Bytes a leer del socket por llamada a recv
+OUTPUT_BUFFER_SIZE = 2**16  # Bytes de respuestas que se juntan antes de enviarlos
+IOV_MAX = 1024  # Máximo de fragmentos por llamada a sendmsg
+SLICE_BLOCK_SIZE = 3 * 2**16  # Bytes por bloque al enviar un slice (múltiplo de 3)
+BLOCK_CACHE_SIZE = 2**26  # Bytes del cache de bloques de archivos
+CHECKSUM_DIGEST_SIZE = 32  # Bytes del digest BLAKE2b de get_checksum
+CHECKSUM_READ_SIZE = 2**20  # Bytes que se leen por vez al calcular un checksum
+CHECKSUM_CACHE_ENTRIES = 4096  # Checksums que se guardan en el cache
+CHECKSUM_WORKERS = 2  # Hilos que calculan los checksums grandes
+CHECKSUM_OFFLOAD_SIZE = 2**20  # Bytes desde los que un checksum va a otro hilo
+SIGNATURE_DIGEST_SIZE = 16  # Bytes del hash fuerte de cada bloque en get_signatures
+ADLER_MOD = 65521  # Módulo de adler32, la suma débil de cada bloque
+DELTA_BLOCK_SIZE = 2**13  # Bytes por bloque de Client.retrieve_delta
+MIN_SIGNATURE_BLOCK = 2**9  # Mínimo tamaño de bloque de get_signatures
+MAX_SIGNATURE_BLOCK = 2**24  # Máximo tamaño de bloque de get_signatures
+ZLIB_LEVEL = 6  # Nivel de compresión de zlib en get_slice
+LZMA_PRESET = 1  # Preset de lzma en get_slice (los más altos son muy lentos)
+COMPRESSION_MIN_SIZE = 512  # Slices más chicos se envían sin comprimir
+COMPRESSION_SAMPLE_SIZE = 2**16  # Bytes que se prueban antes de comprimir un slice
+COMPRESSION_MAX_RATIO = 0.9  # Si la muestra no baja de esto, no se comprime
+RATE_QUANTUM = 2**16  # Bytes que envía por turno una conexión con límite
+RATE_SMALL_WRITE = 2**12  # Escrituras más chicas no esperan al límite
+RATE_BURST_TIME = 0.1  # Segundos de envío que se permiten de golpe
+MMAP_IDLE_TIMEOUT = 30  # Segundos sin uso antes de liberar un archivo mapeado
+SELECT_TIMEOUT = 1  # Segundos que el loop de eventos espera sin novedades
+DRAIN_TIMEOUT = 10  # Segundos que se espera a las conexiones al terminar
+WORKER_THREADS = 64  # Hilos que atienden conexiones en el modo threads
+ACCEPT_QUEUE_SIZE = 64  # Conexiones aceptadas que pueden esperar un hilo libre
+LISTEN_BACKLOG = 128  # Conexiones que el kernel encola hasta el accept
+MAX_CONNECTIONS = 1024  # Conexiones abiertas como máximo por proceso
+EVENT_MAX_CONNECTIONS = 10000  # Lo mismo en el modo events
+RESERVED_FDS = 64  # Descriptores que no se usan para conexiones (logs, mapeos)
+IDLE_TIMEOUT = 300  # Segundos sin actividad antes de cerrar una conexión
+METRICS_ADDR = "127.0.0.1"  # Dirección del endpoint HTTP /metrics
+REQUEST_LOG_SAMPLE = 1  # Se anota uno de cada tantos pedidos (0 para ninguno)
+ACCESS_LOG_MAX_BYTES = 2**26  # Tamaño al que se rota el registro de acceso
+ACCESS_LOG_BACKUPS = 5  # Registros de acceso rotados que se guardan
+TRACE_BUFFER_SIZE = 4096  # Eventos de tracing que se guardan por hilo
+TRACE_DUMP_EVENTS = 200  # Últimos eventos por hilo que se vuelcan
+SAMPLE_INTERVAL = 0.005  # Segundos entre muestras de pilas del perfilador
+PROFILE_DUMP_LINES = 40  # Funciones que se vuelcan del cProfile
+# Límites en segundos de los buckets del histograma de latencia por comando
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+RESPAWN_DELAY = 1  # Segundos mínimos entre reinicios de un worker
+POLL_INTERVAL = 1  # Segundos que vale un dato del cache de metadatos sin inotify
+LISTING_PAGE_SIZE = 1000  # Nombres por página del listado en el cliente
+METADATA_BATCH_SIZE = 1000  # Nombres por pedido de Client.get_metadata_many
+PIPELINE_WINDOW = 32  # Pedidos en vuelo que mantiene Client.pipeline
+PARALLEL_CONNECTIONS = 4  # Conexiones de Client.retrieve_parallel
+PARALLEL_RANGE_SIZE = 2**22  # Bytes por rango de Client.retrieve_parallel
+MAX_RETRIES = 3  # Intentos por rango antes de darlo por fallido
+JOURNAL_SUFFIX = ".hftp-journal"  # Registro de rangos de una descarga a retomar
+POOL_CONNECTIONS = 8  # Conexiones por server del pool de aclient
+POOL_CONCURRENCY = 256  # Pedidos en curso a la vez en un pool de aclient
+REQUEST_TIMEOUT = 30  # Segundos por pedido de aclient, contando reintentos
+REQUEST_ATTEMPTS = 3  # Intentos por pedido de aclient si falla la conexión
 
 EOL = "\r\n"
+EOL_BYTES = EOL.encode("ascii")
 NEWLINE = "\n"
 
 CODE_OK = 0
 BAD_EOL = 100
 BAD_REQUEST = 101
+SERVER_BUSY = 102
 INTERNAL_ERROR = 199
 INVALID_COMMAND = 200
 INVALID_ARGUMENTS = 201
@@ -28,6 +86,7 @@ error_messages = {
     # 1xx: Errores fatales (no se pueden atender más pedidos)
     BAD_EOL: "BAD EOL",
     BAD_REQUEST: "BAD REQUEST",
+    SERVER_BUSY: "SERVER BUSY",
     INTERNAL_ERROR: "INTERNAL SERVER ERROR",
     # 2xx: Errores no fatales (no se pudo atender este pedido)
     INVALID_COMMAND: "NO SUCH COMMAND",
@@ -0,0 +1,182 @@
+# encoding: utf-8
+
+"""
+Separación en líneas de los datos que se reciben por un socket, común al
+servidor (Connection) y al cliente (Client).
+"""
+
+from constants import *
+
+
+class LineBuffer(object):
+    """
+    Buffer de recepción de un protocolo de líneas terminadas en EOL, que
+    usan tanto el servidor como el cliente.
+
+    Los datos se reciben con recv_into directamente sobre un bytearray, sin
+    crear un objeto nuevo por cada recv ni concatenar. Se recuerda hasta
+    dónde ya se buscó el terminador, así cada byte se revisa una sola vez
+    aunque la línea llegue en muchos pedazos. Los bytes consumidos no se
+    mueven de a uno: el espacio se recupera cuando el buffer queda vacío o
+    cuando hace falta lugar para recibir más.
+    """
+
+    def __init__(self, capacity=RECV_SIZE, eol=EOL_BYTES):
+        """
+        Args:
+            capacity (int): Tamaño inicial del bytearray.
+            eol (bytes): Terminador de línea.
+        """
+        self.data = bytearray(capacity)
+        self.eol = eol
+        self.start = 0  # Primer byte sin consumir
+        self.end = 0  # Fin de los bytes recibidos
+        self.scan = 0  # Hasta dónde ya se buscó el terminador
+        self.line_end = -1  # Posición del próximo terminador, o -1
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, size: int):
+        """
+        Se asegura de que haya lugar para recibir `size` bytes más, moviendo
+        los bytes pendientes al principio o agrandando el bytearray.
+        """
+        if self.end + size <= len(self.data):
+            return
+        if self.start > 0:
+            pending = self.end - self.start
+            self.data[:pending] = self.data[self.start : self.end]
+            self.scan -= self.start
+            if self.line_end >= 0:
+                self.line_end -= self.start
+            self.start, self.end = 0, pending
+        missing = self.end + size - len(self.data)
+        if missing > 0:
+            # Se al menos duplica, así agrandarlo cuesta O(1) amortizado
+            self.data.extend(bytes(max(missing, len(self.data))))
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        """
+        Recibe hasta `size` bytes del socket al final del buffer.
+
+        Devuelve la cantidad de bytes recibidos (0 si se cerró la conexión).
+        Deja pasar las excepciones del socket.
+        """
+        self.reserve(size)
+        with memoryview(self.data) as view:
+            received = sock.recv_into(view[self.end : self.end + size])
+        self.end += received
+        return received
+
+    def isascii(self, size: int):
+        """
+        True si los últimos `size` bytes recibidos son ASCII.
+        """
+        return self.data[self.end - size : self.end].isascii()
+
+    def find_eol(self):
+        """
+        Devuelve la posición en `data` del próximo terminador, o -1 si
+        todavía no llegó. Solo se revisan los bytes nuevos.
+        """
+        if self.line_end < 0:
+            index = self.data.find(self.eol, self.scan, self.end)
+            if index < 0:
+                # El final puede ser el comienzo de un terminador partido
+                self.scan = max(self.start, self.end - len(self.eol) + 1)
+            else:
+                self.line_end = index
+        return self.line_end
+
+    def has_line(self):
+        """
+        True si hay una línea completa en el buffer.
+        """
+        return self.find_eol() >= 0
+
+    def read_line(self):
+        """
+        Saca la próxima línea completa del buffer.
+
+        Devuelve la línea como bytearray, sin el terminador, o None si
+        todavía no llegó completa.
+        """
+        # Es el camino de cada pedido: se evitan llamadas que no hacen falta
+        index = self.line_end
+        if index < 0:
+            index = self.find_eol()
+            if index < 0:
+                return None
+        line = self.data[self.start : index]
+        self.consume(index + len(self.eol) - self.start)
+        return line
+
+    def read_lines(self):
+        """
+        Saca todas las líneas completas del buffer de una vez, con una sola
+        búsqueda del último terminador y un solo split, que para muchas
+        líneas cortas (pedidos en pipeline) es mucho más barato que sacarlas
+        de a una.
+
+        Devuelve la lista de líneas (bytearray, sin el terminador), que
+        está vacía si todavía no llegó ninguna completa.
+        """
+        last = self.data.rfind(self.eol, self.scan, self.end)
+        if last < 0:
+            self.scan = max(self.start, self.end - len(self.eol) + 1)
+            return []
+        # Las líneas se copian a propósito: separarlas en slices de un
+        # memoryview obliga a buscar cada terminador desde Python, que para
+        # pedidos cortos es bastante más lento que copiarlos, y los
+        # memoryview vivos impiden agrandar o mover el bytearray en reserve
+        lines = self.data[self.start : last].split(self.eol)
+        self.consume(last + len(self.eol) - self.start)
+        return lines
+
+    def read_chunk(self):
+        """
+        Saca lo que haya llegado de la línea actual, para procesar líneas
+        muy largas a medida que llegan.
+
+        Devuelve un par (datos, completa). Si ya llegó el terminador, los
+        datos son el resto de la línea y el terminador se descarta; si no,
+        es todo lo recibido salvo un posible comienzo del terminador.
+        """
+        index = self.find_eol()
+        if index >= 0:
+            data = self.take(index - self.start)
+            self.consume(len(self.eol))
+            return data, True
+        return self.take(self.scan - self.start), False
+
+    def take(self, size: int):
+        """
+        Saca y devuelve como bytes hasta `size` bytes del principio del buffer.
+        """
+        size = min(size, len(self))
+        with memoryview(self.data) as view:
+            data = bytes(view[self.start : self.start + size])
+        self.consume(size)
+        return data
+
+    def consume(self, size: int):
+        """
+        Descarta `size` bytes del principio del buffer.
+        """
+        self.start += size
+        if self.start == self.end:
+            # Vacío: se vuelve a recibir desde el principio, sin mover nada
+            self.start = self.end = self.scan = 0
+            self.line_end = -1
+            return
+        if self.scan < self.start:
+            self.scan = self.start
+        if self.line_end < self.start:
+            self.line_end = -1
+
+    def clear(self):
+        """
+        Descarta todo el contenido del buffer.
+        """
+        self.consume(len(self))
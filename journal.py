@@ -0,0 +1,95 @@
+# encoding: utf-8
+
+import json
+import os
+from constants import *
+
+
+class RangeJournal(object):
+    """
+    Registro en disco de los rangos de un archivo que ya se bajaron, para
+    poder retomar una descarga interrumpida sin empezar de cero. Se guarda
+    junto al archivo, con el sufijo JOURNAL_SUFFIX.
+    """
+
+    def __init__(self, filename: str, size: int, done=None):
+        """
+        Args:
+            filename (str): Archivo local que se está bajando.
+            size (int): Tamaño total del archivo en el server.
+            done: Lista de pares [inicio, fin) ya bajados, ordenados y disjuntos.
+        """
+        self.filename = filename
+        self.path = filename + JOURNAL_SUFFIX
+        self.size = size
+        self.done = done or []
+
+    @classmethod
+    def load(cls, filename: str):
+        """
+        Lee el registro de la descarga de `filename`.
+
+        Devuelve el registro, o None si no existe o está dañado.
+        """
+        try:
+            with open(filename + JOURNAL_SUFFIX) as f:
+                data = json.load(f)
+            return cls(filename, data["size"], [tuple(r) for r in data["done"]])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self):
+        """
+        Escribe el registro en disco. Se escribe en un archivo temporal y
+        se lo renombra, así un corte a mitad de camino no lo daña.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"size": self.size, "done": self.done}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        """
+        Borra el registro, una vez que la descarga se completó.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def add(self, start: int, length: int):
+        """
+        Marca como bajado el rango [start, start + length) y guarda el registro.
+        """
+        merged = []
+        new_start, new_end = start, start + length
+        for s, e in self.done:
+            if e < new_start or s > new_end:
+                merged.append((s, e))
+            else:
+                # Se superpone o es contiguo: se une con el nuevo rango
+                new_start, new_end = min(s, new_start), max(e, new_end)
+        merged.append((new_start, new_end))
+        self.done = sorted(merged)
+        self.save()
+
+    def missing(self, range_size: int):
+        """
+        Devuelve los rangos que faltan bajar, como pares (inicio, largo)
+        de hasta `range_size` bytes.
+        """
+        ranges = []
+        position = 0
+        for s, e in self.done + [(self.size, self.size)]:
+            for start in range(position, s, range_size):
+                ranges.append((start, min(range_size, s - start)))
+            position = max(position, e)
+        return ranges
+
+    def complete(self):
+        """
+        True si ya se bajó el archivo completo.
+        """
+        return self.done == [(0, self.size)] or self.size == 0
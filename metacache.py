@@ -0,0 +1,327 @@
+# encoding: utf-8
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import stat
+import struct
+import threading
+import time
+from collections import namedtuple
+from constants import *
+
+# Datos de un archivo que necesitan los pedidos. mtime en nanosegundos.
+FileInfo = namedtuple("FileInfo", ["size", "mtime", "inode"])
+
+# Constantes de inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+# En el directorio padre solo interesa si el directorio servido se borra,
+# se mueve o aparece otro con su nombre
+PARENT_MASK = (
+    IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Inotify(object):
+    """
+    Vigila un directorio con inotify, a través de la libc con ctypes.
+    El descriptor es no bloqueante: read_events() devuelve solo los
+    eventos que ya ocurrieron.
+    """
+
+    def __init__(self):
+        """
+        Raises:
+            OSError: Si el sistema no soporta inotify.
+        """
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "no se encontró la libc")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify no disponible")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 falló")
+
+    def add_watch(self, path: str, mask=WATCH_MASK):
+        """
+        Empieza a vigilar `path`. Devuelve el identificador del watch.
+
+        Raises:
+            OSError: Si no se puede vigilar el directorio (p.ej. no existe).
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch falló", path)
+        return wd
+
+    def read_events(self):
+        """
+        Devuelve la lista de eventos pendientes, como tuplas
+        (wd, mask, nombre).
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 2**16)
+            except BlockingIOError:
+                return events
+            position = 0
+            while position < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, position)
+                position += EVENT_HEADER.size
+                name = data[position : position + length].rstrip(b"\0")
+                position += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MetadataCache(object):
+    """
+    Cache de los archivos del directorio compartido (nombre, tamaño, mtime
+    e inodo), compartido por todas las conexiones, para no hacer varios
+    stat por pedido ni un listdir por cada get_file_listing.
+
+    Se mantiene al día con inotify: antes de cada consulta se leen los
+    eventos pendientes (una sola llamada al sistema) y se invalidan los
+    archivos modificados, que se vuelven a leer recién cuando se los pide.
+    También se vigila el directorio padre: si el directorio servido se borra
+    mientras hay archivos suyos abiertos (o mapeados en memoria), inotify
+    no avisa hasta que se cierran, pero el padre sí ve desaparecer el nombre.
+
+    Si inotify no está disponible o no se puede vigilar el directorio
+    (p.ej. se agotó max_user_watches), se revisa el mtime del directorio en
+    cada consulta y cada archivo se vuelve a leer a los `poll_interval`
+    segundos.
+    """
+
+    def __init__(self, directory: str, poll_interval=POLL_INTERVAL):
+        """
+        Args:
+            directory (str): Directorio compartido.
+            poll_interval (float): Segundos que vale un dato sin inotify.
+        """
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.names = set()  # Todo lo que hay en el directorio
+        self.sorted_names = None  # `names` ordenados, o None si cambiaron
+        self.entries = {}  # nombre -> (FileInfo, momento en que se leyó)
+        self.hits = 0
+        self.misses = 0
+        self.rescans = 0
+        try:
+            self.inotify = Inotify()
+        except OSError:
+            self.inotify = None
+        self.wd = None
+        self.parent_wd = None
+        path = os.path.abspath(directory)
+        self.parent = os.path.dirname(path)
+        self.basename = os.path.basename(path)
+        self.dir_key = None
+        self.rescan()
+
+    def rescan(self):
+        """
+        Vuelve a leer el contenido del directorio. Los datos de cada
+        archivo se leen recién cuando se los pide.
+        """
+        self.rescans += 1
+        self.entries.clear()
+        self.sorted_names = None
+        if self.inotify is not None:
+            # Se vigila antes de leer, así no se pierden cambios intermedios
+            try:
+                self.wd = self.inotify.add_watch(self.directory)
+            except OSError:
+                self.wd = None
+            self.parent_wd = None
+            if self.wd is not None:
+                try:
+                    self.parent_wd = self.inotify.add_watch(self.parent, PARENT_MASK)
+                except OSError:
+                    pass  # Igual se ven los cambios dentro del directorio
+        try:
+            st = os.stat(self.directory)
+            self.dir_key = (st.st_ino, st.st_mtime_ns)
+            with os.scandir(self.directory) as it:
+                self.names = {entry.name for entry in it}
+        except OSError:
+            self.dir_key = None
+            self.names = set()
+
+    def refresh(self):
+        """
+        Aplica los cambios del directorio desde la última consulta.
+        Se llama con el lock tomado.
+        """
+        if self.wd is None:
+            # Sin inotify, o sin poder vigilar el directorio: se revisa su
+            # mtime. Si cambió, rescan() también reintenta vigilarlo.
+            try:
+                st = os.stat(self.directory)
+                dir_key = (st.st_ino, st.st_mtime_ns)
+            except OSError:
+                dir_key = None
+            if dir_key != self.dir_key:
+                self.rescan()
+            return
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Se perdieron eventos, no se puede saber qué cambió
+                self.rescan()
+            elif wd == self.parent_wd and wd != self.wd:
+                if name == self.basename or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # Se borró, movió o reemplazó el directorio servido
+                    self.rescan()
+            elif wd != self.wd:
+                continue  # Evento de un directorio que ya no se vigila
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # El directorio se borró o se movió, quizás haya otro en su lugar
+                self.rescan()
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.names.discard(name)
+                self.entries.pop(name, None)
+                self.sorted_names = None
+            elif name:
+                if name not in self.names:
+                    self.names.add(name)
+                    self.sorted_names = None
+                self.entries.pop(name, None)
+
+    def lookup(self, filename: str):
+        """
+        Devuelve el FileInfo del archivo regular `filename`, o None si no
+        existe en el directorio.
+        """
+        with self.lock:
+            self.refresh()
+            return self._lookup(filename)
+
+    def lookup_many(self, filenames):
+        """
+        Como lookup, para varios archivos a la vez: se toma el lock y se
+        aplican los cambios del directorio una sola vez para todos.
+
+        Devuelve la lista de FileInfo (o None), en el orden de `filenames`.
+        """
+        with self.lock:
+            self.refresh()
+            return [self._lookup(filename) for filename in filenames]
+
+    def _lookup(self, filename: str):
+        """
+        Busca el archivo en el cache, o lo lee si no está. Se llama con el
+        lock tomado.
+        """
+        if filename not in self.names:
+            self.hits += 1
+            return None
+        cached = self.entries.get(filename)
+        if cached is not None and (
+            self.wd is not None or time.monotonic() - cached[1] < self.poll_interval
+        ):
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        try:
+            st = os.stat(os.path.join(self.directory, filename))
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            info = None
+        else:
+            info = FileInfo(st.st_size, st.st_mtime_ns, st.st_ino)
+        self.entries[filename] = (info, time.monotonic())
+        return info
+
+    def listing(self, offset=0, count=None):
+        """
+        Devuelve los nombres de lo que hay en el directorio, en orden
+        alfabético, a partir del número `offset` y hasta `count` nombres
+        (todos si es None). El orden estable permite paginar el listado.
+
+        La lista ordenada se guarda hasta que el directorio cambia, así
+        pedir cada página no cuesta ordenar todo de nuevo.
+        """
+        with self.lock:
+            self.refresh()
+            self.hits += 1
+            if self.sorted_names is None:
+                self.sorted_names = tuple(sorted(self.names))
+            if count is None:
+                return self.sorted_names[offset:]
+            return self.sorted_names[offset : offset + count]
+
+    def stats(self):
+        """
+        Devuelve los contadores del cache.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "rescans": self.rescans,
+                "entries": len(self.names),
+                "inotify": self.wd is not None,
+            }
+
+    def close(self):
+        """
+        Libera el descriptor de inotify. El cache se puede seguir usando,
+        revisando el mtime del directorio como si no hubiera inotify.
+        """
+        with self.lock:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+                self.wd = self.parent_wd = None
+
+
+# Caches de los directorios que sirven las conexiones creadas sin uno propio
+shared_caches = {}
+shared_lock = threading.Lock()
+
+
+def shared_cache(directory: str):
+    """
+    Devuelve el MetadataCache de `directory` que comparten las conexiones
+    creadas sin uno propio, creándolo la primera vez. Así no se abre un
+    descriptor de inotify por conexión.
+    """
+    path = os.path.abspath(directory)
+    with shared_lock:
+        cache = shared_caches.get(path)
+        if cache is None:
+            cache = shared_caches[path] = MetadataCache(directory)
+        return cache
@@ -0,0 +1,230 @@
+# encoding: utf-8
+
+import bisect
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from constants import *
+
+# Contadores de los stats() de caches y pools; el resto son valores actuales
+SOURCE_COUNTERS = ("hits", "misses", "evictions", "rescans")
+
+
+class Shard(object):
+    """
+    Contadores de un solo hilo. Solo los modifica el hilo dueño, así
+    registrar un dato no necesita locks; el resto solo los lee.
+    """
+
+    def __init__(self):
+        self.requests = defaultdict(int)  # comando -> pedidos
+        self.codes = defaultdict(int)  # código -> respuestas
+        self.latency = {}  # comando -> cantidades por bucket de LATENCY_BUCKETS
+        self.latency_sum = defaultdict(float)  # comando -> segundos totales
+        self.bytes_sent = 0
+        self.opened = 0
+        self.closed = 0
+        self.rejected = 0
+
+
+class Metrics(object):
+    """
+    Métricas del servidor: pedidos y latencias por comando, respuestas por
+    código, bytes enviados y conexiones, compartidas por todas las
+    conexiones del proceso.
+
+    Cada hilo anota en su propio Shard, sin locks ni contención entre
+    hilos; render() suma los de todos los hilos al pedir las métricas.
+    También se publican los contadores de los caches registrados con
+    register().
+    """
+
+    def __init__(self):
+        self.shards = []
+        self.lock = threading.Lock()  # Solo para agregar shards y fuentes
+        self.local = threading.local()
+        self.sources = []  # Pares (nombre, cache o pool con stats())
+        self.started = time.time()
+
+    def shard(self):
+        """
+        Devuelve el Shard del hilo actual, creándolo si hace falta.
+        """
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def register(self, name: str, source):
+        """
+        Agrega a las métricas los contadores de `source`, un cache o pool
+        con un método stats() que devuelve un diccionario de números. Se
+        publican como hftp_<name>_<contador>.
+        """
+        with self.lock:
+            self.sources.append((name, source))
+
+    def request(self, command: str, elapsed: float):
+        """
+        Anota un pedido de `command` que tardó `elapsed` segundos en
+        atenderse.
+        """
+        shard = self.shard()
+        shard.requests[command] += 1
+        buckets = shard.latency.get(command)
+        if buckets is None:
+            buckets = shard.latency[command] = [0] * (len(LATENCY_BUCKETS) + 1)
+        buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        shard.latency_sum[command] += elapsed
+
+    def response(self, code: int):
+        """
+        Anota una respuesta con código `code`.
+        """
+        self.shard().codes[code] += 1
+
+    def sent(self, size: int):
+        """
+        Anota `size` bytes enviados a un cliente.
+        """
+        self.shard().bytes_sent += size
+
+    def opened(self):
+        """
+        Anota una conexión nueva.
+        """
+        self.shard().opened += 1
+
+    def closed(self):
+        """
+        Anota una conexión terminada.
+        """
+        self.shard().closed += 1
+
+    def rejected(self):
+        """
+        Anota una conexión rechazada por falta de lugar.
+        """
+        self.shard().rejected += 1
+
+    def collect(self):
+        """
+        Suma los Shard de todos los hilos.
+
+        Devuelve un Shard con los totales.
+        """
+        with self.lock:
+            shards = list(self.shards)
+        total = Shard()
+        for shard in shards:
+            # Se copian primero: el hilo dueño puede estar agregando claves
+            for command, count in dict(shard.requests).items():
+                total.requests[command] += count
+            for code, count in dict(shard.codes).items():
+                total.codes[code] += count
+            for command, buckets in dict(shard.latency).items():
+                summed = total.latency.setdefault(command, [0] * len(buckets))
+                for i, count in enumerate(list(buckets)):
+                    summed[i] += count
+            for command, seconds in dict(shard.latency_sum).items():
+                total.latency_sum[command] += seconds
+            total.bytes_sent += shard.bytes_sent
+            total.opened += shard.opened
+            total.closed += shard.closed
+            total.rejected += shard.rejected
+        return total
+
+    def render(self):
+        """
+        Devuelve las métricas en el formato de texto de Prometheus, como
+        lista de líneas.
+        """
+        total = self.collect()
+        lines = [
+            "# TYPE hftp_requests_total counter",
+        ]
+        for command, count in sorted(total.requests.items()):
+            lines.append(f'hftp_requests_total{{command="{command}"}} {count}')
+        lines.append("# TYPE hftp_responses_total counter")
+        for code, count in sorted(total.codes.items()):
+            lines.append(
+                f'hftp_responses_total{{code="{code}",'
+                f'message="{error_messages[code]}"}} {count}'
+            )
+        lines.append("# TYPE hftp_request_duration_seconds histogram")
+        for command, buckets in sorted(total.latency.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                lines.append(
+                    f'hftp_request_duration_seconds_bucket{{command="{command}",'
+                    f'le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'hftp_request_duration_seconds_sum{{command="{command}"}} '
+                f"{total.latency_sum[command]:.6f}"
+            )
+            lines.append(
+                f'hftp_request_duration_seconds_count{{command="{command}"}} '
+                f"{cumulative}"
+            )
+        lines += [
+            "# TYPE hftp_sent_bytes_total counter",
+            f"hftp_sent_bytes_total {total.bytes_sent}",
+            "# TYPE hftp_connections_total counter",
+            f"hftp_connections_total {total.opened}",
+            "# TYPE hftp_connections_active gauge",
+            f"hftp_connections_active {total.opened - total.closed}",
+            "# TYPE hftp_connections_rejected_total counter",
+            f"hftp_connections_rejected_total {total.rejected}",
+            "# TYPE hftp_start_time_seconds gauge",
+            f"hftp_start_time_seconds {self.started:.0f}",
+        ]
+        with self.lock:
+            sources = list(self.sources)
+        for name, source in sources:
+            for key, value in sorted(source.stats().items()):
+                if key in SOURCE_COUNTERS:
+                    series, kind = f"hftp_{name}_{key}_total", "counter"
+                else:
+                    series, kind = f"hftp_{name}_{key}", "gauge"
+                lines += [f"# TYPE {series} {kind}", f"{series} {int(value)}"]
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Atiende GET /metrics con las métricas del servidor.
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = ("\n".join(self.server.metrics.render()) + "\n").encode("ascii")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Los pedidos de métricas no se anotan
+
+
+def serve_metrics(metrics: Metrics, addr: str, port: int):
+    """
+    Atiende el endpoint HTTP /metrics en la dirección y puerto dados, desde
+    un hilo aparte.
+
+    Devuelve el servidor HTTP, que se detiene con shutdown().
+    """
+    httpd = ThreadingHTTPServer((addr, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.metrics = metrics
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
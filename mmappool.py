@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+import mmap
+import os
+import threading
+import time
+from constants import *
+
+
+class MappedFile(object):
+    """
+    Una versión de un archivo mapeada en memoria de solo lectura.
+    `view` es un memoryview sobre el mapeo: sus slices no copian datos.
+    """
+
+    def __init__(self, filepath: str):
+        with open(filepath, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.map)
+            else:
+                # No se puede mapear un archivo vacío
+                self.map = None
+                self.view = memoryview(b"")
+        self.refs = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        """
+        Libera el mapeo. Si todavía quedan slices de `view` en uso, el
+        mapeo se libera recién cuando se descarte el último.
+        """
+        try:
+            self.view.release()
+            if self.map is not None:
+                self.map.close()
+        except BufferError:
+            pass
+
+
+class MmapPool(object):
+    """
+    Mapeos de solo lectura de los archivos servidos, compartidos por todas
+    las conexiones. Cada versión de un archivo (inodo, tamaño y mtime) se
+    mapea una sola vez; se cuentan las referencias y los mapeos sin uso durante
+    `idle_timeout` segundos se liberan.
+
+    Cuidado: si un archivo mapeado se trunca mientras se lo lee, el proceso
+    recibe SIGBUS. Solo conviene usarlo si los archivos servidos se
+    reemplazan (rename) en vez de reescribirse en el lugar.
+    """
+
+    def __init__(self, idle_timeout=MMAP_IDLE_TIMEOUT):
+        """
+        Args:
+            idle_timeout (float): Segundos sin uso antes de liberar un mapeo.
+        """
+        self.idle_timeout = idle_timeout
+        self.maps = {}  # (inodo, tamaño, mtime) -> MappedFile
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, filepath: str, info):
+        """
+        Devuelve el MappedFile de la versión `info` del archivo, mapeándolo
+        si hace falta. Hay que devolverlo con release() al terminar.
+
+        Raises:
+            OSError: Si no se puede abrir o mapear el archivo.
+        """
+        key = (info.inode, info.size, info.mtime)
+        with self.lock:
+            mapped = self.maps.get(key)
+            if mapped is None:
+                self.misses += 1
+                mapped = MappedFile(filepath)
+                self.maps[key] = mapped
+            else:
+                self.hits += 1
+            mapped.refs += 1
+            return mapped
+
+    def release(self, mapped: MappedFile):
+        """
+        Devuelve un MappedFile obtenido con acquire().
+        """
+        with self.lock:
+            mapped.refs -= 1
+            mapped.last_used = time.monotonic()
+            self.sweep()
+
+    def sweep(self):
+        """
+        Libera los mapeos sin uso hace más de `idle_timeout` segundos. Para
+        no recorrer todos los mapeos en cada pedido, se hace como mucho una
+        vez por segundo. Se llama con el lock tomado.
+        """
+        now = time.monotonic()
+        if now - self.last_sweep < 1:
+            return
+        self.last_sweep = now
+        for key, mapped in list(self.maps.items()):
+            if mapped.refs == 0 and now - mapped.last_used > self.idle_timeout:
+                del self.maps[key]
+                mapped.close()
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Devuelve los contadores del pool.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "maps": len(self.maps),
+            }
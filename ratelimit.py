@@ -0,0 +1,95 @@
+# encoding: utf-8
+
+import threading
+import time
+from constants import *
+
+
+class TokenBucket(object):
+    """
+    Límite de ancho de banda de `rate` bytes por segundo, con ráfagas de
+    hasta `burst` bytes. Se puede compartir entre hilos.
+
+    Los bytes se reservan antes de enviarlos y el saldo puede quedar
+    negativo: quien reserva espera el tiempo que tarda en saldarse su
+    deuda. Como cada reserva se pone en la cola detrás de las anteriores,
+    las conexiones que envían de a RATE_QUANTUM bytes se turnan y se
+    reparten el ancho de banda en partes iguales.
+    """
+
+    def __init__(self, rate: int, burst=None):
+        """
+        Args:
+            rate (int): Bytes por segundo.
+            burst (int): Bytes que se pueden enviar de golpe luego de un
+                rato sin enviar. Por defecto, lo que se envía en
+                RATE_BURST_TIME segundos, y al menos RATE_QUANTUM.
+        """
+        assert rate > 0
+        self.rate = rate
+        if burst is None:
+            burst = max(int(rate * RATE_BURST_TIME), RATE_QUANTUM)
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """
+        Suma los tokens acumulados desde la última vez, hasta `burst`.
+
+        Se llama con el lock tomado.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, size: int, slack=0):
+        """
+        Descuenta `size` bytes y devuelve los segundos que hay que esperar
+        antes de enviarlos. Con `slack` se toleran esos bytes de deuda sin
+        esperar.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= size
+            return max(0.0, -self.tokens - slack) / self.rate
+
+
+class RateLimiter(object):
+    """
+    Límites de ancho de banda de una conexión: uno propio y uno global,
+    compartido por todas las conexiones del proceso. Cualquiera de los dos
+    puede faltar.
+
+    Las escrituras de menos de RATE_SMALL_WRITE bytes (encabezados,
+    metadatos) se descuentan pero no esperan mientras la deuda no supere
+    una ráfaga, así las respuestas chicas no quedan detrás de las
+    descargas grandes.
+    """
+
+    def __init__(self, rate=0, shared=None):
+        """
+        Args:
+            rate (int): Bytes por segundo de la conexión (0 sin límite).
+            shared (TokenBucket): Límite global, o None.
+        """
+        self.buckets = [shared] if shared is not None else []
+        if rate > 0:
+            self.buckets.append(TokenBucket(rate))
+
+    def _slack(self, bucket, size: int):
+        """
+        Deuda que se tolera sin esperar para una escritura de `size` bytes.
+        """
+        return bucket.burst if size < RATE_SMALL_WRITE else 0
+
+    def reserve(self, size: int):
+        """
+        Descuenta `size` bytes de todos los límites y devuelve los segundos
+        que hay que esperar antes de enviarlos.
+        """
+        delay = 0.0
+        for bucket in self.buckets:
+            delay = max(delay, bucket.reserve(size, self._slack(bucket, size)))
+        return delay
@@ -0,0 +1,124 @@
+# encoding: utf-8
+
+import datetime
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from constants import *
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que encola los registros tal cual, sin armar el mensaje:
+    el texto (o el JSON) se arma recién en el hilo que los escribe.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatea los registros cuyo mensaje es un diccionario como una línea
+    JSON, agregando el momento del registro.
+    """
+
+    def format(self, record):
+        moment = datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+        entry = {"time": moment.isoformat(timespec="milliseconds")}
+        entry.update(record.msg)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+class RequestLogger(object):
+    """
+    Registro de acceso del servidor: una línea JSON por pedido, con el
+    comando, sus argumentos (archivo, offset, tamaño...), el código de
+    respuesta, los bytes de la respuesta y la duración.
+
+    No frena a quien atiende los pedidos: cada registro se encola
+    (QueueHandler) y un hilo aparte (QueueListener) arma el JSON y lo
+    escribe, en la salida estándar o en un archivo que se rota al llegar a
+    `max_bytes`. Por el mismo hilo salen los mensajes del logger
+    "hftp.server" (conexiones nuevas y cerradas, errores).
+
+    Se anota solo uno de cada `sample` pedidos, y la decisión se toma antes
+    de armar el registro, así los que no se anotan no cuestan casi nada.
+    """
+
+    def __init__(
+        self,
+        sample=REQUEST_LOG_SAMPLE,
+        stream=None,
+        path=None,
+        max_bytes=ACCESS_LOG_MAX_BYTES,
+        backups=ACCESS_LOG_BACKUPS,
+    ):
+        """
+        Args:
+            sample (int): Se anota uno de cada `sample` pedidos (0 para no
+                anotar ninguno).
+            stream: Dónde se escriben el registro y los mensajes. Por
+                defecto, la salida estándar.
+            path (str): Archivo donde escribir el registro de acceso, en
+                lugar de `stream`.
+            max_bytes (int): Tamaño al que se rota el archivo.
+            backups (int): Archivos rotados que se guardan.
+        """
+        self.sample = sample
+        self.counter = itertools.count()
+        self.queue = queue.SimpleQueue()
+        self.handler = RecordQueueHandler(self.queue)
+        stream = stream if stream is not None else sys.stdout
+        # Un logger por registro, así cada servidor escribe solo los suyos
+        self.logger = logging.getLogger(f"hftp.access.{id(self)}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+        if path is not None:
+            access = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups
+            )
+        else:
+            access = logging.StreamHandler(stream)
+        access.setFormatter(JsonFormatter())
+        access.addFilter(logging.Filter(self.logger.name))
+        messages = logging.StreamHandler(stream)
+        messages.setFormatter(logging.Formatter("%(message)s"))
+        messages.addFilter(logging.Filter("hftp.server"))
+        server = logging.getLogger("hftp.server")
+        server.propagate = False
+        server.setLevel(logging.INFO)
+        server.addHandler(self.handler)
+        self.listener = logging.handlers.QueueListener(self.queue, access, messages)
+        self.listener.start()
+
+    def begin(self):
+        """
+        Decide si se anota el próximo pedido.
+
+        Devuelve el diccionario donde anotar los datos del pedido, o None
+        si no le toca según el muestreo.
+        """
+        if self.sample and next(self.counter) % self.sample == 0:
+            return {}
+        return None
+
+    def write(self, record: dict):
+        """
+        Encola el registro de un pedido ya atendido.
+        """
+        self.logger.info(record)
+
+    def close(self):
+        """
+        Escribe los registros encolados y detiene el hilo que los escribe.
+        """
+        logging.getLogger("hftp.server").removeHandler(self.handler)
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
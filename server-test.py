@@ -6,15 +6,39 @@
 # $Id: server-test.py 388 2011-03-22 14:20:06Z nicolasw $
 
 import unittest
+import aclient
+import asyncio
+import base64
+import blockcache
 import client
+import connection
 import constants
+import errno
+import hashlib
+import io
+import journal
+import json
+import metacache
+import metrics
+import mmappool
+import ratelimit
+import requestlog
+import resource
+import server
 import select
+import signal
 import time
 import socket
 import os
 import os.path
 import logging
+import lzma
 import sys
+import threading
+import tracing
+import urllib.request
+import zlib
+from collections import deque
 
 DATADIR = "testdata"
 TIMEOUT = 3  # Una cantidad razonable de segundos para esperar respuestas
@@ -55,6 +79,18 @@ class TestBase(unittest.TestCase):
             self.fail("No se pudo establecer conexión al server")
         return self.client
 
+    def socket_pair(self):
+        # Sockets TCP conectados entre sí, (ours, theirs): el del lado del
+        # server, para armar una conexión, y el del lado del cliente. Se
+        # cierran al terminar el test.
+        listener = socket.create_server(("127.0.0.1", 0))
+        theirs = socket.create_connection(listener.getsockname())
+        ours = listener.accept()[0]
+        listener.close()
+        self.addCleanup(theirs.close)
+        self.addCleanup(ours.close)
+        return ours, theirs
+
 
 class TestHFTPServer(TestBase):
     # Tests
@@ -459,6 +495,1035 @@ class TestHFTPCustom(TestBase):
             )
         c.close()
 
+    def test_eol_split_between_sends(self):
+        f = open(os.path.join(DATADIR, "bar"), "w")
+        f.write("x" * 100)
+        f.close()
+        c = self.new_client()
+        # El terminador y los pedidos quedan partidos entre varios recv
+        pieces = [
+            "get_metadata bar\r",
+            "\nget_metadata bar\r\nget_meta",
+            "data bar\r\n",
+        ]
+        for piece in pieces:
+            c.s.send(piece.encode("ascii"))
+            time.sleep(0.2)
+        for i in range(3):
+            status, message = c.read_response_line(TIMEOUT)
+            self.assertEqual(status, constants.CODE_OK)
+            self.assertEqual(c.read_line(TIMEOUT), "100")
+        c.close()
+
+    def test_non_ascii_request(self):
+        c = self.new_client()
+        c.s.send(b"get_file_listing\xff\r\n")
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(
+            status,
+            constants.BAD_REQUEST,
+            "El servidor no rechazó un pedido con caracteres no ASCII",
+        )
+
+
+class TestHFTPSend(TestBase):
+    # Envío de los slices: sin codificar, con sendmsg y TCP_CORK
+    def test_get_slice_raw(self):
+        self.output_file = "bar"
+        test_data = bytes(range(256)) * 1000 + b"\r\n\n\r" * 100
+        f = open(os.path.join(DATADIR, self.output_file), "wb")
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.get_slice_raw(self.output_file, 0, len(test_data))
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, "rb")
+        self.assertEqual(
+            f.read(), test_data, "El contenido del archivo no es el correcto"
+        )
+        f.close()
+        c.get_slice_raw(self.output_file, 1000, 10)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, "rb")
+        self.assertEqual(
+            f.read(), test_data[1000:1010], "El contenido del archivo no es el correcto"
+        )
+        f.close()
+        # La conexión sigue sincronizada luego de los datos sin codificar
+        m = c.get_metadata(self.output_file)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(m, len(test_data))
+        c.send("get_slice_raw %s 1 %d" % (self.output_file, len(test_data)))
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(
+            status,
+            constants.BAD_OFFSET,
+            "El servidor no contestó 203 ante un offset invalido",
+        )
+        c.close()
+        # Si el archivo se achicó, se corta la conexión en lugar de enviar
+        # menos bytes de los prometidos
+        path = os.path.join(DATADIR, self.output_file)
+        for limiter in [None, ratelimit.RateLimiter(10 * constants.RATE_QUANTUM)]:
+            ours, theirs = self.socket_pair()
+            cn = connection.Connection(ours, DATADIR, limiter=limiter)
+            cn.send_file(open(path, "rb"), len(test_data) - 1000, 2000)
+            self.assertFalse(cn.connected)
+            theirs.settimeout(TIMEOUT)
+            received = b""
+            chunk = theirs.recv(4096)
+            while chunk:
+                received += chunk
+                chunk = theirs.recv(4096)
+            self.assertEqual(received, test_data[-1000:])
+
+    def test_send_vectored(self):
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(TIMEOUT)
+        # Varios fragmentos en un solo sendmsg, el último cortado en `limit`
+        buffers = deque([b"abc", memoryview(b"defgh"), b"ij"])
+        self.assertEqual(connection.send_vectored(ours, buffers, 6), 6)
+        self.assertEqual(theirs.recv(100), b"abcdef")
+        self.assertEqual([bytes(data) for data in buffers], [b"gh", b"ij"])
+        # Lo que no son bytes (p.ej. un FileRange) corta el envío
+        marker = object()
+        buffers.extend([marker, b"kl"])
+        self.assertEqual(connection.send_vectored(ours, buffers), 4)
+        self.assertEqual(theirs.recv(100), b"ghij")
+        self.assertEqual(list(buffers), [marker, b"kl"])
+        # Como mucho IOV_MAX fragmentos por llamada
+        buffers = deque([b"x"] * (constants.IOV_MAX + 5))
+        self.assertEqual(connection.send_vectored(ours, buffers), constants.IOV_MAX)
+        self.assertEqual(len(buffers), 5)
+        received = b""
+        while len(received) < constants.IOV_MAX:
+            received += theirs.recv(constants.IOV_MAX)
+        self.assertEqual(received, b"x" * constants.IOV_MAX)
+        # Lo que no entró en el socket queda sin copiar
+        ours.setblocking(False)
+        big = bytes(2**24)
+        buffers = deque([b"y", big])
+        sent = connection.send_vectored(ours, buffers)
+        self.assertLess(sent, 1 + len(big))
+        self.assertEqual(len(buffers), 1)
+        self.assertIs(buffers[0].obj, big)
+        self.assertEqual(len(buffers[0]), 1 + len(big) - sent)
+        ours.close()
+        theirs.close()
+        # Con sendfile, el cork junta encabezado, archivo y fin de línea, y
+        # se saca al terminar la respuesta
+        if connection.TCP_CORK is None:
+            return
+        f = open(os.path.join(DATADIR, "bar"), "wb")
+        f.write(b"z" * 100)
+        f.close()
+        for cls in [connection.Connection, connection.EventConnection]:
+            ours, theirs = self.socket_pair()
+            cn = cls(ours, DATADIR)
+            cn.handle_line("get_slice_raw bar 0 100")
+            if cls is connection.EventConnection:
+                cn.on_writable()
+            else:
+                self.assertTrue(cn.corked)
+                cork = ours.getsockopt(socket.IPPROTO_TCP, connection.TCP_CORK)
+                self.assertEqual(cork, 1)
+                cn.flush()
+            self.assertFalse(cn.corked)
+            cork = ours.getsockopt(socket.IPPROTO_TCP, connection.TCP_CORK)
+            self.assertEqual(cork, 0)
+            expected = b"0 OK\r\n" + b"z" * 100 + b"\r\n"
+            theirs.settimeout(TIMEOUT)
+            received = b""
+            while len(received) < len(expected):
+                received += theirs.recv(4096)
+            self.assertEqual(received, expected)
+
+
+class TestHFTPPipeline(TestBase):
+    # Pedidos en pipeline, con el cliente sincrónico y el asincrónico
+    def test_pipeline_order(self):
+        sizes = [17 * i for i in range(50)]
+        for i, size in enumerate(sizes):
+            f = open(os.path.join(DATADIR, "file%02d" % i), "wb")
+            f.write(bytes([i]) * size)
+            f.close()
+        requests = []
+        for i, size in enumerate(sizes):
+            requests.append(("get_metadata", "file%02d" % i))
+            requests.append(("get_slice", "file%02d" % i, 0, size))
+        requests.append(("get_metadata", "does_not_exist"))
+        requests.append(("get_slice_raw", "file49", 1, sizes[49] - 1))
+        c = self.new_client()
+        results = c.pipeline(requests, window=8)
+        self.assertEqual(len(results), len(requests))
+        for i, size in enumerate(sizes):
+            self.assertEqual(
+                results[2 * i],
+                (constants.CODE_OK, size),
+                "Las respuestas no llegaron en el orden de los pedidos",
+            )
+            self.assertEqual(
+                results[2 * i + 1],
+                (constants.CODE_OK, bytes([i]) * size),
+                "Las respuestas no llegaron en el orden de los pedidos",
+            )
+        self.assertEqual(results[-2], (constants.FILE_NOT_FOUND, None))
+        self.assertEqual(
+            results[-1], (constants.CODE_OK, bytes([49]) * (sizes[49] - 1))
+        )
+        c.close()
+
+    def test_async_client(self):
+        data = os.urandom(100000)
+        with open(os.path.join(DATADIR, "bar"), "wb") as f:
+            f.write(data)
+        for i in range(50):
+            with open(os.path.join(DATADIR, "foo%d" % i), "w") as f:
+                f.write("x" * i)
+
+        async def run():
+            async with aclient.ConnectionPool(
+                [("127.0.0.1", constants.DEFAULT_PORT)], connections=4, concurrency=16
+            ) as pool:
+                sizes = await asyncio.gather(
+                    *(pool.get_metadata("foo%d" % i) for i in range(50))
+                )
+                self.assertEqual(sizes, list(range(50)))
+                self.assertEqual(await pool.get_slice("bar", 10, 50000), data[10:50010])
+                names = sorted(await pool.get_file_listing())
+                self.assertEqual(len(names), 51)
+                page = await pool.get_file_listing(count=3)
+                self.assertEqual(len(page), 3)
+                with self.assertRaises(aclient.ResponseError) as cm:
+                    await pool.get_metadata("nada")
+                self.assertEqual(cm.exception.code, constants.FILE_NOT_FOUND)
+                # Las conexiones libres se cortan y el pedido se reintenta
+                for conn in pool.servers[0].idle:
+                    conn.reader.feed_eof()
+                self.assertEqual(await pool.get_metadata("foo7"), 7)
+                with self.assertRaises(asyncio.TimeoutError):
+                    await pool.get_slice("bar", 0, 100000, timeout=0.00001)
+                self.assertLessEqual(len(pool.servers[0].idle), 4)
+
+        asyncio.run(run())
+        # El timeout del cliente bloqueante es de reloj, no de CPU
+        c = self.new_client()
+        start = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            c.read_line(0.2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+
+class TestHFTPDownloads(TestBase):
+    # Descargas por rangos en paralelo y retomadas
+    def test_retrieve_parallel(self):
+        self.output_file = "bar"
+        test_data = os.urandom(2**20 + 12345)
+        f = open(os.path.join(DATADIR, self.output_file), "wb")
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        for raw in (False, True):
+            ok = c.retrieve_parallel(
+                self.output_file, connections=4, range_size=100000, raw=raw
+            )
+            self.assertTrue(ok)
+            self.assertEqual(c.status, constants.CODE_OK)
+            f = open(self.output_file, "rb")
+            self.assertEqual(
+                f.read(), test_data, "El contenido del archivo no es el correcto"
+            )
+            f.close()
+        c.close()
+
+    def test_retrieve_resume(self):
+        self.output_file = "bar"
+        test_data = os.urandom(500000)
+        f = open(os.path.join(DATADIR, self.output_file), "wb")
+        f.write(test_data)
+        f.close()
+        # Una descarga anterior ya había bajado [0, 100000) y [300000, 400000)
+        f = open(self.output_file, "wb")
+        f.write(b"\0" * len(test_data))
+        f.close()
+        journal.RangeJournal(
+            self.output_file, len(test_data), [(0, 100000), (300000, 400000)]
+        ).save()
+        c = self.new_client()
+        ok = c.retrieve_parallel(
+            self.output_file, connections=2, range_size=64000, resume=True
+        )
+        self.assertTrue(ok)
+        f = open(self.output_file, "rb")
+        data = f.read()
+        f.close()
+        # Solo se pidieron los rangos que faltaban
+        self.assertEqual(data[:100000], b"\0" * 100000)
+        self.assertEqual(data[300000:400000], b"\0" * 100000)
+        self.assertEqual(data[100000:300000], test_data[100000:300000])
+        self.assertEqual(data[400000:], test_data[400000:])
+        self.assertFalse(
+            os.path.exists(self.output_file + constants.JOURNAL_SUFFIX),
+            "No se borró el registro de la descarga completa",
+        )
+        # Con un registro completo no se vuelve a pedir nada
+        f = open(self.output_file, "wb")
+        f.write(b"\0" * len(test_data))
+        f.close()
+        journal.RangeJournal(
+            self.output_file, len(test_data), [(0, len(test_data))]
+        ).save()
+        ok = c.retrieve_parallel(self.output_file, resume=True)
+        self.assertTrue(ok)
+        f = open(self.output_file, "rb")
+        self.assertEqual(f.read(), b"\0" * len(test_data))
+        f.close()
+        self.assertFalse(os.path.exists(self.output_file + constants.JOURNAL_SUFFIX))
+        c.close()
+        # Los rangos se anotan sin el lock que usan los hilos para pedir
+        # rangos, y si no se pueden anotar la descarga no se da por completa
+        ranges = [(start, 100000) for start in range(0, len(test_data), 100000)]
+        fd = os.open(self.output_file, os.O_WRONLY)
+        try:
+            for fails in [False, True]:
+                recorded = []
+                free = []
+
+                def take():
+                    if fetcher.cond.acquire(timeout=TIMEOUT):
+                        fetcher.cond.release()
+                        free.append(True)
+
+                def on_done(finished):
+                    other = threading.Thread(target=take)
+                    other.start()
+                    other.join()
+                    recorded.extend(finished)
+                    if fails:
+                        raise OSError(errno.EIO, "Error de E/S")
+
+                fetcher = client.RangeFetcher(
+                    c, self.output_file, fd, deque(ranges), on_done=on_done
+                )
+                fetcher.run(2)
+                self.assertEqual(sorted(recorded), ranges)
+                self.assertTrue(free)
+                self.assertEqual(sorted(fetcher.failed), ranges if fails else [])
+        finally:
+            os.close(fd)
+        # Un registro que se va completando de a rangos
+        partial = journal.RangeJournal(self.output_file, 1000)
+        partial.add(0, 300)
+        partial.add(600, 400)
+        self.assertFalse(partial.complete())
+        self.assertEqual(partial.missing(200), [(300, 200), (500, 100)])
+        self.assertEqual(
+            journal.RangeJournal.load(self.output_file).done, [(0, 300), (600, 1000)]
+        )
+        partial.add(300, 300)
+        self.assertTrue(partial.complete())
+        partial.remove()
+
+
+class TestHFTPCaches(TestBase):
+    # Caches de bloques y de metadatos, y pool de mmap
+    def test_block_cache(self):
+        cache = blockcache.BlockCache(250)
+        for i in range(3):
+            cache.put(("bloque", i), bytes([i]) * 100)
+        # El tercero no entraba: se descartó el usado hace más tiempo
+        self.assertIsNone(cache.get(("bloque", 0)))
+        self.assertEqual(cache.get(("bloque", 1)), b"\1" * 100)
+        # El 1 se usó recién, así que ahora se descarta el 2
+        cache.put(("bloque", 3), b"\3" * 100)
+        self.assertIsNone(cache.get(("bloque", 2)))
+        self.assertEqual(cache.get(("bloque", 1)), b"\1" * 100)
+        # Un bloque más grande que toda la capacidad no se guarda
+        cache.put(("grande",), b"x" * 300)
+        self.assertIsNone(cache.get(("grande",)))
+        stats = cache.stats()
+        self.assertEqual((stats["blocks"], stats["bytes"]), (2, 200))
+        self.assertEqual(stats["evictions"], 2)
+        # Con capacidad 0 no se guarda nada, ni siquiera un bloque vacío
+        disabled = blockcache.BlockCache(0)
+        disabled.put(("vacío",), b"")
+        self.assertEqual(disabled.stats()["blocks"], 0)
+        # Un archivo que creció sin que cambie su mtime no devuelve el
+        # último bloque viejo
+        path = os.path.join(DATADIR, "bar")
+        f = open(path, "wb")
+        f.write(b"x" * 10)
+        f.close()
+        before = metacache.FileInfo(size=10, mtime=1, inode=2)
+        reader = blockcache.BlockReader(path, before, 12, cache)
+        self.assertEqual(reader.block(0), b"x" * 10)
+        reader.close()
+        f = open(path, "ab")
+        f.write(b"y" * 10)
+        f.close()
+        after = metacache.FileInfo(size=20, mtime=1, inode=2)
+        reader = blockcache.BlockReader(path, after, 12, cache)
+        self.assertEqual(reader.block(0), b"x" * 10 + b"yy")
+        reader.close()
+
+    def test_mmap_pool(self):
+        for name in ["bar", "foo"]:
+            f = open(os.path.join(DATADIR, name), "wb")
+            f.write(name.encode("ascii") * 100)
+            f.close()
+        cache = metacache.MetadataCache(DATADIR)
+        bar = (os.path.join(DATADIR, "bar"), cache.lookup("bar"))
+        foo = (os.path.join(DATADIR, "foo"), cache.lookup("foo"))
+        cache.close()
+        pool = mmappool.MmapPool(idle_timeout=5)
+        # La misma versión del archivo se mapea una sola vez
+        first = pool.acquire(*bar)
+        second = pool.acquire(*bar)
+        self.assertIs(first, second)
+        self.assertEqual(first.refs, 2)
+        self.assertEqual(bytes(first.view[:6]), b"barbar")
+        in_use = pool.acquire(*foo)
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(first.refs, 0)
+        # Se liberan solo los mapeos sin referencias e inactivos hace más
+        # de idle_timeout segundos
+        with pool.lock:
+            pool.sweep()
+        self.assertEqual(pool.stats()["maps"], 2)
+        first.last_used -= 10
+        in_use.last_used -= 10
+        pool.last_sweep -= 10
+        with pool.lock:
+            pool.sweep()
+        stats = pool.stats()
+        self.assertEqual((stats["maps"], stats["evictions"]), (1, 1))
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEqual(bytes(in_use.view[:6]), b"foofoo")
+        pool.release(in_use)
+        # Se vuelve a mapear si se lo pide de nuevo
+        self.assertIsNot(pool.acquire(*bar), first)
+        # Los slices que no empiezan en un múltiplo de 3 se codifican bien,
+        # aunque los bytes que sobran crucen varios bloques
+        data = b"bar" * 100
+        ours, theirs = self.socket_pair()
+        for block_size in [3, 30]:
+            cn = connection.Connection(ours, DATADIR, block_size=block_size, mmaps=pool)
+            for offset in range(8):
+                for size in range(40):
+                    encoded = b"".join(cn.slice_blocks(*bar, offset, size))
+                    self.assertEqual(
+                        encoded, base64.b64encode(data[offset : offset + size])
+                    )
+
+    def test_metadata_after_change(self):
+        f = open(os.path.join(DATADIR, "bar"), "w")
+        f.write("x" * 100)
+        f.close()
+        c = self.new_client()
+        self.assertEqual(c.get_metadata("bar"), 100)
+        # El server no debe responder con datos viejos
+        f = open(os.path.join(DATADIR, "bar"), "a")
+        f.write("x" * 100)
+        f.close()
+        self.assertEqual(c.get_metadata("bar"), 200)
+        os.remove(os.path.join(DATADIR, "bar"))
+        self.assertEqual(c.get_metadata("bar"), None)
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        open(os.path.join(DATADIR, "foo"), "w").close()
+        self.assertEqual(c.file_lookup(), ["foo"])
+        c.close()
+        # Si no se puede vigilar el directorio, se revisa su mtime en lugar
+        # de volver a leerlo entero en cada consulta
+        cache = metacache.MetadataCache(DATADIR)
+        if cache.inotify is not None:
+
+            def add_watch(*args):
+                raise OSError(errno.ENOSPC, "no quedan watches")
+
+            cache.inotify.add_watch = add_watch
+            cache.rescan()
+        self.assertFalse(cache.stats()["inotify"])
+        rescans = cache.rescans
+        for i in range(5):
+            self.assertEqual(cache.lookup("foo").size, 0)
+        self.assertEqual(cache.rescans, rescans)
+        time.sleep(0.05)  # Para que cambie el mtime del directorio
+        open(os.path.join(DATADIR, "nuevo"), "w").close()
+        self.assertIsNotNone(cache.lookup("nuevo"))
+        cache.close()
+        self.assertIsNone(cache.inotify)
+        self.assertIsNotNone(cache.lookup("foo"))
+        # Las conexiones creadas sin cache comparten uno por directorio
+        self.assertIs(metacache.shared_cache(DATADIR), metacache.shared_cache(DATADIR))
+
+
+class TestHFTPMetadata(TestBase):
+    # Listado por páginas y metadatos de varios archivos
+    def test_file_listing_pages(self):
+        names = ["file%03d" % i for i in range(25)]
+        for name in names:
+            open(os.path.join(DATADIR, name), "w").close()
+        c = self.new_client()
+        self.assertEqual(c.file_lookup(20, 10), names[20:])
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(c.file_lookup(30, 10), [])
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(list(c.file_lookup_pages(10)), names)
+        # Con uno solo de los dos también se pide una página
+        self.assertEqual(c.file_lookup(count=5), names[:5])
+        self.assertEqual(c.file_lookup(offset=22), names[22:])
+        self.assertEqual(c.status, constants.CODE_OK)
+        c.file_lookup(-1, 10)
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+        c.send("get_file_listing 10")
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+    def test_get_metadata_many(self):
+        for i in range(5):
+            f = open(os.path.join(DATADIR, "file%d" % i), "w")
+            f.write("x" * i * 10)
+            f.close()
+        c = self.new_client()
+        names = ["file%d" % i for i in range(5)] + ["missing", "in/valid"]
+        result = c.get_metadata_many(names, batch_size=3)
+        self.assertEqual(
+            result,
+            [(constants.CODE_OK, i * 10) for i in range(5)]
+            + [(constants.FILE_NOT_FOUND, None), (constants.INVALID_ARGUMENTS, None)],
+        )
+        c.send("get_metadata_multi")
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+
+class TestHFTPChecksums(TestBase):
+    # Checksums y descargas de lo que cambió
+    def test_get_checksum(self):
+        self.output_file = "bar"
+        # Más grande que CHECKSUM_OFFLOAD_SIZE, se calcula en otro hilo
+        data = bytes(range(256)) * 2**13
+        f = open(os.path.join(DATADIR, self.output_file), "wb")
+        f.write(data)
+        f.close()
+
+        def blake2b(data):
+            h = hashlib.blake2b(digest_size=constants.CHECKSUM_DIGEST_SIZE)
+            h.update(data)
+            return h.hexdigest()
+
+        c = self.new_client()
+        self.assertEqual(c.get_checksum(self.output_file), blake2b(data))
+        self.assertEqual(
+            c.get_checksum(self.output_file, 10, 100), blake2b(data[10:110])
+        )
+        c.get_checksum(self.output_file, 10, len(data))
+        self.assertEqual(c.status, constants.BAD_OFFSET)
+        # Los pedidos que siguen se responden después, en orden
+        results = c.pipeline(
+            [("get_checksum", self.output_file), ("get_metadata", self.output_file)]
+        )
+        self.assertEqual(
+            results,
+            [(constants.CODE_OK, blake2b(data)), (constants.CODE_OK, len(data))],
+        )
+        # El segundo checksum del archivo entero salió del cache
+        self.assertGreaterEqual(c.stats()["hftp_checksum_cache_hits_total"], 1)
+        # Sin copia local se baja, con una copia igual no
+        self.assertTrue(c.retrieve_if_changed(self.output_file))
+        self.assertFalse(c.retrieve_if_changed(self.output_file))
+        f = open(self.output_file, "r+b")
+        f.write(b"x")
+        f.close()
+        self.assertTrue(c.retrieve_if_changed(self.output_file))
+        f = open(self.output_file, "rb")
+        self.assertEqual(f.read(), data)
+        f.close()
+        # Un quit detrás de un checksum que se está calculando
+        c.send("get_checksum %s 1 %d\r\nquit" % (self.output_file, len(data) - 1))
+        self.assertEqual(c.read_response_line(TIMEOUT)[0], constants.CODE_OK)
+        self.assertEqual(c.read_line(TIMEOUT), blake2b(data[1:]))
+        self.assertEqual(c.read_response_line(TIMEOUT)[0], constants.CODE_OK)
+        c.connected = False
+        c.s.close()
+
+    def test_retrieve_delta(self):
+        self.output_file = "bar"
+        block_size = 1024
+        old = bytes(range(256)) * 400 + b"\0" * 300
+        # Se inserta un poco al principio y se cambia un bloque del medio
+        new = b"nuevo" + old[:50000] + b"x" * block_size + old[51024:]
+        f = open(os.path.join(DATADIR, self.output_file), "wb")
+        f.write(new)
+        f.close()
+        c = self.new_client()
+        # Sin copia local se baja entero
+        self.assertEqual(c.retrieve_delta(self.output_file, block_size), len(new))
+        f = open(self.output_file, "wb")
+        f.write(old)
+        f.close()
+        fetched = c.retrieve_delta(self.output_file, block_size)
+        self.assertTrue(
+            0 < fetched <= 4 * block_size,
+            "Se bajaron %d bytes de %d" % (fetched, len(new)),
+        )
+        f = open(self.output_file, "rb")
+        self.assertEqual(f.read(), new)
+        f.close()
+        self.assertFalse(os.path.exists(self.output_file + ".delta"))
+        self.assertEqual(c.retrieve_delta(self.output_file, block_size), 0)
+        c.get_signatures(self.output_file, 1)
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+
+class TestHFTPCompression(TestBase):
+    # Compresión de los slices
+    def test_compression(self):
+        text = b"".join(b"linea %d de un log repetitivo\n" % i for i in range(5000))
+        noise = os.urandom(100000)
+        for name, data in [("log.txt", text), ("ruido", noise), ("log.gz", text)]:
+            f = open(os.path.join(DATADIR, name), "wb")
+            f.write(data)
+            f.close()
+        c = self.new_client()
+        self.assertFalse(c.set_compression("bzip2"))
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+        for method in ["zlib", "lzma"]:
+            self.assertTrue(c.set_compression(method))
+            c.send("get_slice log.txt 7 %d" % (len(text) - 7))
+            self.assertEqual(c.read_response_line(TIMEOUT)[0], constants.CODE_OK)
+            self.assertEqual(c.read_line(TIMEOUT), method)
+            # El fragmento comprimido es bastante más corto que el archivo
+            self.assertLess(len(c.read_line(TIMEOUT)), len(text) // 4)
+            for name, data, raw in [
+                ("log.txt", text, False),
+                ("log.txt", text, True),
+                ("ruido", noise, False),
+                ("log.gz", text, False),
+            ]:
+                output = io.BytesIO()
+                self.assertTrue(c.fetch_range(name, 3, len(data) - 3, output, raw))
+                self.assertEqual(output.getvalue(), data[3:])
+        # Lo que no se comprime bien se envía sin comprimir
+        for name in ["ruido", "log.gz"]:
+            c.send("get_slice %s 0 1000" % name)
+            self.assertEqual(c.read_response_line(TIMEOUT)[0], constants.CODE_OK)
+            self.assertEqual(c.read_line(TIMEOUT), "none")
+            self.assertEqual(len(c.read_line(TIMEOUT)), 1336)
+        # retrieve_parallel negocia la misma compresión en cada conexión
+        negotiated = []
+        set_compression = client.Client.set_compression
+
+        def counted(cl, method):
+            negotiated.append(method)
+            return set_compression(cl, method)
+
+        client.Client.set_compression = counted
+        try:
+            self.output_file = "log.txt"
+            self.assertTrue(
+                c.retrieve_parallel("log.txt", connections=2, range_size=50000)
+            )
+        finally:
+            client.Client.set_compression = set_compression
+        self.assertEqual(negotiated, ["lzma", "lzma"])
+        f = open(self.output_file, "rb")
+        self.assertEqual(f.read(), text)
+        f.close()
+        # Un rango que no se puede descomprimir se reintenta, sin dejar
+        # esperando a los demás hilos
+        decompressor = client.decompressor
+        wrong = {"zlib": lzma.LZMADecompressor, "lzma": zlib.decompressobj}
+        for method in ["zlib", "lzma"]:
+            broken = []
+
+            def corrupt(used):
+                if broken:
+                    return decompressor(used)
+                broken.append(used)
+                return wrong[used]()
+
+            self.assertTrue(c.set_compression(method))
+            client.decompressor = corrupt
+            try:
+                self.assertTrue(
+                    c.retrieve_parallel("log.txt", connections=2, range_size=50000)
+                )
+            finally:
+                client.decompressor = decompressor
+            self.assertEqual(broken, [method])
+            f = open(self.output_file, "rb")
+            self.assertEqual(f.read(), text)
+            f.close()
+        c.close()
+
+
+class TestHFTPLimits(TestBase):
+    # Límites de ancho de banda y de conexiones
+    def test_rate_limiter(self):
+        rate = 10 * constants.RATE_QUANTUM
+        shared = ratelimit.TokenBucket(rate, burst=constants.RATE_QUANTUM)
+        first = ratelimit.RateLimiter(shared=shared)
+        second = ratelimit.RateLimiter(shared=shared)
+        # La ráfaga sale enseguida, lo que sigue espera su turno en orden
+        self.assertEqual(first.reserve(constants.RATE_QUANTUM), 0)
+        delays = [
+            limiter.reserve(constants.RATE_QUANTUM)
+            for limiter in [first, second, first, second]
+        ]
+        self.assertEqual(delays, sorted(delays))
+        self.assertAlmostEqual(delays[0], 0.1, delta=0.02)
+        self.assertAlmostEqual(delays[3], 0.4, delta=0.02)
+        # Las escrituras chicas no esperan mientras la deuda no pase una ráfaga
+        small = ratelimit.RateLimiter(rate, shared=None)
+        self.assertEqual(small.reserve(constants.RATE_QUANTUM), 0)
+        self.assertEqual(small.reserve(100), 0)
+        self.assertGreater(small.reserve(constants.RATE_QUANTUM), 0)
+        # Con más de una ráfaga de deuda también esperan las chicas
+        self.assertGreater(small.reserve(100), 0)
+
+    def test_server_busy(self):
+        f = open(os.path.join(DATADIR, "bar"), "w")
+        f.write("x" * 100)
+        f.close()
+        port = constants.DEFAULT_PORT + 1
+        # Cada servidor admite dos conexiones: atiende una y encola la otra,
+        # o atiende ambas en el loop de eventos
+        servers = [
+            (server.Server, {"threads": 1, "accept_queue": 1}),
+            (server.EventServer, {"max_connections": 2}),
+        ]
+        for cls, limits in servers:
+            srv = cls(port=port, directory=DATADIR, idle_timeout=1, **limits)
+            # Ya escucha antes de que el hilo llegue a serve()
+            srv.socket.listen()
+            t = threading.Thread(target=srv.serve)
+            t.start()
+            try:
+                first = client.Client(port=port)
+                self.assertEqual(first.get_metadata("bar"), 100)
+                second = client.Client(port=port)
+                second.send("get_metadata bar")
+                third = client.Client(port=port)
+                status, message = third.read_response_line(TIMEOUT)
+                self.assertEqual(status, constants.SERVER_BUSY)
+                # La primera se cierra por inactividad y la segunda se atiende
+                self.assertEqual(first.read_line(TIMEOUT), "")
+                self.assertFalse(first.connected)
+                self.assertEqual(
+                    second.read_response_line(TIMEOUT)[0], constants.CODE_OK
+                )
+                self.assertEqual(second.read_line(TIMEOUT), "100")
+                # En el loop de eventos puede haberse cerrado por inactividad
+                second.s.close()
+            finally:
+                srv.shutdown()
+                t.join()
+                srv.socket.close()
+
+    def test_connection_limit(self):
+        port = constants.DEFAULT_PORT + 1
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        top = hard if hard != resource.RLIM_INFINITY else 2**20
+        try:
+            for cls in (server.Server, server.EventServer):
+                # Con pocos descriptores se sube el límite blando hasta donde
+                # deja el duro, y las conexiones se ajustan a lo que haya
+                resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+                srv = cls(port=port, directory=DATADIR)
+                srv.socket.close()
+                wanted = cls.default_max_connections + constants.RESERVED_FDS
+                raised = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+                self.assertEqual(raised, min(wanted, top))
+                self.assertEqual(
+                    srv.max_connections,
+                    min(cls.default_max_connections, raised - constants.RESERVED_FDS),
+                )
+                # Un límite pedido explícitamente se respeta
+                srv = cls(port=port, directory=DATADIR, max_connections=5)
+                srv.socket.close()
+                self.assertEqual(srv.max_connections, 5)
+            self.assertGreater(
+                server.EventServer.default_max_connections,
+                server.Server.default_max_connections,
+            )
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+class TestHFTPServerModes(TestBase):
+    # Loop de eventos y modo pre-fork, en el mismo proceso
+    def test_event_server(self):
+        # Más grande que CHECKSUM_OFFLOAD_SIZE, se calcula en otro hilo
+        data = bytes(range(256)) * 2**13
+        f = open(os.path.join(DATADIR, "bar"), "wb")
+        f.write(data)
+        f.close()
+        digest = hashlib.blake2b(data, digest_size=constants.CHECKSUM_DIGEST_SIZE)
+        port = constants.DEFAULT_PORT + 3
+        srv = server.EventServer(port=port, directory=DATADIR, idle_timeout=1)
+        # Ya escucha antes de que el hilo llegue a serve()
+        srv.socket.listen()
+        t = threading.Thread(target=srv.serve)
+        t.start()
+        try:
+            first = client.Client(port=port)
+            second = client.Client(port=port)
+            # Los pedidos detrás del checksum esperan a que se calcule
+            results = first.pipeline(
+                [
+                    ("get_checksum", "bar"),
+                    ("get_metadata", "bar"),
+                    ("get_slice", "bar", 10, 100),
+                    ("get_slice_raw", "bar", 0, len(data)),
+                ]
+            )
+            self.assertEqual(
+                results,
+                [
+                    (constants.CODE_OK, digest.hexdigest()),
+                    (constants.CODE_OK, len(data)),
+                    (constants.CODE_OK, data[10:110]),
+                    (constants.CODE_OK, data),
+                ],
+            )
+            # El mismo loop atiende a la otra conexión
+            self.assertEqual(second.get_metadata("bar"), len(data))
+            second.send("verdura")
+            status, message = second.read_response_line(TIMEOUT)
+            self.assertEqual(status, constants.INVALID_COMMAND)
+            total = srv.metrics.collect()
+            self.assertEqual(total.opened - total.closed, 2)
+            self.assertEqual(total.codes[constants.CODE_OK], 5)
+            # Sin actividad, el loop cierra las dos
+            self.assertEqual(second.read_line(TIMEOUT), "")
+            self.assertEqual(first.read_line(TIMEOUT), "")
+            first.s.close()
+            second.s.close()
+        finally:
+            srv.shutdown()
+            t.join()
+            srv.socket.close()
+
+    def test_supervisor(self):
+        data = b"x" * 2**23
+        f = open(os.path.join(DATADIR, "bar"), "wb")
+        f.write(data)
+        f.close()
+        port = constants.DEFAULT_PORT + 4
+        srv = server.Server(port=port, directory=DATADIR, reuse_port=True)
+        sup = server.Supervisor(srv, 2)
+        signums = [signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2]
+        handlers = {signum: signal.getsignal(signum) for signum in signums}
+        errors = []
+
+        def connect():
+            deadline = time.monotonic() + TIMEOUT
+            while True:
+                try:
+                    return client.Client(port=port)
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+
+        def check():
+            # Corre en otro hilo: el supervisor atiende señales y espera a
+            # sus workers desde el hilo principal
+            try:
+                c = connect()
+                self.assertEqual(c.get_metadata("bar"), len(data))
+                c.close()
+                # Un worker que muere se reemplaza
+                dead = next(iter(list(sup.workers)))
+                os.kill(dead, signal.SIGKILL)
+                deadline = time.monotonic() + constants.RESPAWN_DELAY + TIMEOUT
+                while dead in sup.workers or len(sup.workers) < 2:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.05)
+                # Con SIGTERM los workers terminan la respuesta en curso
+                c = connect()
+                c.send("get_slice bar 0 %d" % len(data))
+                self.assertEqual(c.read_response_line(TIMEOUT)[0], constants.CODE_OK)
+                os.kill(os.getpid(), signal.SIGTERM)
+                self.assertEqual(base64.b64decode(c.read_line(TIMEOUT)), data)
+                self.assertEqual(c.read_line(TIMEOUT), "")
+                c.s.close()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if sup.running:
+                    os.kill(os.getpid(), signal.SIGTERM)
+
+        t = threading.Thread(target=check)
+        t.start()
+        try:
+            sup.run()
+        finally:
+            t.join()
+            srv.socket.close()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        if errors:
+            raise errors[0]
+        self.assertEqual(sup.workers, {})
+
+
+class TestHFTPObservability(TestBase):
+    # Métricas, registro de acceso y tracing
+    def test_stats(self):
+        f = open(os.path.join(DATADIR, "bar"), "w")
+        f.write("x" * 100)
+        f.close()
+        c = self.new_client()
+        before = c.stats()
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertGreaterEqual(before["hftp_connections_active"], 1)
+        c.get_metadata("bar")
+        c.send("verdura")
+        c.read_response_line(TIMEOUT)
+        after = c.stats()
+        requests = 'hftp_requests_total{command="get_metadata"}'
+        self.assertEqual(after[requests], before.get(requests, 0) + 1)
+        count = 'hftp_request_duration_seconds_count{command="get_metadata"}'
+        self.assertEqual(after[count], after[requests])
+        errors = 'hftp_responses_total{code="200",message="NO SUCH COMMAND"}'
+        self.assertEqual(after[errors], before.get(errors, 0) + 1)
+        self.assertGreater(
+            after["hftp_sent_bytes_total"], before["hftp_sent_bytes_total"]
+        )
+        # También se publican los contadores de los caches
+        lookups = [
+            "hftp_metadata_cache_hits_total",
+            "hftp_metadata_cache_misses_total",
+        ]
+        self.assertGreater(
+            sum(after[name] for name in lookups), sum(before[name] for name in lookups)
+        )
+        self.assertIn("hftp_block_cache_evictions_total", after)
+        c.send("stats extra")
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.INVALID_ARGUMENTS)
+        c.close()
+        # Las mismas métricas, por HTTP
+        registry = metrics.Metrics()
+        registry.request("get_metadata", 0.002)
+        httpd = metrics.serve_metrics(registry, "127.0.0.1", constants.DEFAULT_PORT + 2)
+        try:
+            url = "http://127.0.0.1:%d/metrics" % (constants.DEFAULT_PORT + 2)
+            body = urllib.request.urlopen(url, timeout=TIMEOUT).read().decode()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        bucket = 'hftp_request_duration_seconds_bucket{command="get_metadata",le="%s"}'
+        self.assertIn(bucket % "0.001" + " 0", body.splitlines())
+        self.assertIn(bucket % "0.005" + " 1", body.splitlines())
+
+    def test_request_log(self):
+        f = open(os.path.join(DATADIR, "bar"), "w")
+        f.write("x" * 100)
+        f.close()
+        path = os.path.join(DATADIR, "access.log")
+        for cls in [connection.Connection, connection.EventConnection]:
+            log = requestlog.RequestLogger(path=path, stream=io.StringIO())
+            ours, theirs = self.socket_pair()
+            cn = cls(ours, DATADIR, log=log)
+            lines = [
+                "get_metadata bar",
+                "get_slice bar 10 20",
+                "verdura",
+                "get_checksum bar",
+            ]
+            for line in lines:
+                cn.handle_line(line)
+            if cls is connection.EventConnection:
+                cn.on_writable()
+            else:
+                cn.flush()
+            log.close()
+            with open(path) as f:
+                records = [json.loads(line) for line in f.read().splitlines()]
+            os.remove(path)
+            self.assertEqual(len(records), 4)
+            self.assertEqual(
+                [r["command"] for r in records],
+                ["get_metadata", "get_slice", "verdura", "get_checksum"],
+            )
+            self.assertEqual(records[0]["file"], "bar")
+            self.assertEqual(records[0]["status"], constants.CODE_OK)
+            self.assertEqual(records[0]["bytes"], len("0 OK\r\n100\r\n"))
+            self.assertEqual(records[1]["offset"], 10)
+            self.assertEqual(records[1]["size"], 20)
+            # Encabezado, 20 bytes en base64 y fin de línea
+            self.assertEqual(records[1]["bytes"], 6 + 28 + 2)
+            self.assertEqual(records[2]["status"], constants.INVALID_COMMAND)
+            self.assertGreaterEqual(records[1]["duration"], 0)
+            # La respuesta que se calcula aparte también anota su código
+            self.assertEqual(records[3]["status"], constants.CODE_OK)
+            digest = 2 * constants.CHECKSUM_DIGEST_SIZE
+            self.assertEqual(records[3]["bytes"], 6 + digest + 2)
+            self.assertEqual(cn.metrics.collect().codes[constants.CODE_OK], 3)
+        # Muestreo y rotación
+        log = requestlog.RequestLogger(
+            sample=3, path=path, max_bytes=200, backups=2, stream=io.StringIO()
+        )
+        sampled = [log.begin() for i in range(9)]
+        self.assertEqual(
+            [i for i, record in enumerate(sampled) if record is not None], [0, 3, 6]
+        )
+        for i in range(20):
+            log.write({"command": "get_metadata", "file": "archivo%d" % i})
+        log.close()
+        self.assertTrue(os.path.exists(path + ".2"))
+        self.assertFalse(os.path.exists(path + ".3"))
+
+    def test_tracing(self):
+        tracer = tracing.Tracer(size=4)
+        for i in range(6):
+            tracer.add("fase%d" % i, i, 0.001)
+        self.assertEqual(
+            [name for start, elapsed, name in tracer.ring().snapshot()],
+            ["fase2", "fase3", "fase4", "fase5"],
+        )
+        f = open(os.path.join(DATADIR, "bar"), "wb")
+        f.write(b"x" * 100000)
+        f.close()
+        tracer = tracing.Tracer()
+        ours, theirs = self.socket_pair()
+        cn = connection.Connection(ours, DATADIR, tracer=tracer)
+        cn.handle_line("get_metadata bar")
+        cn.handle_line("get_slice bar 0 100000")
+        cn.flush()
+        names = {name for start, elapsed, name in tracer.ring().snapshot()}
+        self.assertTrue(
+            {"validate", "read", "encode", "send", "get_metadata", "get_slice"} <= names
+        )
+        output = io.StringIO()
+        tracer.dump(output)
+        self.assertIn("get_slice", output.getvalue())
+        # Perfiladores
+        profiler = tracing.ThreadProfiler()
+        profiler.active = True
+        profiler.check()
+        sum(range(1000))
+        profiler.active = False
+        profiler.check()
+        output = io.StringIO()
+        profiler.dump(output)
+        self.assertIn("function calls", output.getvalue())
+        sampler = tracing.StackSampler(interval=0.001)
+        sampler.start()
+        time.sleep(0.05)
+        sampler.stop()
+        self.assertFalse(sampler.active)
+        output = io.StringIO()
+        sampler.dump(output)
+        self.assertIn("MainThread;", output.getvalue())
+
 
 class TestHFTPCustomErrorFeo(TestBase):
     def test_close_connection_before_get_response(self):
@@ -624,6 +1689,16 @@ def suite():
     suite.addTest(unittest.makeSuite(TestHFTPErrors))
     suite.addTest(unittest.makeSuite(TestHFTPHard))
     suite.addTest(unittest.makeSuite(TestHFTPCustom))
+    suite.addTest(unittest.makeSuite(TestHFTPSend))
+    suite.addTest(unittest.makeSuite(TestHFTPPipeline))
+    suite.addTest(unittest.makeSuite(TestHFTPDownloads))
+    suite.addTest(unittest.makeSuite(TestHFTPCaches))
+    suite.addTest(unittest.makeSuite(TestHFTPMetadata))
+    suite.addTest(unittest.makeSuite(TestHFTPChecksums))
+    suite.addTest(unittest.makeSuite(TestHFTPCompression))
+    suite.addTest(unittest.makeSuite(TestHFTPLimits))
+    suite.addTest(unittest.makeSuite(TestHFTPServerModes))
+    suite.addTest(unittest.makeSuite(TestHFTPObservability))
     suite.addTest(unittest.makeSuite(TestHFTPCustomErrorFeo))
     suite.addTest(unittest.makeSuite(TestHFTPCustomMultipleClients))
     return suite
@@ -7,12 +7,31 @@
 # $Id: server.py 656 2013-03-18 23:49:11Z bc $
 
 import optparse
+import queue
+import resource
 import socket
+import blockcache
+import checksums
 import connection
+import metacache
+import metrics
+import mmappool
+import ratelimit
+import requestlog
+import tracing
 from constants import *
 import sys
 import os
+import selectors
+import heapq
+import itertools
+import logging
+import signal
 import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("hftp.server")
 
 
 class Server(object):
@@ -21,12 +40,72 @@ class Server(object):
     especificados donde se reciben nuevas conexiones de clientes.
     """
 
-    def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT, directory=DEFAULT_DIR):
+    # Conexiones abiertas como máximo si no se pide otra cantidad
+    default_max_connections = MAX_CONNECTIONS
+
+    def __init__(
+        self,
+        addr=DEFAULT_ADDR,
+        port=DEFAULT_PORT,
+        directory=DEFAULT_DIR,
+        reuse_port=False,
+        block_size=SLICE_BLOCK_SIZE,
+        cache_size=BLOCK_CACHE_SIZE,
+        cache_b64=False,
+        use_mmap=False,
+        rate=0,
+        global_rate=0,
+        threads=WORKER_THREADS,
+        accept_queue=ACCEPT_QUEUE_SIZE,
+        backlog=LISTEN_BACKLOG,
+        max_connections=None,
+        idle_timeout=IDLE_TIMEOUT,
+        metrics_port=0,
+        log_sample=REQUEST_LOG_SAMPLE,
+        access_log=None,
+        access_log_max_bytes=ACCESS_LOG_MAX_BYTES,
+        access_log_backups=ACCESS_LOG_BACKUPS,
+        trace=False,
+        profile=None,
+        profile_dir=".",
+    ):
         """
         Args:
             addr (str): Dirección IP del servidor.
             puerto (int): Puerto en el que el servidor aceptará conexiones entrantes.
             directorio (str): Directorio compartido que se servirá a los clientes.
+            reuse_port (bool): Permite que otros procesos vinculen el mismo puerto.
+            block_size (int): Bytes por bloque al enviar un slice, múltiplo de 3.
+            cache_size (int): Bytes del cache de bloques compartido (0 lo desactiva).
+            cache_b64 (bool): Guardar también los bloques codificados en base64.
+            use_mmap (bool): Leer los archivos mapeados en memoria, con un
+                pool de mapeos compartido.
+            rate (int): Bytes por segundo que puede enviar cada conexión
+                (0 sin límite).
+            global_rate (int): Bytes por segundo que pueden enviar entre
+                todas las conexiones del proceso (0 sin límite).
+            threads (int): Hilos que atienden conexiones (modo threads).
+            accept_queue (int): Conexiones aceptadas que pueden esperar un
+                hilo libre (modo threads).
+            backlog (int): Conexiones que el kernel encola hasta el accept.
+            max_connections (int): Conexiones abiertas como máximo. Las que
+                llegan de más se rechazan con SERVER_BUSY. Si no se da, se
+                usa la de connection_limit().
+            idle_timeout (float): Segundos sin actividad antes de cerrar
+                una conexión (0 para no cerrarlas).
+            metrics_port (int): Puerto del endpoint HTTP /metrics, en
+                METRICS_ADDR (0 para no atenderlo).
+            log_sample (int): Se anota uno de cada `log_sample` pedidos (0
+                para no anotarlos).
+            access_log (str): Archivo del registro de acceso. Si no se da,
+                se escribe en la salida estándar.
+            access_log_max_bytes (int): Tamaño al que se rota el registro.
+            access_log_backups (int): Registros rotados que se guardan.
+            trace (bool): Anotar las fases de cada pedido en un Tracer.
+            profile (str): Perfilador que se prende y apaga con SIGUSR2:
+                "sample" (muestreo de pilas), "cprofile" o None.
+            profile_dir (str): Directorio donde SIGUSR1 vuelca el tracing
+                y los perfiles.
 
         Raises:
             OSError: Si no se puede crear el directorio especificado.
@@ -41,31 +120,637 @@ class Server(object):
 
         print(f'Serving "{directory}" directory on {addr}:{port}.')
 
-        # Se crea el socket y se lo vincula a la dirección y puerto
+        # Se guarda la dirección, el socket y el directorio compartido en el objeto
+        self.addr = addr
+        self.port = port
+        self.socket = self.bind(reuse_port)
+        self.directory = directory
+        self.block_size = block_size
+        self.cache_size = cache_size
+        self.cache_b64 = cache_b64
+        self.use_mmap = use_mmap
+        self.rate = rate
+        self.global_rate = global_rate
+        self.threads = threads
+        self.accept_queue = accept_queue
+        self.backlog = backlog
+        if max_connections is None:
+            max_connections = self.connection_limit()
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.metrics_port = metrics_port
+        self.log_sample = log_sample
+        self.access_log = access_log
+        self.access_log_max_bytes = access_log_max_bytes
+        self.access_log_backups = access_log_backups
+        self.trace = trace
+        self.profile = profile
+        self.profile_dir = profile_dir
+        # Se crean al empezar a atender, así cada worker tiene los suyos
+        self.cache = None
+        self.blocks = None
+        self.mmaps = None
+        self.checksums = None
+        self.bandwidth = None
+        self.metrics = None
+        self.log = None
+        self.tracer = None
+        self.sampler = None
+        self.profiler = None
+        self.running = True
+        # Conexiones abiertas, para poder drenarlas al terminar
+        self.connections = set()
+
+    def bind(self, reuse_port=False):
+        """
+        Crea el socket y lo vincula a la dirección y puerto del servidor.
+
+        Args:
+            reuse_port (bool): Si es True, varios procesos pueden vincular
+                su propio socket al mismo puerto (SO_REUSEPORT).
+        """
         oursocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        oursocket.bind((addr, port))
+        # Permite reiniciar el servidor sin esperar a que expire TIME_WAIT
+        oursocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            oursocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        oursocket.bind((self.addr, self.port))
+        return oursocket
 
-        # Se guarda el socket y el directorio compartido en el objeto
-        self.socket = oursocket
-        self.directory = directory
+    def connection_limit(self):
+        """
+        Devuelve cuántas conexiones abrir como máximo por defecto:
+        default_max_connections, que depende del modo, siempre que alcancen
+        los descriptores. Si el límite blando de descriptores (RLIMIT_NOFILE)
+        no alcanza, se lo sube hasta donde deja el duro, y si aun así no
+        alcanza se abren menos conexiones, guardando RESERVED_FDS
+        descriptores para el resto del servidor.
+        """
+        wanted = self.default_max_connections + RESERVED_FDS
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY or soft >= wanted:
+            return self.default_max_connections
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            soft = wanted
+        except (ValueError, OSError):
+            pass  # Queda el límite blando que había
+        return max(1, min(self.default_max_connections, soft - RESERVED_FDS))
 
     def serve(self):
         """
-        Loop principal del servidor. Se acepta una conexión a la vez
-        y se espera a que concluya antes de seguir.
+        Loop principal del servidor. Se acepta una conexión a la vez y se
+        la encola para que la atienda uno de los `threads` hilos, hasta que
+        se llama a shutdown(). Si no hay lugar en la cola, o ya hay
+        `max_connections` conexiones, se la rechaza enseguida.
         """
-        # Escucha conexiones entrantes con un máximo de 5 conexiones en cola
-        self.socket.listen(5)
+        self.socket.listen(self.backlog)
+        self.create_caches()
+        self.queue = queue.Queue()
+        for _ in range(self.threads):
+            threading.Thread(target=self.work, daemon=True).start()
 
-        while True:
+        while self.running:
             # Bloquea la ejecución hasta que se recibe una conexión entrante
-            (cnSocket, cnAdress) = self.socket.accept()
+            try:
+                (cnSocket, cnAdress) = self.socket.accept()
+            except OSError as e:
+                # shutdown() cierra el socket para interrumpir el accept
+                if not self.running:
+                    break
+                # Por ejemplo, se alcanzó el límite de descriptores abiertos
+                logger.error("Error accepting connection: %s", e)
+                time.sleep(0.1)
+                continue
+            waiting = self.queue.qsize()
+            if (
+                waiting >= self.accept_queue
+                or len(self.connections) + waiting >= self.max_connections
+            ):
+                self.reject(cnSocket)
+                continue
+            self.queue.put((cnSocket, cnAdress))
+        self.drain()
+        self.cache.close()
+        self.log.close()
+
+    def work(self):
+        """
+        Cuerpo de los hilos que atienden conexiones: toma de la cola una
+        conexión aceptada por vez y la atiende hasta que termina.
+        """
+        while True:
+            if self.profiler is None:
+                accepted = self.queue.get()
+            else:
+                # Sin conexiones también hay que notar si cambió el cProfile
+                self.profiler.check()
+                try:
+                    accepted = self.queue.get(timeout=SELECT_TIMEOUT)
+                except queue.Empty:
+                    continue
+            if accepted is None:
+                return
+            cnSocket, cnAdress = accepted
+            if self.idle_timeout > 0:
+                cnSocket.settimeout(self.idle_timeout)
             # Crea un objeto Connection para manejar la conexión entrante
-            cn = connection.Connection(cnSocket, self.directory)
-            print(f"Connected by: {cnAdress}")
-            # Creamos un nuevo hilo para manejar la conexión entrante
-            t = threading.Thread(target=cn.handle)
-            t.start()
+            cn = self.new_connection(connection.Connection, cnSocket)
+            logger.info("Connected by: %s", cnAdress)
+            self.handle(cn)
+
+    def reject(self, cnSocket):
+        """
+        Contesta SERVER_BUSY a una conexión que no se va a atender y la
+        cierra, sin esperar a que el cliente pueda recibir.
+        """
+        logger.info("Server busy, rejecting connection.")
+        self.metrics.rejected()
+        reply = f"{SERVER_BUSY} {error_messages[SERVER_BUSY]}{EOL}"
+        try:
+            cnSocket.setblocking(False)
+            cnSocket.send(reply.encode("ascii"))
+        except OSError:
+            pass  # El cliente no la va a ver, pero igual se lo rechaza
+        cnSocket.close()
+
+    def create_caches(self):
+        """
+        Crea los caches, las métricas y el registro de pedidos que
+        comparten todas las conexiones del proceso.
+        """
+        self.cache = metacache.MetadataCache(self.directory)
+        self.blocks = blockcache.BlockCache(self.cache_size)
+        if self.use_mmap:
+            self.mmaps = mmappool.MmapPool()
+        self.checksums = checksums.ChecksumCache()
+        if self.global_rate > 0:
+            self.bandwidth = ratelimit.TokenBucket(self.global_rate)
+        self.metrics = metrics.Metrics()
+        self.metrics.register("metadata_cache", self.cache)
+        self.metrics.register("block_cache", self.blocks)
+        if self.mmaps is not None:
+            self.metrics.register("mmap_pool", self.mmaps)
+        self.metrics.register("checksum_cache", self.checksums)
+        if self.metrics_port > 0:
+            metrics.serve_metrics(self.metrics, METRICS_ADDR, self.metrics_port)
+        self.log = requestlog.RequestLogger(
+            self.log_sample,
+            path=self.access_log,
+            max_bytes=self.access_log_max_bytes,
+            backups=self.access_log_backups,
+        )
+        if self.trace:
+            self.tracer = tracing.Tracer()
+        if self.profile == "sample":
+            self.sampler = tracing.StackSampler()
+        elif self.profile == "cprofile":
+            self.profiler = tracing.ThreadProfiler()
+
+    def new_connection(self, cls, cnSocket, **kwargs):
+        """
+        Crea la conexión de clase `cls` para el socket aceptado, con la
+        configuración del servidor y los argumentos extra de `kwargs`.
+        """
+        limiter = None
+        if self.rate > 0 or self.bandwidth is not None:
+            limiter = ratelimit.RateLimiter(self.rate, self.bandwidth)
+        return cls(
+            cnSocket,
+            self.directory,
+            block_size=self.block_size,
+            cache=self.cache,
+            blocks=self.blocks,
+            cache_b64=self.cache_b64,
+            mmaps=self.mmaps,
+            checksums=self.checksums,
+            limiter=limiter,
+            metrics=self.metrics,
+            log=self.log,
+            tracer=self.tracer,
+            profiler=self.profiler,
+            **kwargs,
+        )
+
+    def handle(self, cn):
+        """
+        Atiende una conexión en el hilo actual, registrándola mientras dure.
+        """
+        self.connections.add(cn)
+        self.metrics.opened()
+        try:
+            cn.handle()
+        finally:
+            self.connections.discard(cn)
+            self.metrics.closed()
+
+    def handle_profile_signals(self):
+        """
+        Atiende SIGUSR2 prendiendo o apagando el perfilador, y SIGUSR1
+        volcando el tracing y los perfiles a un archivo.
+        """
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_profile())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_profile())
+
+    def toggle_profile(self):
+        """
+        Prende el perfilador elegido con `profile` si está apagado, o lo
+        apaga si está prendido.
+        """
+        if self.sampler is not None:
+            if self.sampler.active:
+                self.sampler.stop()
+            else:
+                self.sampler.start()
+            active = self.sampler.active
+        elif self.profiler is not None:
+            # Cada hilo lo nota en su próximo check()
+            self.profiler.active = not self.profiler.active
+            active = self.profiler.active
+        else:
+            return
+        logger.info("Profiling %s.", "started" if active else "stopped")
+
+    def dump_profile(self):
+        """
+        Escribe en un archivo nuevo de `profile_dir` lo anotado por el
+        tracer y los perfiladores del proceso.
+        """
+        parts = [
+            part
+            for part in (self.tracer, self.sampler, self.profiler)
+            if part is not None
+        ]
+        if not parts:
+            return
+        name = "hftp-profile-%d-%s.txt" % (os.getpid(), time.strftime("%Y%m%d-%H%M%S"))
+        path = os.path.join(self.profile_dir, name)
+        with open(path, "w") as f:
+            for part in parts:
+                part.dump(f)
+                f.write("\n")
+        logger.info("Profile written to %s", path)
+
+    def shutdown(self):
+        """
+        Deja de aceptar conexiones nuevas. Se puede llamar desde un handler
+        de señales o desde otro hilo: cierra el socket para destrabar el
+        accept bloqueante.
+        """
+        self.running = False
+        try:
+            # Cerrarlo no alcanza para destrabar un accept de otro hilo
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def drain(self):
+        """
+        Espera a que terminen las conexiones abiertas, como mucho
+        DRAIN_TIMEOUT segundos. Se deja de leer de los clientes, así cada
+        conexión termina de responder el pedido en curso y se cierra.
+        """
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        # Las que todavía esperaban un hilo ya no se van a atender
+        while True:
+            try:
+                accepted = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if accepted is not None:
+                self.reject(accepted[0])
+        for _ in range(self.threads):
+            self.queue.put(None)
+        for cn in list(self.connections):
+            try:
+                cn.s.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass  # Seguramente ya se desconecto del otro lado
+        while self.connections and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+class EventServer(Server):
+    """
+    Servidor que atiende todas las conexiones desde un único hilo, con un
+    loop de eventos sobre sockets no bloqueantes (selectors). Cada conexión
+    es una máquina de estados (EventConnection) que lee y escribe solo
+    cuando el socket está listo, así se sostienen miles de sesiones sin un
+    hilo por cliente.
+
+    Las respuestas que se calculan en otro hilo (p.ej. checksums grandes)
+    avisan al loop al terminar, escribiendo en un socketpair vigilado.
+
+    Las conexiones que agotaron su ancho de banda no se vigilan hasta que
+    pueden seguir enviando: esperan en un heap ordenado por ese momento.
+    Una vez por SELECT_TIMEOUT se cierran las conexiones inactivas.
+    """
+
+    # Sin un hilo por conexión, el límite lo ponen los descriptores
+    default_max_connections = EVENT_MAX_CONNECTIONS
+
+    def serve(self):
+        """
+        Loop principal del servidor. Espera eventos de lectura y escritura
+        en el socket de escucha y en los de todas las conexiones abiertas.
+        """
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+        self.create_caches()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, self.wake_r)
+        self.ready = deque()  # Conexiones cuyo cálculo terminó
+        self.timers = []  # Heap de (momento, orden, conexión) a retomar
+        self.order = itertools.count()
+        self.next_sweep = time.monotonic() + SELECT_TIMEOUT
+
+        while self.running:
+            # El timeout permite notar un shutdown() pedido por una señal
+            self.poll()
+        self.drain()
+        self.selector.close()
+        self.wake_r.close()
+        self.wake_w.close()
+        self.cache.close()
+        self.log.close()
+
+    def poll(self):
+        """
+        Espera eventos y atiende los que ocurrieron, y luego las
+        conexiones que ya pueden seguir enviando.
+        """
+        if self.profiler is not None:
+            self.profiler.check()
+        timeout = SELECT_TIMEOUT
+        if self.timers:
+            timeout = min(timeout, max(0, self.timers[0][0] - time.monotonic()))
+        for key, mask in self.selector.select(timeout):
+            if key.data is None:
+                self.accept()
+            elif key.data is self.wake_r:
+                self.on_wakeup()
+            else:
+                self.service(key.data, mask)
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            cn = heapq.heappop(self.timers)[2]
+            if cn.s.fileno() != -1:
+                self.service(cn, 0)
+        if self.idle_timeout > 0 and now >= self.next_sweep:
+            self.next_sweep = now + SELECT_TIMEOUT
+            self.sweep(now - self.idle_timeout)
+
+    def sweep(self, limit: float):
+        """
+        Cierra las conexiones que no tuvieron actividad desde `limit`, salvo
+        las que esperan una respuesta que se está calculando.
+        """
+        for cn in list(self.connections):
+            if cn.last_active < limit and not cn.waiting:
+                logger.info("Closing idle connection...")
+                cn.abort()
+                self.close(cn)
+
+    def wakeup(self, cn):
+        """
+        Avisa al loop que terminó un cálculo que espera la conexión `cn`.
+        Se llama desde el hilo que hizo el cálculo.
+        """
+        self.ready.append(cn)
+        try:
+            self.wake_w.send(b"\0")
+        except BlockingIOError:
+            pass  # Ya hay avisos sin leer, el loop se va a despertar igual
+        except OSError:
+            pass  # El loop ya terminó y nadie espera la respuesta
+
+    def on_wakeup(self):
+        """
+        Atiende las conexiones cuyo cálculo terminó.
+        """
+        try:
+            while self.wake_r.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while self.ready:
+            cn = self.ready.popleft()
+            if cn.s.fileno() != -1:
+                self.service(cn, 0)
+
+    def shutdown(self):
+        """
+        Pide al loop de eventos que deje de aceptar conexiones. El socket
+        se cierra desde el propio loop, al notar el pedido.
+        """
+        self.running = False
+
+    def drain(self):
+        """
+        Deja de aceptar conexiones y sigue atendiendo las abiertas hasta
+        que terminen, como mucho DRAIN_TIMEOUT segundos.
+        """
+        self.selector.unregister(self.socket)
+        self.socket.close()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for cn in list(self.connections):
+            try:
+                cn.s.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass  # Seguramente ya se desconecto del otro lado
+        while self.connections and time.monotonic() < deadline:
+            self.poll()
+
+    def accept(self):
+        """
+        Acepta todas las conexiones entrantes pendientes.
+        """
+        while True:
+            try:
+                (cnSocket, cnAdress) = self.socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # Por ejemplo, se alcanzó el límite de descriptores abiertos
+                logger.error("Error accepting connection: %s", e)
+                return
+            if len(self.connections) >= self.max_connections:
+                self.reject(cnSocket)
+                continue
+            cn = self.new_connection(
+                connection.EventConnection, cnSocket, wakeup=self.wakeup
+            )
+            logger.info("Connected by: %s", cnAdress)
+            self.connections.add(cn)
+            self.metrics.opened()
+            self.selector.register(cnSocket, selectors.EVENT_READ, cn)
+
+    def service(self, cn, mask):
+        """
+        Atiende un evento de una conexión y actualiza los eventos que
+        interesan: mientras haya salida pendiente no se leen más pedidos.
+        """
+        cn.last_active = time.monotonic()
+        if mask & selectors.EVENT_READ:
+            cn.on_readable()
+        # Se intenta escribir enseguida, casi siempre el socket está listo
+        cn.on_writable()
+        if cn.finished:
+            self.close(cn)
+        elif cn.waiting and not cn.connected:
+            # Solo falta una respuesta que se está calculando: no se vigila
+            # el socket hasta que llegue el aviso de que terminó
+            self.unwatch(cn)
+        elif cn.resume_at is not None:
+            # Agotó su ancho de banda: se la retoma cuando pueda seguir
+            self.unwatch(cn)
+            heapq.heappush(self.timers, (cn.resume_at, next(self.order), cn))
+        elif cn.output and not cn.waiting:
+            self.watch(cn, selectors.EVENT_WRITE)
+        else:
+            # Mientras se calcula una respuesta se pueden leer más pedidos
+            self.watch(cn, selectors.EVENT_READ)
+
+    def close(self, cn):
+        """
+        Deja de vigilar la conexión y cierra su socket.
+        """
+        self.unwatch(cn)
+        if cn in self.connections:
+            self.connections.discard(cn)
+            self.metrics.closed()
+        cn.s.close()
+
+    def watch(self, cn, events):
+        """
+        Vigila los eventos `events` del socket de la conexión, que puede no
+        estar registrado si esperaba un cálculo.
+        """
+        try:
+            self.selector.modify(cn.s, events, cn)
+        except KeyError:
+            self.selector.register(cn.s, events, cn)
+
+    def unwatch(self, cn):
+        """
+        Deja de vigilar el socket de la conexión, si estaba registrado.
+        """
+        try:
+            self.selector.unregister(cn.s)
+        except KeyError:
+            pass
+
+
+SERVER_MODES = {"threads": Server, "events": EventServer}
+
+
+class Supervisor(object):
+    """
+    Modo pre-fork: lanza varios procesos worker que atienden conexiones en
+    el mismo puerto, cada uno con su propio loop de accept, para usar más
+    de un núcleo. Reinicia los workers que mueren y, al recibir SIGTERM,
+    les pide que drenen sus conexiones y espera a que terminen.
+    """
+
+    def __init__(self, server: Server, workers: int):
+        """
+        Args:
+            server (Server): Servidor ya vinculado al puerto, que heredan los workers.
+            workers (int): Cantidad de procesos worker.
+        """
+        self.server = server
+        self.nworkers = workers
+        self.workers = {}  # pid -> momento en que se lanzó
+        self.running = True
+
+    def spawn(self):
+        """
+        Lanza un nuevo proceso worker.
+        """
+        # Evita que el hijo herede (y repita) la salida aún no escrita
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker()
+        self.workers[pid] = time.monotonic()
+
+    def run_worker(self):
+        """
+        Cuerpo de un proceso worker: atiende conexiones hasta recibir SIGTERM.
+        Nunca vuelve, termina el proceso al salir.
+        """
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.server.shutdown())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.server.shutdown())
+            self.server.handle_profile_signals()
+            if hasattr(socket, "SO_REUSEPORT"):
+                # Cada worker tiene su propio socket y el kernel reparte
+                # las conexiones entre ellos
+                self.server.socket.close()
+                self.server.socket = self.server.bind(reuse_port=True)
+            if self.server.access_log is not None:
+                # Cada worker rota su propio registro de acceso
+                self.server.access_log += f".{os.getpid()}"
+            self.server.serve()
+        except Exception as e:
+            print(f"Worker {os.getpid()} failed: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(self, signum, frame):
+        """
+        Handler de SIGTERM: no lanza más workers y les pide a los
+        existentes que drenen sus conexiones.
+        """
+        self.running = False
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def forward(self, signum, frame):
+        """
+        Handler que reenvía la señal a todos los workers.
+        """
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """
+        Lanza los workers y los vigila hasta que terminan todos.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        # El tracing y los perfiles son de cada worker
+        signal.signal(signal.SIGUSR1, self.forward)
+        signal.signal(signal.SIGUSR2, self.forward)
+        for _ in range(self.nworkers):
+            self.spawn()
+
+        while self.workers:
+            pid, status = os.wait()
+            started = self.workers.pop(pid, None)
+            if started is None or not self.running:
+                continue
+            print(f"Worker {pid} died (status {status}), restarting it.")
+            # Evita relanzar en un ciclo si el worker muere apenas arranca
+            if time.monotonic() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            if self.running:
+                self.spawn()
 
 
 # Punto de entrada del programa que lanza un servidor con protocolo HFTP
@@ -82,6 +767,150 @@ def main():
     parser.add_option(
         "-d", "--datadir", help="Directorio compartido", default=DEFAULT_DIR
     )
+    parser.add_option(
+        "-m",
+        "--mode",
+        type="choice",
+        choices=list(SERVER_MODES.keys()),
+        help="Forma de atender las conexiones: un hilo por conexión (threads) "
+        "o un loop de eventos (events)",
+        default="threads",
+    )
+    parser.add_option(
+        "-b",
+        "--block-size",
+        type="int",
+        help="Bytes que se leen y codifican por vez al enviar un slice "
+        "(múltiplo de 3)",
+        default=SLICE_BLOCK_SIZE,
+    )
+    parser.add_option(
+        "-c",
+        "--cache-size",
+        type="int",
+        help="Bytes del cache de bloques de archivos (0 para desactivarlo)",
+        default=BLOCK_CACHE_SIZE,
+    )
+    parser.add_option(
+        "--cache-b64",
+        action="store_true",
+        help="Guardar en el cache también los bloques codificados en base64",
+        default=False,
+    )
+    parser.add_option(
+        "--mmap",
+        action="store_true",
+        help="Leer los archivos mapeados en memoria (solo si los archivos "
+        "servidos no se reescriben en el lugar)",
+        default=False,
+    )
+    parser.add_option(
+        "--rate",
+        type="int",
+        help="Bytes por segundo que puede enviar cada conexión (0 sin límite)",
+        default=0,
+    )
+    parser.add_option(
+        "--global-rate",
+        type="int",
+        help="Bytes por segundo que pueden enviar entre todas las conexiones "
+        "de cada proceso (0 sin límite)",
+        default=0,
+    )
+    parser.add_option(
+        "--threads",
+        type="int",
+        help="Hilos que atienden conexiones en el modo threads",
+        default=WORKER_THREADS,
+    )
+    parser.add_option(
+        "--accept-queue",
+        type="int",
+        help="Conexiones aceptadas que pueden esperar un hilo libre en el "
+        "modo threads",
+        default=ACCEPT_QUEUE_SIZE,
+    )
+    parser.add_option(
+        "--backlog",
+        type="int",
+        help="Conexiones que el kernel encola hasta aceptarlas",
+        default=LISTEN_BACKLOG,
+    )
+    parser.add_option(
+        "--max-connections",
+        type="int",
+        help="Conexiones abiertas como máximo en cada proceso; las demás "
+        "se rechazan con SERVER BUSY (por defecto, %d en el modo threads y "
+        "%d en el modo events, si alcanzan los descriptores)"
+        % (MAX_CONNECTIONS, EVENT_MAX_CONNECTIONS),
+        default=None,
+    )
+    parser.add_option(
+        "--idle-timeout",
+        type="float",
+        help="Segundos sin actividad antes de cerrar una conexión (0 para "
+        "no cerrarlas)",
+        default=IDLE_TIMEOUT,
+    )
+    parser.add_option(
+        "--metrics-port",
+        type="int",
+        help="Puerto donde atender las métricas por HTTP en "
+        f"{METRICS_ADDR}/metrics (0 para no atenderlas; no se puede usar "
+        "con --workers)",
+        default=0,
+    )
+    parser.add_option(
+        "--log-sample",
+        type="int",
+        help="Anotar uno de cada tantos pedidos (0 para no anotarlos)",
+        default=REQUEST_LOG_SAMPLE,
+    )
+    parser.add_option(
+        "--access-log",
+        help="Archivo donde escribir el registro de acceso, en JSON (por "
+        "defecto, la salida estándar)",
+        default=None,
+    )
+    parser.add_option(
+        "--access-log-max-bytes",
+        type="int",
+        help="Tamaño al que se rota el registro de acceso",
+        default=ACCESS_LOG_MAX_BYTES,
+    )
+    parser.add_option(
+        "--access-log-backups",
+        type="int",
+        help="Registros de acceso rotados que se guardan",
+        default=ACCESS_LOG_BACKUPS,
+    )
+    parser.add_option(
+        "--trace",
+        action="store_true",
+        help="Anotar las fases de cada pedido (validación, lectura, "
+        "codificación, envío); SIGUSR1 las vuelca",
+        default=False,
+    )
+    parser.add_option(
+        "--profile",
+        choices=["sample", "cprofile"],
+        help="Perfilador que se prende y apaga con SIGUSR2: muestreo de "
+        "pilas (sample) o cProfile; SIGUSR1 vuelca lo medido",
+        default=None,
+    )
+    parser.add_option(
+        "--profile-dir",
+        help="Directorio donde SIGUSR1 vuelca el tracing y los perfiles",
+        default=".",
+    )
+    parser.add_option(
+        "-w",
+        "--workers",
+        type="int",
+        help="Cantidad de procesos worker que atienden el mismo puerto "
+        "(0 para atender desde un solo proceso)",
+        default=0,
+    )
     # Si se proporcionan argumentos extra, imprime la ayuda y sale del programa.
     options, args = parser.parse_args()
     if len(args) > 0:
@@ -94,10 +923,49 @@ def main():
         sys.stderr.write("Numero de puerto invalido: %s\n" % repr(options.port))
         parser.print_help()
         sys.exit(1)
+    if options.metrics_port > 0 and options.workers > 0:
+        sys.stderr.write("--metrics-port no se puede usar con --workers\n")
+        parser.print_help()
+        sys.exit(1)
+    if options.block_size <= 0 or options.block_size % 3 != 0:
+        sys.stderr.write("Tamaño de bloque invalido: %d\n" % options.block_size)
+        parser.print_help()
+        sys.exit(1)
     # Crea un objeto servidor con IP, número de puerto y directorio especificados.
-    server = Server(options.address, port, options.datadir)
-    # Llama al método serve() para comenzar a escuchar conexiones entrantes.
-    server.serve()
+    server = SERVER_MODES[options.mode](
+        options.address,
+        port,
+        options.datadir,
+        reuse_port=options.workers > 0 and hasattr(socket, "SO_REUSEPORT"),
+        block_size=options.block_size,
+        cache_size=options.cache_size,
+        cache_b64=options.cache_b64,
+        use_mmap=options.mmap,
+        rate=options.rate,
+        global_rate=options.global_rate,
+        threads=options.threads,
+        accept_queue=options.accept_queue,
+        backlog=options.backlog,
+        max_connections=options.max_connections,
+        idle_timeout=options.idle_timeout,
+        metrics_port=options.metrics_port,
+        log_sample=options.log_sample,
+        access_log=options.access_log,
+        access_log_max_bytes=options.access_log_max_bytes,
+        access_log_backups=options.access_log_backups,
+        trace=options.trace,
+        profile=options.profile,
+        profile_dir=options.profile_dir,
+    )
+    if options.workers > 0:
+        # Los workers atienden las conexiones y este proceso los supervisa
+        Supervisor(server, options.workers).run()
+    else:
+        # Ante SIGTERM se drenan las conexiones abiertas antes de salir
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        server.handle_profile_signals()
+        # Llama al método serve() para comenzar a escuchar conexiones entrantes.
+        server.serve()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,250 @@
+# encoding: utf-8
+
+import cProfile
+import contextlib
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from constants import *
+
+# Context manager que no anota nada, para cuando no hay tracing
+NO_TRACE = contextlib.nullcontext()
+
+
+class Ring(object):
+    """
+    Buffer circular con los últimos eventos de un hilo. Solo lo modifica
+    el hilo dueño, así anotar un evento no necesita locks; quien lo lee
+    puede ver un evento a medio pisar, que es aceptable en un volcado.
+    """
+
+    def __init__(self, size: int):
+        self.events = [None] * size
+        self.count = 0  # Eventos anotados desde el principio
+        self.thread = threading.current_thread().name
+
+    def snapshot(self):
+        """
+        Devuelve los eventos guardados, del más viejo al más nuevo.
+        """
+        events = list(self.events)
+        cut = self.count % len(events)
+        return [e for e in events[cut:] + events[:cut] if e is not None]
+
+
+class Span(object):
+    """
+    Context manager que anota en el Tracer cuánto tardó su bloque.
+    """
+
+    def __init__(self, tracer, name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class Tracer(object):
+    """
+    Tracing de las fases de cada pedido (validación, lectura del disco,
+    codificación, envío) y de los pedidos enteros.
+
+    Cada hilo anota en su propio Ring de `size` eventos, sin locks: los
+    eventos viejos se pisan y siempre quedan los últimos, que son los que
+    interesan cuando sube la latencia.
+    """
+
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.size = size
+        self.rings = []
+        self.lock = threading.Lock()  # Solo para agregar rings
+        self.local = threading.local()
+
+    def ring(self):
+        """
+        Devuelve el Ring del hilo actual, creándolo si hace falta.
+        """
+        try:
+            return self.local.ring
+        except AttributeError:
+            ring = self.local.ring = Ring(self.size)
+            with self.lock:
+                self.rings.append(ring)
+            return ring
+
+    def add(self, name: str, start: float, elapsed: float):
+        """
+        Anota un evento `name` que empezó en `start` (según
+        time.perf_counter) y duró `elapsed` segundos.
+        """
+        ring = self.ring()
+        ring.events[ring.count % self.size] = (start, elapsed, name)
+        ring.count += 1
+
+    def span(self, name: str):
+        """
+        Devuelve un context manager que anota la duración de su bloque
+        como un evento `name`.
+        """
+        return Span(self, name)
+
+    def dump(self, stream, recent=TRACE_DUMP_EVENTS):
+        """
+        Escribe en `stream` el resumen por fase y por comando de los
+        eventos guardados, y los últimos `recent` eventos de cada hilo.
+        """
+        with self.lock:
+            rings = list(self.rings)
+        totals = {}
+        for ring in rings:
+            for start, elapsed, name in ring.snapshot():
+                count, total, worst = totals.get(name, (0, 0.0, 0.0))
+                totals[name] = (count + 1, total + elapsed, max(worst, elapsed))
+        stream.write(
+            "# Fases y pedidos: cantidad, total (ms), media (us), máximo (us)\n"
+        )
+        for name, (count, total, worst) in sorted(
+            totals.items(), key=lambda item: -item[1][1]
+        ):
+            stream.write(
+                "%-20s %8d %10.3f %10.1f %10.1f\n"
+                % (name, count, 1e3 * total, 1e6 * total / count, 1e6 * worst)
+            )
+        for ring in rings:
+            events = ring.snapshot()[-recent:]
+            if not events:
+                continue
+            stream.write(f"\n# Últimos eventos de {ring.thread}: inicio (s), us\n")
+            for start, elapsed, name in events:
+                stream.write("%14.6f %10.1f %s\n" % (start, 1e6 * elapsed, name))
+
+
+class StackSampler(object):
+    """
+    Perfilador por muestreo: un hilo aparte toma cada `interval` segundos
+    la pila de todos los demás hilos y cuenta cuántas veces se vio cada
+    una. Cuesta poco aunque quede activo un buen rato.
+
+    Las pilas se vuelcan en formato "collapsed" (una por línea, marcos
+    separados por ";" y la cantidad al final), el que usan las
+    herramientas de flame graphs. Los hilos esperando (en accept, recv o
+    la cola de conexiones) también aparecen.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def active(self):
+        return self.thread is not None
+
+    def start(self):
+        """
+        Empieza a tomar muestras.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Deja de tomar muestras; las ya tomadas se conservan.
+        """
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        me = threading.current_thread()
+        names = {}
+        while self.thread is me:
+            time.sleep(self.interval)
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    place = f"{code.co_filename}:{frame.f_lineno}"
+                    stack.append(f"{code.co_name} ({place})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                self.counts.update(stacks)
+
+    def dump(self, stream):
+        """
+        Escribe en `stream` las pilas vistas, de la más frecuente a la
+        menos.
+        """
+        with self.lock:
+            counts = self.counts.most_common()
+        stream.write(f"# Muestras de pilas cada {self.interval} s (collapsed)\n")
+        for stack, count in counts:
+            stream.write(f"{stack} {count}\n")
+
+
+class ThreadProfiler(object):
+    """
+    cProfile para un servidor con varios hilos. cProfile solo mide el hilo
+    que lo activa, así que cada hilo que atiende pedidos llama a check()
+    entre pedidos: ahí activa o desactiva su propio cProfile según
+    `active`, y al desactivarlo suma lo medido a las estadísticas comunes.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = None  # pstats.Stats con lo medido por todos los hilos
+
+    def check(self):
+        """
+        Activa o desactiva el cProfile del hilo actual según `active`.
+        """
+        profile = getattr(self.local, "profile", None)
+        if self.active and profile is None:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Desde Python 3.12 un solo cProfile ya mide todos los hilos
+                profile = False
+            self.local.profile = profile
+        elif not self.active and profile is not None:
+            self.local.profile = None
+            if profile is False:
+                return
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def dump(self, stream, limit=PROFILE_DUMP_LINES):
+        """
+        Escribe en `stream` las funciones más costosas, con lo que ya
+        sumaron los hilos que dejaron de medir.
+        """
+        stream.write("# cProfile (hilos que ya dejaron de medir)\n")
+        with self.lock:
+            if self.stats is None:
+                return
+            self.stats.stream = stream
+            self.stats.sort_stats("cumulative").print_stats(limit)